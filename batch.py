@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Пакетный рендер без Telegram: все шаблоны дерева templates/<PERSONA>/<stage>/…
+с фотографиями из папки, параллельно на всех ядрах.
+
+Пример:
+    python batch.py templates photos out --workers 8
+"""
+
+# ────────────────────────────────────────────────────────────────────
+# ► 0. ИМПОРТЫ
+# ────────────────────────────────────────────────────────────────────
+import os, sys, time, argparse, itertools, logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Optional, Tuple
+
+import render
+
+# ────────────────────────────────────────────────────────────────────
+# ► 1. ПОИСК ФАЙЛОВ
+# ────────────────────────────────────────────────────────────────────
+def find_photos(root: str) -> List[str]:
+    return sorted(
+        os.path.join(root, f) for f in os.listdir(root)
+        if f.lower().endswith(render.VALID_IMAGE_EXTENSIONS) and os.path.isfile(os.path.join(root, f))
+    )
+
+
+def plan_jobs(templates_root: str, photos: List[str], out_dir: str,
+              max_per_template: int) -> List[Tuple[str, List[str], str]]:
+    """
+    Список задач (шаблон, фото, путь результата без расширения).
+    Для шаблона с N областями берутся все сочетания по N фото.
+    """
+    jobs = []
+    for tpl_path in render.find_templates(templates_root):
+        try:
+            n = render.count_areas(tpl_path)
+        except Exception as e:
+            logging.error(f"Пропуск шаблона {tpl_path}: {e}")
+            continue
+        if n == 0 or n > len(photos):
+            logging.warning(f"Пропуск шаблона {tpl_path}: областей {n}, фото {len(photos)}")
+            continue
+        rel = os.path.splitext(os.path.relpath(tpl_path, templates_root))[0]
+        combos = itertools.combinations(photos, n)
+        if max_per_template > 0:
+            combos = itertools.islice(combos, max_per_template)
+        for combo in combos:
+            suffix = "+".join(os.path.splitext(os.path.basename(p))[0] for p in combo)
+            jobs.append((tpl_path, list(combo), os.path.join(out_dir, f"{rel}__{suffix}")))
+    return jobs
+
+
+# ────────────────────────────────────────────────────────────────────
+# ► 2. ВЫПОЛНЕНИЕ
+# ────────────────────────────────────────────────────────────────────
+def run_job(tpl_path: str, photo_paths: List[str], out_base: str,
+            seed: Optional[int] = None) -> Tuple[str, int, float]:
+    """Рендерит одну комбинацию и пишет результат на диск (в процессе пула)."""
+    t0 = time.perf_counter()
+    result = render.render_files(tpl_path, photo_paths, seed)
+    out_path = out_base + render.result_extension(result)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    with open(out_path, "wb") as f:
+        f.write(result)
+    return out_path, len(result), time.perf_counter() - t0
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Пакетный рендер шаблонов с фотографиями.")
+    parser.add_argument("templates", help="корень дерева шаблонов, например templates/")
+    parser.add_argument("photos", help="папка с фотографиями")
+    parser.add_argument("out", help="папка для результатов")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="процессов рендера")
+    parser.add_argument("--max-per-template", type=int, default=0,
+                        help="не больше N комбинаций фото на шаблон (0 — все)")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="сид поворота и сдвига: с ним повторный запуск дает те же байты")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    photos = find_photos(args.photos)
+    if not photos:
+        logging.error(f"В папке {args.photos} нет фото.")
+        return 1
+    jobs = plan_jobs(args.templates, photos, args.out, args.max_per_template)
+    logging.info(f"Задач: {len(jobs)}, воркеров: {args.workers}")
+
+    t0 = time.perf_counter()
+    done = failed = total_bytes = 0
+    busy = 0.0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(run_job, *job, args.seed): job for job in jobs}
+        for fut in as_completed(futures):
+            tpl_path, photo_paths, _ = futures[fut]
+            try:
+                out_path, size, dt = fut.result()
+            except Exception as e:
+                failed += 1
+                logging.error(f"Ошибка рендера {tpl_path} + {photo_paths}: {e}")
+                continue
+            done += 1
+            total_bytes += size
+            busy += dt
+            logging.info(f"[{done + failed}/{len(jobs)}] {out_path} {size // 1024} КБ за {dt:.2f} с")
+
+    wall = time.perf_counter() - t0
+    if done:
+        logging.info(
+            f"Готово: {done} ок, {failed} ошибок за {wall:.1f} с | "
+            f"{done / wall:.2f} задач/с, {done * 60 / wall:.1f} задач/мин | "
+            f"среднее время задачи {busy / done:.2f} с | {total_bytes / 1024 / 1024:.1f} МБ"
+        )
+    else:
+        logging.info(f"Готово: 0 ок, {failed} ошибок за {wall:.1f} с")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
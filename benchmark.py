@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Воспроизводимый бенчмарк рендера на синтетических шаблонах и фото.
+
+Каждый случай выполняется в отдельном процессе, чтобы пиковый RSS
+не смешивался между случаями. Все случайные данные генерируются из seed,
+результаты пишутся в JSON для сравнения между коммитами.
+
+Примеры:
+    python benchmark.py                               # все случаи → bench_results/<commit>.json
+    python benchmark.py --cases 2quad_small,1quad_huge --repeat 5
+    python benchmark.py --compare bench_results/a1b2c3d.json bench_results/e4f5a6b.json
+"""
+
+# ────────────────────────────────────────────────────────────────────
+# ► 0. ИМПОРТЫ
+# ────────────────────────────────────────────────────────────────────
+import os, sys, json, math, time, argparse, platform, resource, statistics, subprocess, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+# ────────────────────────────────────────────────────────────────────
+# ► 1. ОПИСАНИЕ СЛУЧАЕВ
+# ────────────────────────────────────────────────────────────────────
+DEFAULT_SEED     = 1234
+DEFAULT_REPEAT   = 3
+DEFAULT_WORKDIR  = os.path.join("bench_results", "assets")
+GREEN            = (0, 255, 0)
+
+# Фото типичных для телефона размеров: оригинал документом, фото Telegram (2560) и сжатое (1280)
+PHOTOS = {
+    "phone_12mp":       (4000, 3000),
+    "phone_12mp_port":  (3000, 4000),
+    "tg_2560":          (2560, 1920),
+    "tg_1280_port":     (960, 1280),
+}
+
+# Области задаются в долях размера шаблона:
+#   ("quad", [(x, y) × 4]) — четырехугольник, вставка через warpPerspective;
+#   ("ellipse", cx, cy, rx, ry, angle) — не 4-угольник, вставка поворотом.
+CASES: Dict[str, Dict[str, Any]] = {
+    "1quad_small": {
+        "size": (1000, 700), "photos": ["phone_12mp"],
+        "areas": [("quad", [(0.30, 0.15), (0.70, 0.17), (0.69, 0.85), (0.31, 0.83)])],
+    },
+    "2quad_small": {
+        "size": (1400, 900), "photos": ["phone_12mp", "tg_2560"],
+        "areas": [("quad", [(0.07, 0.11), (0.36, 0.13), (0.34, 0.78), (0.06, 0.76)]),
+                  ("quad", [(0.57, 0.17), (0.86, 0.17), (0.86, 0.83), (0.57, 0.83)])],
+    },
+    "3mixed_small": {
+        "size": (1800, 1000), "photos": ["phone_12mp", "tg_2560", "tg_1280_port"],
+        "areas": [("quad", [(0.05, 0.10), (0.28, 0.12), (0.27, 0.80), (0.04, 0.78)]),
+                  ("ellipse", 0.50, 0.45, 0.10, 0.30, 12.0),
+                  ("quad", [(0.70, 0.15), (0.95, 0.15), (0.94, 0.85), (0.71, 0.86)])],
+    },
+    "1rotated_nonquad": {
+        "size": (1200, 1200), "photos": ["phone_12mp_port"],
+        "areas": [("ellipse", 0.50, 0.50, 0.22, 0.38, -20.0)],
+    },
+    "2quad_large": {
+        "size": (4000, 3000), "photos": ["phone_12mp", "phone_12mp_port"],
+        "areas": [("quad", [(0.07, 0.11), (0.36, 0.13), (0.34, 0.78), (0.06, 0.76)]),
+                  ("quad", [(0.57, 0.17), (0.86, 0.17), (0.86, 0.83), (0.57, 0.83)])],
+    },
+    "1quad_huge": {
+        # 90 Мп > MAX_PIXELS_TPL — шаблон будет уменьшен
+        "size": (10000, 9000), "photos": ["phone_12mp"],
+        "areas": [("quad", [(0.30, 0.15), (0.70, 0.17), (0.69, 0.85), (0.31, 0.83)])],
+    },
+}
+
+# ────────────────────────────────────────────────────────────────────
+# ► 2. ГЕНЕРАЦИЯ ДАННЫХ
+# ────────────────────────────────────────────────────────────────────
+def _smooth_noise(rng: np.random.Generator, size: Tuple[int, int]) -> Image.Image:
+    """Плавный «фотографический» шум: несколько октав, растянутых бикубически."""
+    w, h = size
+    acc = np.zeros((h, w, 3), dtype=np.float32)
+    for cell, amp in ((8, 60.0), (64, 45.0), (512, 35.0)):
+        small = rng.integers(0, 256, (max(2, h // cell), max(2, w // cell), 3), dtype=np.uint8)
+        big = np.asarray(Image.fromarray(small).resize((w, h), Image.BICUBIC), dtype=np.float32)
+        acc += (big - 127.5) * (amp / 127.5)
+    acc += 127.5
+    return Image.fromarray(np.clip(acc, 0, 255).astype(np.uint8))
+
+
+def _ellipse_points(cx: float, cy: float, rx: float, ry: float, angle: float, n: int = 72) -> List[Tuple[float, float]]:
+    a = math.radians(angle)
+    pts = []
+    for i in range(n):
+        t = 2 * math.pi * i / n
+        x, y = rx * math.cos(t), ry * math.sin(t)
+        pts.append((cx + x * math.cos(a) - y * math.sin(a), cy + x * math.sin(a) + y * math.cos(a)))
+    return pts
+
+
+def generate_assets(workdir: str, seed: int, cases: List[str]) -> None:
+    """Создает шаблоны, фото и filter.png в workdir (повторно не перегенерирует)."""
+    os.makedirs(workdir, exist_ok=True)
+    for name, size in PHOTOS.items():
+        path = os.path.join(workdir, f"photo_{name}_{seed}.jpg")
+        if not os.path.exists(path):
+            rng = np.random.default_rng([seed, len(name), size[0], size[1]])
+            _smooth_noise(rng, size).save(path, quality=92)
+
+    filt_path = os.path.join(workdir, "filter.png")
+    if not os.path.exists(filt_path):
+        yy, xx = np.mgrid[0:800, 0:600].astype(np.float32)
+        vignette = np.clip(((xx / 600 - 0.5) ** 2 + (yy / 800 - 0.5) ** 2) * 4, 0, 1) * 180
+        filt = np.zeros((800, 600, 4), dtype=np.uint8)
+        filt[..., :3] = (230, 200, 150)
+        filt[..., 3] = vignette.astype(np.uint8)
+        Image.fromarray(filt, "RGBA").save(filt_path)
+
+    for name in cases:
+        path = os.path.join(workdir, f"tpl_{name}_{seed}.jpg")
+        if os.path.exists(path):
+            continue
+        case = CASES[name]
+        w, h = case["size"]
+        # Фон генерируем в уменьшенном виде — для огромных шаблонов это экономит память
+        rng = np.random.default_rng([seed, w, h, len(case["areas"])])
+        bg = np.array(_smooth_noise(rng, (max(2, w // 4), max(2, h // 4))))
+        bg[..., 1] = np.minimum(bg[..., 1], 180)  # фон не должен попадать в маску зеленого
+        img = Image.fromarray(bg).resize((w, h), Image.BICUBIC)
+        draw = ImageDraw.Draw(img)
+        for area in case["areas"]:
+            if area[0] == "quad":
+                draw.polygon([(x * w, y * h) for x, y in area[1]], fill=GREEN)
+            else:
+                _, cx, cy, rx, ry, angle = area
+                draw.polygon(_ellipse_points(cx * w, cy * h, rx * w, ry * h, angle), fill=GREEN)
+        img.save(path, quality=95)
+
+
+# ────────────────────────────────────────────────────────────────────
+# ► 3. ЗАМЕРЫ (в отдельном процессе)
+# ────────────────────────────────────────────────────────────────────
+def _rss_mb() -> float:
+    """
+    Пиковый RSS процесса, МБ. VmHWM сбрасывается при exec, а ru_maxrss
+    наследует пик родителя, поэтому сначала пробуем /proc.
+    """
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Linux: КБ
+
+
+def run_case(name: str, workdir: str, seed: int, repeat: int) -> Dict[str, Any]:
+    """Выполняет один случай: холодная компиляция шаблона и repeat рендеров."""
+    os.chdir(workdir)  # filter.png берется из рабочей папки бенчмарка
+    import render
+
+    tpl_path = f"tpl_{name}_{seed}.jpg"
+    photos = []
+    for ph in CASES[name]["photos"]:
+        with open(f"photo_{ph}_{seed}.jpg", "rb") as f:
+            photos.append(f.read())
+    rss_base = _rss_mb()
+
+    with render.collect_stages() as tpl_stages:
+        t0 = time.perf_counter()
+        compiled = render.get_compiled_template(tpl_path)
+        tpl_wall = time.perf_counter() - t0
+
+    walls, stages, sizes = [], [], []
+    for r in range(repeat):
+        with render.collect_stages() as st:
+            t0 = time.perf_counter()
+            result = render.render_job(tpl_path, photos, seed=seed + r)
+            walls.append(time.perf_counter() - t0)
+        stages.append(st)
+        sizes.append(len(result))
+
+    stage_names = sorted({k for st in stages for k in st})
+    return {
+        "template_size": list(compiled.size),
+        "canvas_size": list(compiled.tpl_big.size),
+        "areas": len(compiled.areas),
+        "template_compile_s": round(tpl_wall, 4),
+        "template_stages_s": {k: round(v, 4) for k, v in sorted(tpl_stages.items())},
+        "wall_s": [round(w, 4) for w in walls],
+        "wall_median_s": round(statistics.median(walls), 4),
+        "wall_min_s": round(min(walls), 4),
+        "stages_median_s": {k: round(statistics.median(st.get(k, 0.0) for st in stages), 4) for k in stage_names},
+        "result_bytes": sizes,
+        "rss_base_mb": round(rss_base, 1),
+        "peak_rss_mb": round(_rss_mb(), 1),
+    }
+
+
+# ────────────────────────────────────────────────────────────────────
+# ► 4. ОТЧЕТ И СРАВНЕНИЕ
+# ────────────────────────────────────────────────────────────────────
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def _settings() -> Dict[str, Any]:
+    import render
+    keys = ("OUT_DIM", "SCALE_MONO", "MAX_PIXELS_TPL", "MONO_MODE", "MONO_SUPERSAMPLE",
+            "MONO_PIXEL_BUDGET", "COMPOSITE_MODE")
+    return {k: getattr(render, k) for k in keys if hasattr(render, k)}
+
+
+def compare(old_path: str, new_path: str) -> None:
+    with open(old_path, encoding="utf-8") as f: old = json.load(f)
+    with open(new_path, encoding="utf-8") as f: new = json.load(f)
+    print(f"{old['meta']['git_commit']} → {new['meta']['git_commit']}")
+    print(f"{'случай':<18} {'время, с':>20} {'Δ':>8} {'пик RSS, МБ':>22}")
+    for name in sorted(set(old["cases"]) | set(new["cases"])):
+        a, b = old["cases"].get(name), new["cases"].get(name)
+        if not a or not b or "error" in a or "error" in b:
+            print(f"{name:<18} {'нет данных для сравнения':>20}")
+            continue
+        wa, wb = a["wall_median_s"], b["wall_median_s"]
+        delta = (wb - wa) / wa * 100 if wa else 0.0
+        print(f"{name:<18} {wa:>9.3f} → {wb:<8.3f} {delta:>+7.1f}% "
+              f"{a['peak_rss_mb']:>9.0f} → {b['peak_rss_mb']:<9.0f}")
+        for st in sorted(set(a["stages_median_s"]) | set(b["stages_median_s"])):
+            sa, sb = a["stages_median_s"].get(st, 0.0), b["stages_median_s"].get(st, 0.0)
+            print(f"  {st:<16} {sa:>9.3f} → {sb:<8.3f}")
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарк рендера на синтетических данных.")
+    parser.add_argument("--cases", default=",".join(CASES), help="случаи через запятую")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="рендеров на случай")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--workdir", default=DEFAULT_WORKDIR, help="папка для сгенерированных данных")
+    parser.add_argument("--out", help="JSON с результатами (по умолчанию bench_results/<commit>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="сравнить два JSON и выйти")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    cases = [c.strip() for c in args.cases.split(",") if c.strip()]
+    unknown = [c for c in cases if c not in CASES]
+    if unknown:
+        parser.error(f"неизвестные случаи: {', '.join(unknown)}")
+
+    workdir = os.path.abspath(args.workdir)
+    print(f"Генерация данных в {workdir} (seed={args.seed})…", flush=True)
+    generate_assets(workdir, args.seed, cases)
+
+    commit = _git_commit()
+    report = {
+        "meta": {
+            "git_commit": commit,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "settings": _settings(),
+        },
+        "cases": {},
+    }
+    ctx = multiprocessing.get_context("spawn")
+    for name in cases:
+        print(f"▶ {name}", flush=True)
+        # Новый процесс на каждый случай: честный пиковый RSS и холодный кэш шаблонов
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            try:
+                res = pool.submit(run_case, name, workdir, args.seed, args.repeat).result()
+            except Exception as e:
+                res = {"error": repr(e)}
+        report["cases"][name] = res
+        if "error" in res:
+            print(f"  ошибка: {res['error']}")
+        else:
+            stages = ", ".join(f"{k}={v:.3f}" for k, v in res["stages_median_s"].items())
+            print(f"  {res['wall_median_s']:.3f} с (min {res['wall_min_s']:.3f}), "
+                  f"пик RSS {res['peak_rss_mb']:.0f} МБ | {stages}")
+
+    out = args.out or os.path.join("bench_results", f"{commit}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты: {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
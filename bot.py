@@ -7,67 +7,71 @@ Telegram-бот для вставки НЕСКОЛЬКИХ фотографий
 # ────────────────────────────────────────────────────────────────────
 # ► 0. ИМПОРТЫ
 # ────────────────────────────────────────────────────────────────────
-import io, os, math, random, traceback, warnings, sys, logging, time, re
-from typing import Dict, Any, List, Tuple, Optional
+import os, sys, logging, time, asyncio
+from typing import Dict, Any, List, Set, Tuple, Optional
 
-import requests
+from PIL import Image, UnidentifiedImageError
 
-import numpy as np
-import cv2
-from PIL import Image, ImageFilter
 from dotenv import load_dotenv
 
-os.makedirs("logs", exist_ok=True)
-
-# настраиваем корневой логгер
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s %(levelname)s %(message)s",
-    handlers=[
-        logging.FileHandler("logs/bot.log", encoding="utf-8"),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
-
+# .env загружаем до импорта модулей, читающих настройки из окружения
+load_dotenv()
 
-import telebot
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
+from render import (templates_dir, TG_PHOTO_LIMIT, PREVIEW_SIZE, count_areas, result_extension,
+                    prepare_photo, new_seed, find_templates)
+from engine import RenderEngine, RenderJob, QueueFullError, ChatBusyError
+from jobqueue import QueueEngine
+from metrics import METRICS, start_metrics_server
+from health import HEALTH, HEALTH_POLL_STALE, HEALTH_JOB_STALE
+from sessions import SessionStore
+from catalog import Catalog
+from result_cache import ResultCache, job_key
+from outbox import Outbox, with_retries
+import webhook
+from logsetup import setup_logging, stop_logging, worker_log_queue, dropped_records, log_job
+
+# Логи пишет фоновый поток (см. logsetup.py). Только в основном процессе:
+# воркеры пула импортируют этот модуль заново и логируют через очередь движка
+if __name__ == "__main__":
+    setup_logging()
 
-# ────────────────────────────────────────────────────────────────────
-# ► 1. НАСТРОЙКА PIL
-# ────────────────────────────────────────────────────────────────────
-Image.MAX_IMAGE_PIXELS = None
-warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, Message
 
 # ────────────────────────────────────────────────────────────────────
-# ► 2. ГЛОБАЛЬНЫЕ КОНСТАНТЫ
+# ► 1. ГЛОБАЛЬНЫЕ КОНСТАНТЫ
 # ────────────────────────────────────────────────────────────────────
-templates_dir      = "templates"
-filter_path        = "filter.png"
-OUT_DIM            = 2048
-scale_pixels       = 75
-upscale_factor     = 0.5
-SCALE_MONO         = 8
-min_shift, max_shift       = 2, 8
-min_rotation, max_rotation = 1, 3
-thickness, box_blur_radius = 25, 5
-MAX_PIXELS_TPL     = 80_000_000
-TG_PHOTO_LIMIT     = 10_485_760
-SEND_RETRIES       = 3
-VALID_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
-MIN_CONTOUR_AREA = 1000 # Минимальная площадь зеленой области для учета
+TG_CONNECTIONS     = int(os.getenv("TG_CONNECTIONS", 50))  # соединений в общем пуле HTTP-сессии
+TG_API_BASE        = os.getenv("TG_API_BASE", "")  # другой адрес Bot API (локальный сервер, fake_botapi.py)
+ALBUM_DEBOUNCE     = float(os.getenv("ALBUM_DEBOUNCE", 1.5))  # секунд ждать остальные фото альбома
+PREWARM_TEMPLATES  = os.getenv("PREWARM_TEMPLATES", "1") != "0"  # компилировать шаблоны при старте
+PREWARM_LOG_EVERY  = 60  # секунд между сообщениями, если воркеры долго не прогреваются
+# local — пул процессов внутри бота; queue — задачи в общую очередь для worker.py (см. jobqueue.py)
+RENDER_MODE        = os.getenv("RENDER_MODE", "local")
+# Кому доступна команда /stats: ID через запятую
+ADMIN_USER_IDS     = {int(x) for x in os.getenv("ADMIN_USER_IDS", "").replace(" ", "").split(",") if x}
 
 # ────────────────────────────────────────────────────────────────────
-# ► 3. ГОТОВЫЕ СООБЩЕНИЯ / ЭМОДЗИ
+# ► 2. ГОТОВЫЕ СООБЩЕНИЯ / ЭМОДЗИ
 # ────────────────────────────────────────────────────────────────────
 MSG_SELECT_PERSONA   = "🎭 Выберите персонажа:"
 MSG_SELECT_STAGE     = "📟 Выберите этап"
 MSG_SELECT_TEMPLATE  = "🖼️ Выберите шаблон"
 MSG_SELECT_VARIANT   = "🔢 Выберите вариант"
 MSG_SEND_PHOTO       = "📥 Отправь фото {current_num} из {total_num}" # ИЗМЕНЕНО
+MSG_SEND_PHOTOS      = "📥 Отправь {total_num} фото — можно одним альбомом"
+MSG_ALBUM_EXTRA      = "Лишние фото из альбома пропущены: {count}."
 MSG_PROCESSING       = "⏳ Идёт обработка…"
+MSG_QUEUED           = "⏳ Вы в очереди: {position}. Результат придёт автоматически."
+MSG_QUEUE_FULL       = "⏳ Сейчас слишком много задач. Попробуйте через пару минут."
+MSG_ALREADY_RENDERING = "⏳ Предыдущая обработка ещё не закончилась."
+MSG_RENDER_CANCELLED = "Предыдущая обработка отменена."
 MSG_DONE             = "✅ Готово!"
+MSG_PREVIEW          = "👀 Предпросмотр, полное качество будет через несколько секунд…"
 BTN_REGENERATE       = "Сгенерировать снова"
+BTN_START_OVER       = "Начать заново"
+MSG_REGEN_EXPIRED    = "Фото уже удалены — начните заново."
 MSG_NO_ACCESS        = "Нет доступа."
 MSG_START_FIRST      = "Сначала /start."
 MSG_TEMPLATE_NOT_FOUND = "Шаблон не найден."
@@ -82,7 +86,7 @@ STAGE_NAME_MAP = {
 }
 
 # ────────────────────────────────────────────────────────────────────
-# ► 4. ЗАГРУЗКА «БЕЛОГО» СПИСКА ПОЛЬЗОВАТЕЛЕЙ
+# ► 3. ЗАГРУЗКА «БЕЛОГО» СПИСКА ПОЛЬЗОВАТЕЛЕЙ
 # ────────────────────────────────────────────────────────────────────
 def load_allowed_user_ids(fname: str = "allowed_users.txt") -> set[int]:
     ids = set()
@@ -101,571 +105,747 @@ def load_allowed_user_ids(fname: str = "allowed_users.txt") -> set[int]:
 ALLOWED_USER_IDS = load_allowed_user_ids()
 
 # ────────────────────────────────────────────────────────────────────
-# ► 5. ИНИЦИАЛИЗАЦИЯ TELEGRAM-БОТА
+# ► 4. ИНИЦИАЛИЗАЦИЯ TELEGRAM-БОТА
 # ────────────────────────────────────────────────────────────────────
-load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     logging.critical("BOT_TOKEN не найден в .env файле! Бот не сможет запуститься.")
     sys.exit(1)
 
-bot = telebot.TeleBot(BOT_TOKEN)
-
-import telebot.apihelper as tbh
-tbh.SEND_FILE_TIMEOUT = 120
-tbh.CONNECT_TIMEOUT = 30
-tbh.READ_TIMEOUT = 120
+# Все запросы к Bot API идут через одну aiohttp-сессию telebot с пулом соединений
+asyncio_helper.REQUEST_TIMEOUT = 120
+asyncio_helper.REQUEST_LIMIT = TG_CONNECTIONS
+if TG_API_BASE:
+    asyncio_helper.API_URL = TG_API_BASE.rstrip("/") + "/bot{0}/{1}"
+    asyncio_helper.FILE_URL = TG_API_BASE.rstrip("/") + "/file/bot{0}/{1}"
+
+bot = AsyncTeleBot(BOT_TOKEN)
+# Сообщения, правки и удаления уходят через очередь с лимитами Telegram (см. outbox.py);
+# ответы на нажатия кнопок — напрямую, иначе у пользователя крутятся «часики»
+outbox = Outbox(bot)
 logging.info("Bot ready")
 
 # ────────────────────────────────────────────────────────────────────
-# ► 6. ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
+# ► 5. ХРАНИЛИЩЕ СОСТОЯНИЙ
 # ────────────────────────────────────────────────────────────────────
-def get_personas() -> list[str]:
-    if not os.path.exists(templates_dir) or not os.path.isdir(templates_dir):
-        logging.error(f"Папка шаблонов '{templates_dir}' не найдена.")
-        return []
-    return sorted(d for d in os.listdir(templates_dir) if os.path.isdir(os.path.join(templates_dir, d)))
-
-def get_stages_for_persona(persona: str) -> List[Tuple[str, str]]:
-    persona_path = os.path.join(templates_dir, persona)
-    stages = []
-    if os.path.isdir(persona_path):
-        for item in os.listdir(persona_path):
-            item_path = os.path.join(persona_path, item)
-            if os.path.isdir(item_path) and item.isdigit():
-                display_name = STAGE_NAME_MAP.get(item, f"Этап {item}")
-                stages.append((item, display_name))
-    return sorted(stages, key=lambda x: int(x[0]))
-
-def get_templates_in_path(current_path: str) -> List[str]:
-    templates = []
-    if os.path.isdir(current_path):
-        for item in os.listdir(current_path):
-            item_path = os.path.join(current_path, item)
-            if os.path.isfile(item_path) and item.lower().endswith(VALID_IMAGE_EXTENSIONS):
-                templates.append(item)
-    return sorted(templates)
-
-def group_templates_by_basename(current_path: str) -> Dict[str, Dict[int, str]]:
-    """\
-    Возвращает словарь групп шаблонов вида {basename: {number: filename}}.
-
-    basename -- имя файла без суффикса _1/_2 и расширения. number -- 1, 2, ...
-    """
-    groups: Dict[str, Dict[int, str]] = {}
-    for fname in get_templates_in_path(current_path):
-        base = get_template_name_without_extension(fname)
-        if base.endswith("_1") or base.endswith("_2"):
-            key = base[:-2]
-            try:
-                num = int(base[-1])
-            except ValueError:
-                num = 1
-        else:
-            key = base
-            num = 1
-        groups.setdefault(key, {})[num] = fname
-    return groups
-
-def get_template_name_without_extension(filename: str) -> str:
-    return os.path.splitext(filename)[0]
-
-def order_corners(pts: np.ndarray) -> np.ndarray:
-    pts = np.asarray(pts, dtype="float32")
-    s = pts.sum(1)
-    diff = np.diff(pts, axis=1)
-    tl, br = pts[np.argmin(s)], pts[np.argmax(s)]
-    tr, bl = pts[np.argmin(diff)], pts[np.argmax(diff)]
-    return np.array([tl, tr, br, bl], dtype="float32")
-
-def _save_png(img: Image.Image) -> bytes:
-    buf = io.BytesIO()
-    img.save(buf, "PNG")
-    buf.seek(0)
-    return buf.getvalue()
-
-def _save_jpeg(img: Image.Image, q: int = 95) -> bytes:
-    buf = io.BytesIO()
-    img.convert("RGB").save(buf, "JPEG", quality=q)
-    buf.seek(0)
-    return buf.getvalue()
-
-def _safe_send(func, *args, **kwargs):
-    """Отправляет медиа с несколькими попытками при таймауте."""
-    for attempt in range(1, SEND_RETRIES + 1):
-        try:
-            return func(*args, **kwargs)
-        except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError) as e:
-            logging.warning(
-                f"Timeout или ошибка соединения при отправке (попытка {attempt}/{SEND_RETRIES}): {e}")
-            if attempt == SEND_RETRIES:
-                raise
-            time.sleep(2)
+# Хранилище сессий, каталог шаблонов и движок рендера создаются в точке входа:
+# воркеры пула импортируют этот модуль заново и не должны поднимать собственные копии
+sessions: Optional[SessionStore] = None
+catalog: Optional[Catalog] = None
+render_engine: Optional[RenderEngine] = None
+results: Optional[ResultCache] = None
+# Цикл событий бота: колбэки движка приходят из его потоков и передаются сюда
+event_loop: Optional[asyncio.AbstractEventLoop] = None
 
 # ────────────────────────────────────────────────────────────────────
-# ► 7. НОВЫЕ ФУНКЦИИ АНАЛИЗА И ОБРАБОТКИ
+# ► 6. ХЕНДЛЕРЫ БОТА
 # ────────────────────────────────────────────────────────────────────
+async def common_access_check(user_id: int, chat_id: int) -> bool:
+    if user_id not in ALLOWED_USER_IDS:
+        await outbox.send_message(chat_id, MSG_NO_ACCESS)
+        return False
+    return True
 
-def find_and_sort_green_areas(tpl_img: Image.Image) -> List[np.ndarray]:
-    """
-    Находит все зеленые области в шаблоне, фильтрует слишком маленькие
-    и сортирует их слева направо по X-координате центра.
-    """
-    tpl_rgba = tpl_img.convert("RGBA")
-    b, g, r, _ = np.asarray(tpl_rgba).transpose(2, 0, 1)
-    mask = ((g > 200) & (r < 100) & (b < 100)).astype(np.uint8) * 255
+async def common_access_check_callback(call) -> bool:
+    if call.from_user.id not in ALLOWED_USER_IDS:
+        await bot.answer_callback_query(call.id, MSG_NO_ACCESS, show_alert=True)
+        return False
+    return True
 
-    cnts, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+async def request_next_photo(chat_id: int, message_id: Optional[int] = None):
+    """Запрашивает следующее фото или запускает обработку, если все собраны."""
+    state = sessions.get(chat_id)
+    if state.get("state") != "waiting_photos":
+        return
 
-    # Фильтруем контуры по минимальной площади
-    significant_contours = [
-        cnt for cnt in cnts if cv2.contourArea(cnt) > MIN_CONTOUR_AREA
-    ]
+    required = state.get("required_photos", 0)
+    photos = state.get("photos", [])
 
-    if not significant_contours:
-        return []
+    if len(photos) < required:
+        # Запрашиваем следующее фото; в начале — подсказка, что можно прислать альбомом
+        if not photos and required > 1:
+            msg = MSG_SEND_PHOTOS.format(total_num=required)
+        else:
+            msg = MSG_SEND_PHOTO.format(current_num=len(photos) + 1, total_num=required)
+        if message_id:
+            await outbox.edit_message_text(msg, chat_id, message_id)
+        else:
+            await outbox.send_message(chat_id, msg)
+    else:
+        # Все фото собраны. Переход в «rendering» атомарный: если два фото
+        # пришли одновременно, задачу поставит только один из хендлеров
+        if not sessions.compare_and_set_state(chat_id, "waiting_photos", "rendering"):
+            return
+        await _submit_render(chat_id, state["template_file"])
 
-    # Сортируем контуры по X-координате их ограничивающего прямоугольника
-    # Это гарантирует обработку слева направо
-    sorted_contours = sorted(significant_contours, key=lambda c: cv2.boundingRect(c)[0])
-    
-    return sorted_contours
 
-def process_template_with_multiple_photos(tpl_img: Image.Image, user_imgs: List[Image.Image]) -> bytes:
+async def _submit_render(chat_id: int, template_file: str, regen: bool = False) -> None:
     """
-    Основная функция обработки: находит зеленые области, сортирует их
-    и вставляет в них фото из списка user_imgs.
+    Ставит задачу в очередь рендера и сразу возвращается. Сессия уже в
+    состоянии «rendering». Монолиты кэшируются в каталоге чата, поэтому
+    повторная генерация (regen=True) пропускает их построение.
+
+    Первый рендер берет сид из содержимого шаблона и фото, так что повтор
+    тех же входов отдается из кэша результатов без рендера; повторная
+    генерация — новая вариация со случайным сидом.
     """
-    # 7.1 --- АПСКЕЙЛ ШАБЛОНА
-    out_scale = OUT_DIM / max(tpl_img.size) if max(tpl_img.size) < OUT_DIM else 1.0
-    tpl_big = tpl_img.resize(
-        (int(tpl_img.width * out_scale), int(tpl_img.height * out_scale)),
-        Image.LANCZOS
-    )
-    if tpl_big.width * tpl_big.height > MAX_PIXELS_TPL:
-        factor = math.sqrt(MAX_PIXELS_TPL / (tpl_big.width * tpl_big.height))
-        tpl_big = tpl_big.resize(
-            (int(tpl_big.width * factor), int(tpl_big.height * factor)),
-            Image.LANCZOS
-        )
-        out_scale *= factor
+    tpl_path = os.path.join(templates_dir, template_file)
+    photos = sessions.photo_paths(chat_id)
+    seed = new_seed() if regen else None
+    try:
+        cache_key, seed = await asyncio.to_thread(job_key, tpl_path, photos, seed)
+        cached = await asyncio.to_thread(results.get, cache_key)
+    except OSError as e:
+        # Файл пропал — рендер сообщит об ошибке как обычно, кэш тут ни при чем
+        logging.warning(f"Не удалось вычислить ключ кэша результатов | chat={chat_id}: {e}")
+        cache_key, cached = None, None
+        seed = new_seed() if seed is None else seed
+    if cached is not None:
+        logging.info(f"Результат из кэша | chat={chat_id} key={cache_key[:12]} seed={seed}")
+        job = RenderJob(chat_id, tpl_path, photos, seed=seed)
+        job.stats["cached"] = True
+        await _on_render_done(job, cached, None)
+        return
 
-    res = tpl_big.convert("RGBA")
+    position = render_engine.next_position()
+    status_text = MSG_PROCESSING if position == 0 else MSG_QUEUED.format(position=position)
+    status_msg = await outbox.send_message(chat_id, status_text)
 
-    # 7.2 --- ПОИСК И СОРТИРОВКА ЗЕЛЕНЫХ ОБЛАСТЕЙ
-    # Используем оригинальный, не масштабированный шаблон для поиска
-    sorted_contours = find_and_sort_green_areas(tpl_img)
-    
-    if not sorted_contours:
-        return _save_png(res)
-
-    # Итерируемся по отсортированным контурам и предоставленным фото
-    # min(len(..)) для безопасности, если фото прислали меньше чем надо
-    for i in range(min(len(sorted_contours), len(user_imgs))):
-        cnt = sorted_contours[i]
-        user_img = user_imgs[i]
-        
-        # Масштабируем контур в соответствии с апскейлом шаблона
-        scaled_cnt = (cnt * out_scale).astype(np.int32)
-
-        # 7.3 --- ПРОВЕРКА: 4-угольник или нет
-        peri = cv2.arcLength(scaled_cnt, True)
-        approx = cv2.approxPolyDP(scaled_cnt, 0.02 * peri, True)
-        persp = len(approx) == 4
-
-        if persp:
-            # Для 4-угольника, мы все равно используем minAreaRect, чтобы получить
-            # наиболее точные, неискаженные размеры для создания "монолита".
-            # Это гарантирует правильные пропорции.
-            (cx0, cy0), (w0, h0), ang = cv2.minAreaRect(scaled_cnt)
-            long_side, short_side = int(max(w0, h0)), int(min(w0, h0))
-
-            # Но для вставки мы используем warpPerspective с точными углами 4-угольника.
-            quad = order_corners([p[0] for p in approx])
-            center = quad.mean(0, keepdims=True)
-            vecs = quad - center
-            lens = np.linalg.norm(vecs, 1, keepdims=True)
-            quad = quad + vecs / (lens + 1e-6) * scale_pixels * out_scale
+    # Поворот и сдвиг выбираются по сиду здесь, чтобы превью и полный результат совпали
+    job = RenderJob(chat_id, tpl_path, photos, status_msg.message_id,
+                    mono_dir=sessions.mono_dir(chat_id), seed=seed, preview_size=PREVIEW_SIZE,
+                    cache_key=cache_key if results.enabled else None)
+    # Оценка памяти читает шаблон с диска — вне цикла событий
+    await asyncio.to_thread(render_engine.estimate, job)
+    try:
+        render_engine.submit(job)
+    except ChatBusyError:
+        await outbox.edit_message_text(MSG_ALREADY_RENDERING, chat_id, status_msg.message_id)
+        return
+    except QueueFullError:
+        logging.warning(f"Очередь рендера заполнена | chat={chat_id}")
+        METRICS.inc("jobs_total", "rejected")
+        if regen:
+            # Фото остаются — пользователь может нажать кнопку еще раз
+            sessions.compare_and_set_state(chat_id, "rendering", "done")
+            kb_retry = _result_keyboard()
         else:
-            (cx0, cy0), (w0, h0), ang = cv2.minAreaRect(scaled_cnt)
-            long_side, short_side = int(max(w0, h0)), int(min(w0, h0))
+            await asyncio.to_thread(sessions.reset, chat_id)
+            kb_retry = InlineKeyboardMarkup().add(InlineKeyboardButton(BTN_START_OVER, callback_data="start_over"))
+        await outbox.edit_message_text(MSG_QUEUE_FULL, chat_id, status_msg.message_id, reply_markup=kb_retry)
+        return
 
-        if long_side == 0 or short_side == 0: continue # Пропускаем вырожденные области
 
-        # 7.4 --- СОЗДАЕМ «МОНОЛИТ»
-        # H всегда будет длинной стороной, W - короткой. Это сохраняет консистентность.
-        H = int((long_side + scale_pixels * out_scale) * upscale_factor) * SCALE_MONO
-        W = int((short_side + scale_pixels * out_scale) * upscale_factor) * SCALE_MONO
-        if W == 0 or H == 0: continue
+def _result_keyboard() -> InlineKeyboardMarkup:
+    kb = InlineKeyboardMarkup()
+    kb.add(InlineKeyboardButton(BTN_REGENERATE, callback_data="regen"))
+    kb.add(InlineKeyboardButton(BTN_START_OVER, callback_data="start_over"))
+    return kb
 
-        usr_big = user_img.convert("RGBA").resize(
-            (int(user_img.width * upscale_factor * SCALE_MONO), int(user_img.height * upscale_factor * SCALE_MONO)),
-            Image.LANCZOS
-        )
-        sc_fill = max(W / usr_big.width, H / usr_big.height)
-        usr_fill = usr_big.resize(
-            (int(usr_big.width * sc_fill), int(usr_big.height * sc_fill)),
-            Image.BICUBIC if sc_fill > 1 else Image.LANCZOS
-        )
-        lft, top = (usr_fill.width - W) // 2, (usr_fill.height - H) // 2
-        cropped = usr_fill.crop((lft, top, lft + W, top + H))
-
-        mono = cropped # По умолчанию, если фильтра нет
-        if os.path.exists(filter_path):
-            filt = Image.open(filter_path).convert("RGBA").resize((W, H), Image.LANCZOS)
-            mono = Image.new("RGBA", filt.size, (0, 0, 0, 0))
-            mono.paste(cropped, (0, 0))
-            mono = Image.alpha_composite(mono, filt)
-
-        mono = mono.rotate(
-            random.choice([-1, 1]) * random.uniform(min_rotation, max_rotation),
-            expand=True, resample=Image.BICUBIC
-        )
-        mono = mono.resize((mono.width // SCALE_MONO, mono.height // SCALE_MONO), Image.LANCZOS)
-        dx, dy = random.choice([-1, 1]) * random.randint(min_shift, max_shift), random.choice([-1, 1]) * random.randint(min_shift, max_shift)
-
-        # 7.5 --- ВСТАВКА «МОНОЛИТА»
-        if persp:
-            # По просьбе пользователя, добавляем искусственное растягивание по горизонтали.
-            # Мы берем исходное изображение (монолит) и делаем вид, что оно на 20 пикселей уже,
-            # обрезая по 10 пикселей слева и справа. Когда cv2.getPerspectiveTransform
-            # будет растягивать эту "узкую" версию до полного размера целевого
-            # четырехугольника (quad), изображение растянется.
-            stretch_amount = 8 # пикселей с каждой стороны
-            src = np.array([
-                [stretch_amount, 0],
-                [W // SCALE_MONO - stretch_amount, 0],
-                [W // SCALE_MONO - stretch_amount, H // SCALE_MONO],
-                [stretch_amount, H // SCALE_MONO]
-            ], dtype="float32")
-            quad_shift = quad + np.array([dx, dy], dtype="float32")
-            M = cv2.getPerspectiveTransform(src, quad_shift)
-            canvas_bgr = cv2.cvtColor(np.asarray(res), cv2.COLOR_RGBA2BGRA)
-            mono_bgr = cv2.cvtColor(np.asarray(mono), cv2.COLOR_RGBA2BGRA)
-            warp = cv2.warpPerspective(
-                mono_bgr, M, dsize=res.size, flags=cv2.INTER_LANCZOS4,
-                borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0)
-            )
-            alpha = warp[:, :, 3:4] / 255.0
-            canvas_bgr[:, :, :3] = canvas_bgr[:, :, :3] * (1 - alpha) + warp[:, :, :3] * alpha
-            res = Image.fromarray(cv2.cvtColor(canvas_bgr, cv2.COLOR_BGRA2RGBA), "RGBA")
-        else:
-            (cx, cy), (w_rect, h_rect), ang_rect = cv2.minAreaRect(scaled_cnt)
-            effective_angle = ang_rect
-            if w_rect < h_rect: mono_rot = mono.rotate(-effective_angle, expand=True, resample=Image.BICUBIC)
-            else: mono_rot = mono.rotate(-effective_angle - 90, expand=True, resample=Image.BICUBIC)
-            layer = Image.new("RGBA", res.size, (0, 0, 0, 0))
-            paste_x, paste_y = int(cx + dx - mono_rot.width / 2), int(cy + dy - mono_rot.height / 2)
-            layer.paste(mono_rot, (paste_x, paste_y), mono_rot)
-            res = Image.alpha_composite(res, layer)
-
-    # 7.6 --- РАЗМЫТИЕ ЛЕВОЙ КРОМКИ (применяется ко всему итоговому изображению)
-    if thickness > 0 and box_blur_radius > 0 and res.width >= thickness:
-        strip = res.crop((0, 0, thickness, res.height))
-        res.paste(strip.filter(ImageFilter.BoxBlur(box_blur_radius)), (0, 0))
-
-    # 7.7 --- ПАКОВКА
-    png_bytes = _save_png(res)
-    if len(png_bytes) <= TG_PHOTO_LIMIT: return png_bytes
-    for q in (95, 90, 85, 80, 75, 70, 65):
-        jpg_bytes = _save_jpeg(res, q)
-        if len(jpg_bytes) <= TG_PHOTO_LIMIT: return jpg_bytes
-    return _save_jpeg(res, 50)
 
-# ────────────────────────────────────────────────────────────────────
-# ► 8. ХРАНИЛИЩЕ СОСТОЯНИЙ
-# ────────────────────────────────────────────────────────────────────
-user_state: Dict[int, Dict[str, Any]] = {}
+async def _on_render_start(job: RenderJob) -> None:
+    """Задача дождалась своей очереди — обновляем сообщение о статусе."""
+    try: await outbox.edit_message_text(MSG_PROCESSING, job.chat_id, job.status_message_id)
+    except Exception: pass
 
-# ────────────────────────────────────────────────────────────────────
-# ► 9. ХЕНДЛЕРЫ БОТА
-# ────────────────────────────────────────────────────────────────────
-def common_access_check(user_id: int, chat_id: int) -> bool:
-    if user_id not in ALLOWED_USER_IDS:
-        bot.send_message(chat_id, MSG_NO_ACCESS)
-        return False
-    return True
 
-def common_access_check_callback(call) -> bool:
-    if call.from_user.id not in ALLOWED_USER_IDS:
-        bot.answer_callback_query(call.id, MSG_NO_ACCESS, show_alert=True)
-        return False
-    return True
+# Задачи отправки превью, которые еще в пути: финальный результат дожидается своей,
+# чтобы заменить превью. Запись живет только пока идет отправка
+_preview_sends: Dict[RenderJob, "asyncio.Task"] = {}
 
-def get_display_template_name(tpl_file_name: str, persona_name_str: str) -> str:
-    base_name = get_template_name_without_extension(tpl_file_name)
-    prefix_to_remove = f"{persona_name_str}_"
-    display_name = base_name[len(prefix_to_remove):] if base_name.startswith(prefix_to_remove) else base_name
-    display_name = re.sub(r"_[0-9]+$", "", display_name)
-    return display_name.capitalize()
 
-def request_next_photo(chat_id: int, message_id: Optional[int] = None):
-    """Запрашивает следующее фото или запускает обработку, если все собраны."""
-    state = user_state.get(chat_id)
-    if not state or state.get("state") != "waiting_photos":
-        return
+def _forget_previews(chat_id: int) -> None:
+    """Отмена рендера чата: его превью больше ждать некому."""
+    for job in [j for j in _preview_sends if j.chat_id == chat_id]:
+        _preview_sends.pop(job, None)
 
-    required = state.get("required_photos", 0)
-    photos = state.get("photos", [])
-    
-    if len(photos) < required:
-        # Запрашиваем следующее фото
-        msg = MSG_SEND_PHOTO.format(current_num=len(photos) + 1, total_num=required)
-        if message_id:
-            bot.edit_message_text(msg, chat_id, message_id)
-        else:
-            bot.send_message(chat_id, msg)
-    else:
-        # Все фото собраны, запускаем обработку
-        processing_msg = bot.send_message(chat_id, MSG_PROCESSING)
-        
-        try:
-            relative_tpl_path = state["template_file"]
-            tpl_path = os.path.join(templates_dir, relative_tpl_path)
-            
-            template_img = Image.open(tpl_path)
-            user_imgs = [Image.open(io.BytesIO(p_bytes)) for p_bytes in photos]
-            
-            result_bytes = process_template_with_multiple_photos(template_img, user_imgs)
 
-            template_img.close()
-            for img in user_imgs: img.close()
+async def _on_preview(job: RenderJob, preview_bytes: bytes) -> None:
+    """Быстрое превью заменяет сообщение о статусе, пока идет полный рендер."""
+    if job.cancelled or job.future is None or job.future.done():
+        return  # полный результат уже готов — превью не нужно
+    _preview_sends[job] = asyncio.current_task()
+    chat_id = job.chat_id
+    try:
+        msg = await outbox.send_photo(chat_id, preview_bytes, caption=MSG_PREVIEW)
+        job.preview_message_id = msg.message_id
+    except Exception as e:
+        logging.warning(f"Не удалось отправить превью | chat={chat_id}: {e}")
+        return
+    finally:
+        _preview_sends.pop(job, None)
+    outbox.delete_later(chat_id, job.status_message_id)
+
 
-            logging.info(f"Изображение обработано успешно | chat={chat_id} result_size={len(result_bytes)} bytes")
-            kb = InlineKeyboardMarkup().add(InlineKeyboardButton(BTN_REGENERATE, callback_data="start_over"))
+async def _deliver_result(job: RenderJob, result_bytes: bytes, kb: InlineKeyboardMarkup) -> None:
+    """Заменяет превью полным результатом, а если превью нет или замена не удалась — отправляет заново."""
+    chat_id = job.chat_id
+    if job.preview_message_id is not None:
+        if len(result_bytes) <= TG_PHOTO_LIMIT:
+            try:
+                await outbox.edit_message_media(InputMediaPhoto(result_bytes, caption=MSG_DONE),
+                                                chat_id, job.preview_message_id, reply_markup=kb)
+                return
+            except Exception as e:
+                logging.warning(f"Не удалось заменить превью, отправляем отдельно | chat={chat_id}: {e}")
+        outbox.delete_later(chat_id, job.preview_message_id)
+
+    if len(result_bytes) <= TG_PHOTO_LIMIT:
+        await outbox.send_photo(chat_id, result_bytes, caption=MSG_DONE, reply_markup=kb)
+    else:
+        fname = "result" + result_extension(result_bytes)
+        await outbox.send_document(chat_id, (fname, result_bytes), caption=MSG_DONE, reply_markup=kb)
 
-            try: bot.delete_message(chat_id, processing_msg.message_id)
-            except Exception: pass
 
-            if len(result_bytes) <= TG_PHOTO_LIMIT:
-                _safe_send(bot.send_photo, chat_id, result_bytes, caption=MSG_DONE, reply_markup=kb)
-            else:
-                fname = "result.png" if result_bytes.startswith(b'\x89PNG') else "result.jpg"
-                _safe_send(bot.send_document, chat_id, (fname, result_bytes), caption=MSG_DONE, reply_markup=kb)
+async def _on_render_done(job: RenderJob, result_bytes: Optional[bytes], error: Optional[BaseException]) -> None:
+    """Отправляет результат рендера (или сообщение об ошибке) пользователю."""
+    chat_id = job.chat_id
+    preview_send = _preview_sends.pop(job, None)
+    if preview_send is not None:
+        await asyncio.wait({preview_send})
+    if job.preview_message_id is None and job.status_message_id is not None:  # иначе статус заменен превью
+        outbox.delete_later(chat_id, job.status_message_id)
 
-            # Сбрасываем состояние для этого пользователя
-            user_state[chat_id] = {}
+    try:
+        if error is not None:
+            raise error
+
+        _record_job_stats(job)
+        logging.info(
+            f"Изображение обработано успешно | chat={chat_id} result_size={len(result_bytes)} bytes "
+            f"render={job.stats.get('render_total', 0):.2f}s queue={job.stats.get('queue_wait', 0):.2f}s "
+            f"peak_rss={job.stats.get('peak_rss_bytes', 0) // (1024 * 1024)}MB"
+        )
+        kb = _result_keyboard()
+
+        t0 = time.perf_counter()
+        await _deliver_result(job, result_bytes, kb)
+        upload = time.perf_counter() - t0
+        METRICS.observe("tg_upload", upload)
+        METRICS.job_finished("ok")
+        _log_job(job, "cached" if job.stats.get("cached") else "ok", len(result_bytes), upload)
+        # Уменьшенный при нехватке памяти результат не кэшируем: по тому же ключу ждут полный
+        if job.cache_key is not None and job.render_scale >= 1.0:
+            await asyncio.to_thread(results.put, job.cache_key, result_bytes)
+
+        # Фото и монолиты остаются на REGEN_TTL для кнопки «Сгенерировать снова»;
+        # если пользователь уже начал заново, состояние не трогаем
+        sessions.compare_and_set_state(chat_id, "rendering", "done")
 
-        except Exception as e:
-            logging.exception(f"Ошибка при финальной обработке медиа | chat={chat_id}")
-            bot.send_message(chat_id, MSG_ERROR_INTERNAL)
-            kb_error = InlineKeyboardMarkup().add(InlineKeyboardButton("Начать заново", callback_data="start_over"))
-            bot.send_message(chat_id, "Попробуйте начать заново.", reply_markup=kb_error)
+    except Exception as e:
+        logging.exception(f"Ошибка при финальной обработке медиа | chat={chat_id}", exc_info=e)
+        _log_job(job, "error", error=type(e).__name__)
+        if job.preview_message_id is not None:
+            outbox.delete_later(chat_id, job.preview_message_id)
+        METRICS.job_finished("error")
+        await asyncio.to_thread(sessions.reset, chat_id)
+        await outbox.send_message(chat_id, MSG_ERROR_INTERNAL)
+        kb_error = InlineKeyboardMarkup().add(InlineKeyboardButton(BTN_START_OVER, callback_data="start_over"))
+        await outbox.send_message(chat_id, "Попробуйте начать заново.", reply_markup=kb_error)
+
+
+def _engine_callback(coro_func):
+    """Колбэк для движка рендера: запускает корутину в цикле событий бота."""
+    def callback(*args) -> None:
+        future = asyncio.run_coroutine_threadsafe(coro_func(*args), event_loop)
+        future.add_done_callback(_log_callback_error)
+    return callback
+
+
+def _log_callback_error(future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logging.error("Ошибка в колбэке движка рендера", exc_info=future.exception())
+
+
+def _record_job_stats(job: RenderJob) -> None:
+    """Передает замеры воркера в метрики."""
+    METRICS.observe_stages(job.stats.get("stages", {}))
+    for key in ("render_total", "queue_wait", "preview_total"):
+        if key in job.stats:
+            METRICS.observe(key, job.stats[key])
+    for key, name in (("peak_rss_bytes", "job_peak_rss_bytes"), ("job_rss_bytes", "job_actual_mem_bytes"),
+                      ("mem_estimate_bytes", "job_mem_estimate_bytes")):
+        if key in job.stats:
+            METRICS.set_last(name, job.stats[key])
+
+
+def _log_job(job: RenderJob, status: str, result_size: Optional[int] = None,
+             upload: Optional[float] = None, error: Optional[str] = None) -> None:
+    """Запись о задаче в logs/jobs.jsonl: кто, какой шаблон, замеры стадий и размеры."""
+    fields: Dict[str, Any] = {
+        "chat_id": job.chat_id,
+        "template": os.path.relpath(job.tpl_path, templates_dir),
+        "status": status,
+        "seed": job.seed,
+        "photos": len(job.jitter) if job.jitter is not None else None,  # job.photos движок уже очистил
+        "scale": job.render_scale,
+        "result_size": result_size,
+        "stages": {name: round(sec, 3) for name, sec in job.stats.get("stages", {}).items()},
+    }
+    for key in ("queue_wait", "render_total", "preview_total"):
+        if key in job.stats:
+            fields[key] = round(job.stats[key], 3)
+    for key in ("mem_estimate_bytes", "job_rss_bytes", "peak_rss_bytes"):
+        if key in job.stats:
+            fields[key] = job.stats[key]
+    if upload is not None:
+        fields["tg_upload"] = round(upload, 3)
+    if error is not None:
+        fields["error"] = error
+    log_job(**fields)
+
+
+@bot.callback_query_handler(func=lambda c: c.data == "regen")
+async def cb_regenerate(call) -> None:
+    """Новая вариация поворота и сдвига на тех же фото, без повторной загрузки."""
+    if not await common_access_check_callback(call): return
+    chat_id = call.message.chat.id
+    state = sessions.get(chat_id)
+    if state.get("state") == "rendering":
+        await bot.answer_callback_query(call.id, MSG_ALREADY_RENDERING)
+        return
+    if not sessions.compare_and_set_state(chat_id, "done", "rendering"):
+        await bot.answer_callback_query(call.id, MSG_REGEN_EXPIRED, show_alert=True)
+        return
+    await bot.answer_callback_query(call.id)
+    await _submit_render(chat_id, state["template_file"], regen=True)
 
 
 @bot.callback_query_handler(func=lambda c: c.data == "start_over")
-def cb_start_again(call) -> None:
-    if not common_access_check_callback(call): return
-    bot.answer_callback_query(call.id)
-    cmd_start(call.message, from_callback=True)
+async def cb_start_again(call) -> None:
+    if not await common_access_check_callback(call): return
+    await bot.answer_callback_query(call.id)
+    await cmd_start(call.message, from_callback=True)
 
 @bot.message_handler(commands=["start"])
-def cmd_start(msg: Message, from_callback: bool = False) -> None:
-    if not from_callback and not common_access_check(msg.from_user.id, msg.chat.id): return
+async def cmd_start(msg: Message, from_callback: bool = False) -> None:
+    if not from_callback and not await common_access_check(msg.from_user.id, msg.chat.id): return
     chat_id = msg.chat.id
-    user_state[chat_id] = {}
-    personas = get_personas()
-    if not personas:
-        bot.send_message(chat_id, "Персонажи не найдены.")
+    # Начало заново отменяет незавершенный рендер этого чата
+    if render_engine is not None and render_engine.cancel(chat_id):
+        _forget_previews(chat_id)
+        METRICS.inc("jobs_total", "cancelled")
+        await outbox.send_message(chat_id, MSG_RENDER_CANCELLED)
+    await asyncio.to_thread(sessions.reset, chat_id)
+    if not catalog.personas():
+        await outbox.send_message(chat_id, "Персонажи не найдены.")
         return
-    kb = InlineKeyboardMarkup()
-    for p_name in personas: kb.add(InlineKeyboardButton(p_name, callback_data=f"persona_{p_name}"))
-    
+    kb = catalog.persona_keyboard()
+
     if from_callback:
-        try: bot.edit_message_text(MSG_SELECT_PERSONA, chat_id, msg.message_id, reply_markup=kb)
-        except Exception as e: bot.send_message(chat_id, MSG_SELECT_PERSONA, reply_markup=kb)
-    else: bot.send_message(chat_id, MSG_SELECT_PERSONA, reply_markup=kb)
+        try: await outbox.edit_message_text(MSG_SELECT_PERSONA, chat_id, msg.message_id, reply_markup=kb)
+        except Exception: await outbox.send_message(chat_id, MSG_SELECT_PERSONA, reply_markup=kb)
+    else: await outbox.send_message(chat_id, MSG_SELECT_PERSONA, reply_markup=kb)
 
 
-def set_template_and_start_photo_collection(chat_id: int, message_id: int, template_relative_path: str):
+async def set_template_and_start_photo_collection(chat_id: int, message_id: int, template_relative_path: str):
     """
     Анализирует шаблон, обновляет состояние и запрашивает первое фото.
     """
     full_tpl_path = os.path.join(templates_dir, template_relative_path)
     if not os.path.exists(full_tpl_path):
-        bot.edit_message_text(MSG_TEMPLATE_NOT_FOUND, chat_id, message_id)
+        await outbox.edit_message_text(MSG_TEMPLATE_NOT_FOUND, chat_id, message_id)
         return
     
     try:
-        with Image.open(full_tpl_path) as tpl_img:
-            # Анализируем, сколько областей в шаблоне
-            num_areas = len(find_and_sort_green_areas(tpl_img))
+        # Сколько областей в шаблоне: только геометрия (кэшируется), растры бот не строит
+        num_areas = await asyncio.to_thread(count_areas, full_tpl_path)
     except Exception as e:
         logging.error(f"Не удалось проанализировать шаблон {full_tpl_path}: {e}")
-        bot.edit_message_text("Не удалось обработать файл шаблона.", chat_id, message_id)
+        await outbox.edit_message_text("Не удалось обработать файл шаблона.", chat_id, message_id)
         return
 
     if num_areas == 0:
-        bot.edit_message_text("В этом шаблоне не найдено областей для вставки.", chat_id, message_id)
+        await outbox.edit_message_text("В этом шаблоне не найдено областей для вставки.", chat_id, message_id)
         return
 
-    # Обновляем состояние пользователя
-    user_state[chat_id]["template_file"] = template_relative_path
-    user_state[chat_id]["state"] = "waiting_photos" # Новое состояние
-    user_state[chat_id]["required_photos"] = num_areas
-    user_state[chat_id]["photos"] = [] # Список для хранения байтов фото
+    # Обновляем состояние пользователя; ранее присланные фото удаляются
+    state = sessions.get(chat_id)
+    state.update(template_file=template_relative_path, state="waiting_photos",
+                 required_photos=num_areas, photos=[])
+    await asyncio.to_thread(sessions.reset, chat_id, state)
 
     # Запрашиваем первое фото
-    request_next_photo(chat_id, message_id=message_id)
+    await request_next_photo(chat_id, message_id=message_id)
 
 
-def _show_variant_options(chat_id: int, message_id: int, rel_dir: str, variants: Dict[int, str]):
+async def _show_variant_options(chat_id: int, message_id: int, rel_dir: str, base: str):
     """Показывает выбор между вариантами _1/_2, если их несколько."""
-    kb = InlineKeyboardMarkup()
-    for num, fname in sorted(variants.items()):
-        label = f"{num} фото" if num in (1, 2) else str(num)
-        kb.add(InlineKeyboardButton(label, callback_data=f"template_{rel_dir}/{fname}"))
-    bot.edit_message_text(MSG_SELECT_VARIANT, chat_id, message_id, reply_markup=kb)
+    kb = catalog.variants_keyboard(rel_dir, base)
+    await outbox.edit_message_text(MSG_SELECT_VARIANT, chat_id, message_id, reply_markup=kb)
 
 
-def _handle_template_groups(chat_id: int, message_id: int, persona_name: str, stage_val: Optional[str], current_path: str):
+async def _handle_template_groups(chat_id: int, message_id: int, rel_dir: str):
     """Обрабатывает группировку шаблонов и вывод выбора пользователю."""
-    groups = group_templates_by_basename(current_path)
+    groups = catalog.groups(rel_dir)
     if not groups:
-        bot.edit_message_text(MSG_NO_TEMPLATES_FOUND, chat_id, message_id)
+        await outbox.edit_message_text(MSG_NO_TEMPLATES_FOUND, chat_id, message_id)
         return
 
-    rel_dir = os.path.join(persona_name, stage_val) if stage_val else persona_name
-
     if len(groups) == 1:
         base, variants = next(iter(groups.items()))
         if len(variants) == 1:
             file = next(iter(variants.values()))
             template_path = os.path.join(rel_dir, file)
-            set_template_and_start_photo_collection(chat_id, message_id, template_path)
+            await set_template_and_start_photo_collection(chat_id, message_id, template_path)
         else:
-            _show_variant_options(chat_id, message_id, rel_dir, variants)
+            await _show_variant_options(chat_id, message_id, rel_dir, base)
     else:
-        kb = InlineKeyboardMarkup()
-        for base, variants in sorted(groups.items()):
-            display_name = get_display_template_name(list(variants.values())[0], persona_name)
-            kb.add(InlineKeyboardButton(display_name, callback_data=f"tplgrp_{rel_dir}/{base}"))
-        bot.edit_message_text(MSG_SELECT_TEMPLATE, chat_id, message_id, reply_markup=kb)
+        kb = catalog.groups_keyboard(rel_dir)
+        await outbox.edit_message_text(MSG_SELECT_TEMPLATE, chat_id, message_id, reply_markup=kb)
 
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith("persona_"))
-def cb_persona(call) -> None:
-    if not common_access_check_callback(call): return
+async def cb_persona(call) -> None:
+    if not await common_access_check_callback(call): return
     chat_id = call.message.chat.id
     persona_name = call.data.split("_", 1)[1]
-    user_state[chat_id] = {"persona": persona_name}
-    bot.answer_callback_query(call.id)
-    # ... (логика выбора этапа или шаблона) ...
-    # Эта часть остается похожей, но в конце вызывает set_template_and_start_photo_collection
-    persona_path = os.path.join(templates_dir, persona_name)
-    stages = get_stages_for_persona(persona_name)
-
-    if stages:
-        kb = InlineKeyboardMarkup()
-        for stage_val, stage_label in stages:
-            kb.add(InlineKeyboardButton(stage_label, callback_data=f"stage_{stage_val}"))
-        bot.edit_message_text(MSG_SELECT_STAGE, chat_id, call.message.message_id, reply_markup=kb)
+    await asyncio.to_thread(sessions.reset, chat_id, {"persona": persona_name})
+    await bot.answer_callback_query(call.id)
+    kb = catalog.stage_keyboard(persona_name)
+    if kb is not None:
+        await outbox.edit_message_text(MSG_SELECT_STAGE, chat_id, call.message.message_id, reply_markup=kb)
     else:  # Нет этапов, сразу шаблоны
-        _handle_template_groups(chat_id, call.message.message_id, persona_name, None, persona_path)
+        await _handle_template_groups(chat_id, call.message.message_id, persona_name)
 
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith("stage_"))
-def cb_stage(call) -> None:
-    if not common_access_check_callback(call): return
+async def cb_stage(call) -> None:
+    if not await common_access_check_callback(call): return
     chat_id = call.message.chat.id
     stage_val = call.data.split("_", 1)[1]
-    if "persona" not in user_state.get(chat_id, {}):
-        cmd_start(call.message, from_callback=True); return
-    user_state[chat_id]["stage"] = stage_val
-    bot.answer_callback_query(call.id)
-    persona_name = user_state[chat_id]["persona"]
-    current_path = os.path.join(templates_dir, persona_name, stage_val)
-    _handle_template_groups(chat_id, call.message.message_id, persona_name, stage_val, current_path)
+    if "persona" not in sessions.get(chat_id):
+        await cmd_start(call.message, from_callback=True); return
+    persona_name = sessions.update(chat_id, stage=stage_val)["persona"]
+    await bot.answer_callback_query(call.id)
+    await _handle_template_groups(chat_id, call.message.message_id, f"{persona_name}/{stage_val}")
 
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith("tplgrp_"))
-def cb_template_group(call) -> None:
-    if not common_access_check_callback(call):
+async def cb_template_group(call) -> None:
+    if not await common_access_check_callback(call):
         return
     chat_id = call.message.chat.id
     data = call.data.split("_", 1)[1]
     parts = data.split("/")
     base = parts[-1]
     rel_dir = "/".join(parts[:-1])
-    persona_name = user_state.get(chat_id, {}).get("persona")
-    if not persona_name:
-        cmd_start(call.message, from_callback=True)
+    if "persona" not in sessions.get(chat_id):
+        await cmd_start(call.message, from_callback=True)
         return
-    stage_val = user_state.get(chat_id, {}).get("stage") if len(parts) > 2 else None
-    current_path = os.path.join(templates_dir, rel_dir)
-    groups = group_templates_by_basename(current_path)
-    variants = groups.get(base)
-    bot.answer_callback_query(call.id)
+    variants = catalog.groups(rel_dir).get(base)
+    await bot.answer_callback_query(call.id)
     if not variants:
-        bot.edit_message_text(MSG_TEMPLATE_NOT_FOUND, chat_id, call.message.message_id)
+        await outbox.edit_message_text(MSG_TEMPLATE_NOT_FOUND, chat_id, call.message.message_id)
         return
     if len(variants) == 1:
         file = next(iter(variants.values()))
         template_path = os.path.join(rel_dir, file)
-        set_template_and_start_photo_collection(chat_id, call.message.message_id, template_path)
+        await set_template_and_start_photo_collection(chat_id, call.message.message_id, template_path)
     else:
-        _show_variant_options(chat_id, call.message.message_id, rel_dir, variants)
+        await _show_variant_options(chat_id, call.message.message_id, rel_dir, base)
 
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith("template_"))
-def cb_template_selection(call) -> None:
-    if not common_access_check_callback(call): return
+async def cb_template_selection(call) -> None:
+    if not await common_access_check_callback(call): return
     chat_id = call.message.chat.id
     template_relative_path = call.data.split("_", 1)[1]
-    if "persona" not in user_state.get(chat_id, {}):
-        cmd_start(call.message, from_callback=True); return
-    bot.answer_callback_query(call.id)
-    set_template_and_start_photo_collection(chat_id, call.message.message_id, template_relative_path)
+    if "persona" not in sessions.get(chat_id):
+        await cmd_start(call.message, from_callback=True); return
+    await bot.answer_callback_query(call.id)
+    await set_template_and_start_photo_collection(chat_id, call.message.message_id, template_relative_path)
+
+
+async def _fetch_photo(msg: Message, tpl_path: str) -> Optional[bytes]:
+    """
+    Скачивает фото из сообщения и готовит его под шаблон (см. prepare_photo).
+    None — в сообщении не изображение; пользователю уже ответили.
+    """
+    chat_id = msg.chat.id
+    if msg.content_type == "photo":
+        file_id = msg.photo[-1].file_id
+    elif msg.document and msg.document.mime_type and msg.document.mime_type.startswith("image/"):
+        file_id = msg.document.file_id
+    else:
+        await outbox.reply_to(msg, "Пожалуйста, отправьте изображение.")
+        return None
+
+    t0 = time.perf_counter()
+    file_info = await with_retries(bot.get_file, file_id)
+    downloaded_file_bytes = await with_retries(bot.download_file, file_info.file_path)
+    METRICS.observe("tg_download", time.perf_counter() - t0)
+
+    # Декодируем сразу в размере, нужном шаблону; оригинал в памяти не держим
+    t0 = time.perf_counter()
+    try:
+        prepared = await asyncio.to_thread(prepare_photo, downloaded_file_bytes, tpl_path)
+    except (UnidentifiedImageError, Image.DecompressionBombError) as e:
+        logging.warning(f"Не удалось декодировать фото | chat={chat_id}: {e}")
+        await outbox.reply_to(msg, "Пожалуйста, отправьте изображение.")
+        return None
+    METRICS.observe("photo_prepare", time.perf_counter() - t0)
+    return prepared
+
+
+class _Album:
+    """Фото одного альбома (media group), собираемые до отправки в сессию."""
+    __slots__ = ("items", "pending", "timer")
+
+    def __init__(self):
+        self.items: Dict[int, bytes] = {}  # message_id -> подготовленное фото
+        self.pending = 0                   # скачиваний в процессе
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+# Альбомы в сборке по (chat_id, media_group_id). Живут только в цикле событий
+# бота, поэтому блокировки не нужны
+_albums: Dict[Tuple[int, str], _Album] = {}
+# Альбомы, на которые уже ответили «Сначала /start» (отвечаем один раз, а не на каждое фото)
+_albums_rejected: Set[Tuple[int, str]] = set()
+# Ссылки на задачи, запущенные по таймеру, чтобы их не снял сборщик мусора
+_album_tasks: Set[asyncio.Task] = set()
+
+
+def _schedule_flush(key: Tuple[int, str]) -> None:
+    task = asyncio.ensure_future(_flush_album(key))
+    _album_tasks.add(task)
+    task.add_done_callback(_album_tasks.discard)
+
+
+async def _handle_album_item(msg: Message, state: Dict[str, Any]) -> None:
+    """
+    Элемент альбома: Telegram присылает каждое фото отдельным сообщением,
+    их хендлеры работают параллельно, поэтому все файлы качаются одновременно.
+    Альбом уходит в сессию, как только готово столько фото, сколько не хватает
+    шаблону, или через ALBUM_DEBOUNCE секунд после последнего элемента.
+    """
+    chat_id = msg.chat.id
+    key = (chat_id, msg.media_group_id)
+    album = _albums.setdefault(key, _Album())
+    if album.timer is not None:
+        album.timer.cancel()
+        album.timer = None
+    album.pending += 1
+    try:
+        prepared = await _fetch_photo(msg, os.path.join(templates_dir, state["template_file"]))
+    finally:
+        album.pending -= 1
+    if prepared is not None:
+        album.items[msg.message_id] = prepared
+
+    if _albums.get(key) is not album:
+        return  # альбом уже отправлен, этот элемент лишний
+    missing = state.get("required_photos", 0) - len(sessions.get(chat_id).get("photos", []))
+    if album.pending == 0 and len(album.items) >= missing:
+        await _flush_album(key)
+    elif album.pending == 0:
+        album.timer = event_loop.call_later(ALBUM_DEBOUNCE, _schedule_flush, key)
+
+
+async def _flush_album(key: Tuple[int, str]) -> None:
+    """Сохраняет фото альбома в сессию в порядке сообщений и двигает сценарий дальше."""
+    album = _albums.pop(key, None)
+    if album is None:
+        return
+    if album.timer is not None:
+        album.timer.cancel()
+    chat_id = key[0]
+    try:
+        state = sessions.get(chat_id)
+        if state.get("state") != "waiting_photos":
+            return
+        missing = state.get("required_photos", 0) - len(state.get("photos", []))
+        ordered = sorted(album.items.items())
+        for message_id, prepared in ordered[:max(0, missing)]:
+            await asyncio.to_thread(sessions.add_photo, chat_id, prepared, ".tif")
+        logging.debug(f"Альбом: принято {min(len(ordered), missing)} фото из {len(ordered)} | chat={chat_id}")
+        if len(ordered) > missing:
+            await outbox.send_message(chat_id, MSG_ALBUM_EXTRA.format(count=len(ordered) - missing))
+
+        for message_id, _ in ordered:
+            outbox.delete_later(chat_id, message_id)
+        await request_next_photo(chat_id)
+    except Exception:
+        logging.exception(f"Ошибка при обработке альбома | chat={chat_id}")
+        await outbox.send_message(chat_id, MSG_ERROR_INTERNAL)
 
 
 @bot.message_handler(content_types=["photo", "document"])
-def handle_media(msg: Message) -> None:
+async def handle_media(msg: Message) -> None:
     chat_id = msg.chat.id
-    if not common_access_check(msg.from_user.id, chat_id): return
+    if not await common_access_check(msg.from_user.id, chat_id): return
 
-    state = user_state.get(chat_id, {})
+    state = sessions.get(chat_id)
     if state.get("state") != "waiting_photos":
-        bot.send_message(chat_id, MSG_START_FIRST)
+        if msg.media_group_id:
+            key = (chat_id, msg.media_group_id)
+            if key in _albums_rejected:
+                return
+            _albums_rejected.add(key)
+            event_loop.call_later(ALBUM_DEBOUNCE, _albums_rejected.discard, key)
+        await outbox.send_message(chat_id, MSG_START_FIRST)
         return
 
     try:
-        if msg.content_type == "photo":
-            file_id = msg.photo[-1].file_id
-        elif msg.document and msg.document.mime_type and msg.document.mime_type.startswith("image/"):
-            file_id = msg.document.file_id
-        else:
-            bot.reply_to(msg, "Пожалуйста, отправьте изображение.")
+        if msg.media_group_id:
+            await _handle_album_item(msg, state)
             return
 
-        file_info = bot.get_file(file_id)
-        downloaded_file_bytes = bot.download_file(file_info.file_path)
-
-        # Добавляем байты фото в состояние
-        user_state[chat_id]["photos"].append(downloaded_file_bytes)
-        logging.debug(f"Фото {len(user_state[chat_id]['photos'])}/{user_state[chat_id]['required_photos']} получено | chat={chat_id}")
+        prepared = await _fetch_photo(msg, os.path.join(templates_dir, state["template_file"]))
+        if prepared is None:
+            return
+        count = await asyncio.to_thread(sessions.add_photo, chat_id, prepared, ".tif")
+        logging.debug(f"Фото {count}/{state['required_photos']} получено | chat={chat_id}")
         
         # Удаляем сообщение с просьбой прислать фото
-        try: bot.delete_message(chat_id, msg.message_id)
-        except Exception: pass
+        outbox.delete_later(chat_id, msg.message_id)
         
         # Запрашиваем следующее фото или запускаем обработку
-        request_next_photo(chat_id)
+        await request_next_photo(chat_id)
 
-    except Exception as e:
+    except Exception:
         logging.exception(f"Ошибка при обработке медиа | chat={chat_id}")
-        bot.send_message(chat_id, MSG_ERROR_INTERNAL)
+        await outbox.send_message(chat_id, MSG_ERROR_INTERNAL)
+
+
+@bot.message_handler(commands=["stats"])
+async def cmd_stats(msg: Message) -> None:
+    """Сводка метрик рендера; только для ADMIN_USER_IDS."""
+    if msg.from_user.id not in ADMIN_USER_IDS:
+        await outbox.send_message(msg.chat.id, MSG_NO_ACCESS)
+        return
+    await outbox.send_message(msg.chat.id, METRICS.format_stats(), parse_mode="HTML")
 
 # ────────────────────────────────────────────────────────────────────
-# ► 10. ТОЧКА ВХОДА
+# ► 7. ТОЧКА ВХОДА
 # ────────────────────────────────────────────────────────────────────
+async def _prewarm(templates: List[str]) -> None:
+    """
+    Прогрев при старте: воркеры компилируют шаблоны в своих инициализаторах
+    параллельно, по процессу на ядро. Готовность выставляется, когда
+    прогреты все воркеры. Сам бот шаблоны не прогревает: ему нужна только
+    геометрия областей, а растры в его кэше лишь заняли бы память.
+    """
+    t0 = time.perf_counter()
+    try:
+        while not await asyncio.to_thread(render_engine.wait_ready, PREWARM_LOG_EVERY):
+            logging.warning(f"Воркеры рендера еще не прогреты за {time.perf_counter() - t0:.0f} с")
+    except Exception:
+        # Без прогрева бот работает, но /readyz так и не ответит 200 — это видно снаружи
+        logging.exception("Прогрев не удался")
+        return
+    seconds = time.perf_counter() - t0
+    warm = render_engine.warm_templates()
+    logging.info(f"Прогрев завершен за {seconds:.1f} с: шаблонов {len(templates)}, "
+                 f"прогрето во всех воркерах {warm}")
+    HEALTH.set_ready(prewarm={"templates": len(templates), "warm": warm, "seconds": round(seconds, 1)})
+
+
+def _render_health() -> Optional[str]:
+    if render_engine.is_broken():
+        return "пул процессов сломан"
+    age = render_engine.oldest_running_age()
+    if age > HEALTH_JOB_STALE:
+        return f"задача в работе {age:.0f} с"
+    return None
+
+
+def _track_polling() -> None:
+    """Отметка heartbeat на каждый ответ getUpdates: зависший long poll перестанет ее ставить."""
+    get_updates = bot.get_updates
+
+    async def get_updates_with_heartbeat(*args, **kwargs):
+        updates = await get_updates(*args, **kwargs)
+        HEALTH.beat("polling")
+        return updates
+
+    HEALTH.expect("polling", HEALTH_POLL_STALE)
+    bot.get_updates = get_updates_with_heartbeat
+
+
+async def main() -> None:
+    global sessions, catalog, render_engine, results, event_loop
+    event_loop = asyncio.get_running_loop()
+    outbox.start()
+    METRICS.register_gauge("tg_outbox_depth", outbox.depth)
+    sessions = SessionStore()
+    catalog = Catalog(templates_dir, STAGE_NAME_MAP)
+    catalog.start_watcher()
+    results = ResultCache()
+    METRICS.register_gauge("result_cache_bytes", results.size_bytes)
+    templates = find_templates(templates_dir) if PREWARM_TEMPLATES else []
+    if RENDER_MODE == "queue":
+        # Рендерят отдельные процессы worker.py; прогреваются тоже они
+        render_engine = QueueEngine(on_done=_engine_callback(_on_render_done),
+                                    on_start=_engine_callback(_on_render_start),
+                                    on_preview=_engine_callback(_on_preview))
+    else:
+        render_engine = RenderEngine(on_done=_engine_callback(_on_render_done),
+                                     on_start=_engine_callback(_on_render_start),
+                                     on_preview=_engine_callback(_on_preview),
+                                     prewarm=templates, log_queue=worker_log_queue())
+    logging.info(f"Движок рендера ({RENDER_MODE}): workers={render_engine.workers} "
+                 f"max_jobs={render_engine.max_jobs} memory_budget={render_engine.memory_budget >> 20}MB")
+    # Задачи пула процессов не переживают рестарт — такие сессии начинаются заново;
+    # задачи общей очереди доделают воркеры, их сессии остаются
+    lost = await asyncio.to_thread(sessions.reset_state, "rendering", keep=set(render_engine.chat_ids()))
+    if lost:
+        logging.warning(f"Сброшено сессий с прерванным рендером: {lost}")
+    sessions.start_sweeper()
+    METRICS.register_gauge("render_queue_depth", render_engine.queue_depth)
+    METRICS.register_gauge("render_running", render_engine.running_count)
+    METRICS.register_gauge("render_memory_reserved_bytes", render_engine.memory_reserved)
+    METRICS.register_gauge("log_records_dropped", dropped_records)
+    try:
+        start_metrics_server()
+    except OSError as e:
+        logging.error(f"Не удалось запустить HTTP-сервер метрик: {e}")
+    # Бот принимает обновления сразу, прогрев идет параллельно; /readyz — после него
+    HEALTH.add_check("render", _render_health)
+    background = [asyncio.create_task(HEALTH.run_loop_heartbeat()), asyncio.create_task(_prewarm(templates))]
+    try:
+        if webhook.BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            _track_polling()
+            await bot.remove_webhook()
+            await bot.infinity_polling(skip_pending=True)
+    finally:
+        for task in background:
+            task.cancel()
+        render_engine.shutdown()
+        await outbox.stop()
+        await bot.close_session()
+
+
+async def run_webhook() -> None:
+    """Режим вебхука: обновления принимает встроенный HTTP-сервер."""
+    secret = webhook.resolve_secret()
+    app = webhook.make_webhook_app(lambda update: bot.process_new_updates([update]), secret)
+    runner = await webhook.start_webhook_server(app)
+    try:
+        if webhook.WEBHOOK_URL:
+            await bot.set_webhook(url=webhook.WEBHOOK_URL.rstrip("/") + webhook.WEBHOOK_PATH,
+                                  secret_token=secret,
+                                  drop_pending_updates=True)
+            logging.info(f"Вебхук зарегистрирован: {webhook.WEBHOOK_URL}{webhook.WEBHOOK_PATH}")
+        else:
+            logging.info("WEBHOOK_URL не задан — вебхук не регистрируется (локальный режим)")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
 if __name__ == "__main__":
     if not BOT_TOKEN:
         print("Переменная окружения BOT_TOKEN не установлена.")
     else:
         logging.info("Запуск бота...")
         try:
-            bot.remove_webhook()
-            bot.infinity_polling(skip_pending=True)
-        except Exception as e:
+            asyncio.run(main())
+        except Exception:
             logging.exception("Неожиданная ошибка в главном цикле бота")
+            stop_logging()
             sys.exit(1)
+        stop_logging()
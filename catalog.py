@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Каталог шаблонов в памяти: персонаж → этап → группа → варианты.
+
+Дерево templates/ читается при старте и затем обновляется обходом mtime
+каталогов: перечитываются только изменившиеся папки. Клавиатуры для всех
+уровней навигации строятся заранее, поэтому колбэки кнопок — это чтение
+из словарей, без обращений к диску.
+"""
+
+# ────────────────────────────────────────────────────────────────────
+# ► 0. ИМПОРТЫ
+# ────────────────────────────────────────────────────────────────────
+import os, re, time, logging, threading
+from typing import Dict, List, Optional, Tuple
+
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from render import templates_dir, VALID_IMAGE_EXTENSIONS
+
+# ────────────────────────────────────────────────────────────────────
+# ► 1. КОНСТАНТЫ
+# ────────────────────────────────────────────────────────────────────
+CATALOG_REFRESH    = int(os.getenv("CATALOG_REFRESH", 30))  # секунд между проверками mtime
+
+# ────────────────────────────────────────────────────────────────────
+# ► 2. ГРУППИРОВКА И ПОДПИСИ
+# ────────────────────────────────────────────────────────────────────
+def get_template_name_without_extension(filename: str) -> str:
+    return os.path.splitext(filename)[0]
+
+
+def group_templates_by_basename(files: List[str]) -> Dict[str, Dict[int, str]]:
+    """\
+    Возвращает словарь групп шаблонов вида {basename: {number: filename}}.
+
+    basename -- имя файла без суффикса _1/_2 и расширения. number -- 1, 2, ...
+    """
+    groups: Dict[str, Dict[int, str]] = {}
+    for fname in files:
+        base = get_template_name_without_extension(fname)
+        if base.endswith("_1") or base.endswith("_2"):
+            key = base[:-2]
+            try:
+                num = int(base[-1])
+            except ValueError:
+                num = 1
+        else:
+            key = base
+            num = 1
+        groups.setdefault(key, {})[num] = fname
+    return groups
+
+
+def get_display_template_name(tpl_file_name: str, persona_name_str: str) -> str:
+    base_name = get_template_name_without_extension(tpl_file_name)
+    prefix_to_remove = f"{persona_name_str}_"
+    display_name = base_name[len(prefix_to_remove):] if base_name.startswith(prefix_to_remove) else base_name
+    display_name = re.sub(r"_[0-9]+$", "", display_name)
+    return display_name.capitalize()
+
+# ────────────────────────────────────────────────────────────────────
+# ► 3. КАТАЛОГ
+# ────────────────────────────────────────────────────────────────────
+class _DirNode:
+    """Содержимое одной папки на момент mtime_ns."""
+    __slots__ = ("mtime_ns", "subdirs", "files")
+
+    def __init__(self, mtime_ns: int, subdirs: List[str], files: List[str]):
+        self.mtime_ns = mtime_ns
+        self.subdirs = subdirs
+        self.files = files
+
+
+class _Views:
+    """Неизменяемый снимок каталога с готовыми клавиатурами."""
+
+    def __init__(self):
+        self.personas: List[str] = []
+        self.persona_kb = InlineKeyboardMarkup()
+        self.stages: Dict[str, List[Tuple[str, str]]] = {}
+        self.stage_kb: Dict[str, InlineKeyboardMarkup] = {}
+        self.groups: Dict[str, Dict[str, Dict[int, str]]] = {}
+        self.groups_kb: Dict[str, InlineKeyboardMarkup] = {}
+        self.variants_kb: Dict[Tuple[str, str], InlineKeyboardMarkup] = {}
+
+
+class Catalog:
+    """
+    Дерево шаблонов в памяти. Снимок (_Views) заменяется целиком одной
+    операцией присваивания, поэтому читатели не берут блокировок.
+    """
+
+    def __init__(self, root: str = templates_dir, stage_names: Optional[Dict[str, str]] = None):
+        self.root = root
+        self.stage_names = stage_names or {}
+        self._nodes: Dict[str, _DirNode] = {}
+        self._views = _Views()
+        self._refresh_lock = threading.Lock()
+        self._watcher: Optional[threading.Thread] = None
+        self.refresh()
+
+    # ── Чтение ─────────────────────────────────────────────────────
+    def personas(self) -> List[str]:
+        return self._views.personas
+
+    def persona_keyboard(self) -> InlineKeyboardMarkup:
+        return self._views.persona_kb
+
+    def stages(self, persona: str) -> List[Tuple[str, str]]:
+        return self._views.stages.get(persona, [])
+
+    def stage_keyboard(self, persona: str) -> Optional[InlineKeyboardMarkup]:
+        return self._views.stage_kb.get(persona)
+
+    def groups(self, rel_dir: str) -> Dict[str, Dict[int, str]]:
+        return self._views.groups.get(rel_dir, {})
+
+    def groups_keyboard(self, rel_dir: str) -> Optional[InlineKeyboardMarkup]:
+        return self._views.groups_kb.get(rel_dir)
+
+    def variants_keyboard(self, rel_dir: str, base: str) -> Optional[InlineKeyboardMarkup]:
+        return self._views.variants_kb.get((rel_dir, base))
+
+    # ── Обновление ─────────────────────────────────────────────────
+    def _scan(self, rel_dir: str, nodes: Dict[str, _DirNode]) -> Optional[_DirNode]:
+        """Узел папки: из прошлого снимка, если mtime не изменился, иначе перечитанный."""
+        path = os.path.join(self.root, rel_dir) if rel_dir else self.root
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        node = self._nodes.get(rel_dir)
+        if node is None or node.mtime_ns != mtime_ns:
+            subdirs, files = [], []
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        subdirs.append(entry.name)
+                    elif entry.is_file() and entry.name.lower().endswith(VALID_IMAGE_EXTENSIONS):
+                        files.append(entry.name)
+            node = _DirNode(mtime_ns, sorted(subdirs), sorted(files))
+        nodes[rel_dir] = node
+        return node
+
+    def refresh(self) -> bool:
+        """Сверяет mtime папок и перестраивает снимок, если что-то изменилось."""
+        with self._refresh_lock:
+            nodes: Dict[str, _DirNode] = {}
+            root = self._scan("", nodes)
+            if root is None:
+                logging.error(f"Папка шаблонов '{self.root}' не найдена.")
+            else:
+                for persona in root.subdirs:
+                    node = self._scan(persona, nodes)
+                    for stage in (node.subdirs if node else []):
+                        if stage.isdigit():
+                            self._scan(f"{persona}/{stage}", nodes)
+
+            changed = nodes.keys() != self._nodes.keys() or any(
+                nodes[k] is not self._nodes[k] for k in nodes)
+            if not changed and self._nodes:
+                return False
+            self._nodes = nodes
+            self._views = self._build_views(nodes)
+            logging.info(f"Каталог шаблонов обновлен: персонажей {len(self._views.personas)}, "
+                         f"папок с шаблонами {len(self._views.groups)}")
+            return True
+
+    def _build_views(self, nodes: Dict[str, _DirNode]) -> _Views:
+        views = _Views()
+        root = nodes.get("")
+        views.personas = list(root.subdirs) if root else []
+        for p_name in views.personas:
+            views.persona_kb.add(InlineKeyboardButton(p_name, callback_data=f"persona_{p_name}"))
+
+        for persona in views.personas:
+            node = nodes.get(persona)
+            if node is None:
+                continue
+            stages = sorted(
+                ((s, self.stage_names.get(s, f"Этап {s}")) for s in node.subdirs if s.isdigit()),
+                key=lambda x: int(x[0])
+            )
+            views.stages[persona] = stages
+            if stages:
+                kb = InlineKeyboardMarkup()
+                for stage_val, stage_label in stages:
+                    kb.add(InlineKeyboardButton(stage_label, callback_data=f"stage_{stage_val}"))
+                views.stage_kb[persona] = kb
+
+            dirs = [(persona, node)] + [(f"{persona}/{s}", nodes[f"{persona}/{s}"])
+                                        for s, _ in stages if f"{persona}/{s}" in nodes]
+            for rel_dir, dir_node in dirs:
+                groups = group_templates_by_basename(dir_node.files)
+                if not groups:
+                    continue
+                views.groups[rel_dir] = groups
+                kb = InlineKeyboardMarkup()
+                for base, variants in sorted(groups.items()):
+                    display_name = get_display_template_name(list(variants.values())[0], persona)
+                    kb.add(InlineKeyboardButton(display_name, callback_data=f"tplgrp_{rel_dir}/{base}"))
+                views.groups_kb[rel_dir] = kb
+                for base, variants in groups.items():
+                    kb = InlineKeyboardMarkup()
+                    for num, fname in sorted(variants.items()):
+                        label = f"{num} фото" if num in (1, 2) else str(num)
+                        kb.add(InlineKeyboardButton(label, callback_data=f"template_{rel_dir}/{fname}"))
+                    views.variants_kb[(rel_dir, base)] = kb
+        return views
+
+    def start_watcher(self, interval: int = CATALOG_REFRESH) -> None:
+        """Фоновый поток, раз в interval секунд проверяющий изменения на диске."""
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh()
+                except Exception:
+                    logging.exception("Ошибка обновления каталога шаблонов")
+
+        self._watcher = threading.Thread(target=loop, name="catalog-watcher", daemon=True)
+        self._watcher.start()
@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Движок рендера: пул процессов, ограниченная очередь задач и доставка результатов.
+
+Хендлеры бота только ставят задачу в очередь и сразу возвращаются;
+результат передается в колбэк, когда воркер закончит.
+"""
+
+# ────────────────────────────────────────────────────────────────────
+# ► 0. ИМПОРТЫ
+# ────────────────────────────────────────────────────────────────────
+import os, time, logging, threading, multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Set, Union
+
+import render
+import logsetup
+
+# ────────────────────────────────────────────────────────────────────
+# ► 1. КОНСТАНТЫ
+# ────────────────────────────────────────────────────────────────────
+RENDER_WORKERS     = int(os.getenv("RENDER_WORKERS", os.cpu_count() or 1))
+RENDER_QUEUE_SIZE  = int(os.getenv("RENDER_QUEUE_SIZE", 20))  # задач в очереди и в работе
+DELIVERY_THREADS   = 4
+# Бюджет памяти рендера в МБ на все воркеры; 0 — доля лимита контейнера (или ОЗУ)
+RENDER_MEMORY_BUDGET   = int(os.getenv("RENDER_MEMORY_BUDGET", 0)) * 1024 * 1024
+MEMORY_BUDGET_FRACTION = 0.6
+CGROUP_MEMORY_LIMITS   = ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes")
+READY_PROBE_HOLD   = 0.05  # секунд держит воркер пробу готовности, чтобы пробы разошлись по всем воркерам
+
+
+def default_memory_budget() -> int:
+    """Доля лимита памяти cgroup (v2 или v1), а без лимита — доля физической памяти."""
+    total = 0
+    for path in CGROUP_MEMORY_LIMITS:
+        try:
+            with open(path, encoding="ascii") as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # «max» в v2 и огромное число в v1 означают отсутствие лимита
+        if value.isdigit() and int(value) < 1 << 60:
+            total = int(value)
+            break
+    if not total:
+        try:
+            total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        except (ValueError, OSError, AttributeError):
+            total = 4 * 1024 ** 3
+    return int(total * MEMORY_BUDGET_FRACTION)
+
+# ────────────────────────────────────────────────────────────────────
+# ► 2. ЗАДАЧА И ОШИБКИ ОЧЕРЕДИ
+# ────────────────────────────────────────────────────────────────────
+class QueueFullError(Exception):
+    """Очередь рендера заполнена — новую задачу принять нельзя."""
+
+
+class ChatBusyError(Exception):
+    """У чата уже есть задача в очереди или в работе."""
+
+
+class RenderJob:
+    """Задача рендера одного чата и ее служебное состояние."""
+    __slots__ = ("chat_id", "tpl_path", "photos", "status_message_id", "mono_dir", "seed", "jitter", "cache_key",
+                 "preview_size", "preview_message_id", "mem_estimate", "render_scale", "cancelled", "future", "submitted_at",
+                 "started_at", "stats")
+
+    def __init__(self, chat_id: int, tpl_path: str, photos: List[Union[bytes, str]],
+                 status_message_id: Optional[int] = None, mono_dir: Optional[str] = None,
+                 seed: Optional[int] = None, preview_size: int = 0, cache_key: Optional[str] = None):
+        self.chat_id = chat_id
+        self.tpl_path = tpl_path
+        self.photos = photos
+        self.status_message_id = status_message_id
+        # Каталог кэша монолитов (см. render.render_job); None — без кэша
+        self.mono_dir = mono_dir
+        # Поворот и сдвиг областей выбираются по сиду заранее и общие для превью
+        # и полного рендера; без сида превью не строится, jitter выбирает воркер
+        self.seed = seed
+        self.jitter = None if seed is None else render.draw_jitter(len(photos), seed)
+        # Ключ в кэше результатов (см. result_cache.py); None — не кэшировать
+        self.cache_key = cache_key
+        # Длинная сторона превью; 0 — без превью. Превью считается первым
+        # в том же слоте пула, затем сразу запускается полный рендер
+        self.preview_size = preview_size
+        self.preview_message_id: Optional[int] = None  # заполняет получатель превью
+        # Оценка пика памяти (см. render.estimate_job_memory) и масштаб результата;
+        # масштаб меньше 1, если задача не помещается в бюджет памяти целиком
+        self.mem_estimate = 0
+        self.render_scale = 1.0
+        self.cancelled = False
+        self.future: Optional[Future] = None
+        self.submitted_at = 0.0
+        self.started_at = 0.0
+        # Замеры воркера (см. render.render_job_with_stats) и ожидание в очереди
+        self.stats: Dict[str, Any] = {}
+
+
+# ────────────────────────────────────────────────────────────────────
+# ► 3. ДВИЖОК
+# ────────────────────────────────────────────────────────────────────
+def _worker_init(prewarm: Sequence[str] = (), log_queue: Optional[Any] = None) -> None:
+    if log_queue is not None:
+        # Записи воркера пишет поток основного процесса — в те же файлы
+        logsetup.setup_worker_logging(log_queue)
+    else:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [render] %(message)s")
+    try:
+        render.preload_filter()
+    except Exception:
+        logging.exception("Не удалось загрузить фильтр при старте воркера")
+    if prewarm:
+        report = render.prewarm_templates(list(prewarm))
+        logging.info(f"Воркер прогрет: шаблонов {len(report['templates'])}, ошибок {report['failed']}, "
+                     f"не прогрето (бюджет кэша) {report['skipped']} за {report['seconds']:.1f} с")
+
+
+def _ready_probe() -> Any:
+    """Проба из пула: выполняется только после инициализатора, то есть прогрева воркера."""
+    time.sleep(READY_PROBE_HOLD)
+    return render.cached_templates()
+
+
+class RenderEngine:
+    """
+    Очередь задач поверх ProcessPoolExecutor.
+
+    В пул одновременно отдается не больше workers задач, остальные ждут
+    в собственной очереди — так можно сообщать позицию и отменять задачи,
+    которые еще не начались. На каждый чат допускается одна задача.
+
+    Перед запуском задача резервирует оценку своей памяти из общего бюджета.
+    Если остатка не хватает, очередь ждет (порядок сохраняется); задача
+    больше всего бюджета рендерится в уменьшенном масштабе, а если не
+    влезает и так — запускается, когда пул пуст, и до ее конца другие ждут.
+    """
+
+    def __init__(self,
+                 on_done: Callable[[RenderJob, Optional[bytes], Optional[BaseException]], None],
+                 on_start: Optional[Callable[[RenderJob], None]] = None,
+                 workers: int = RENDER_WORKERS, max_jobs: int = RENDER_QUEUE_SIZE,
+                 on_preview: Optional[Callable[[RenderJob, bytes], None]] = None,
+                 memory_budget: int = RENDER_MEMORY_BUDGET, prewarm: Sequence[str] = (),
+                 log_queue: Optional[Any] = None):
+        self.on_done = on_done
+        self.on_start = on_start
+        self.on_preview = on_preview
+        self.workers = max(1, workers)
+        self.max_jobs = max(1, max_jobs)
+        self._pending: Deque[RenderJob] = deque()
+        self._running: Dict[int, RenderJob] = {}
+        self._busy = 0  # задач в пуле, включая отмененные, но еще не завершенные
+        self.memory_budget = memory_budget or default_memory_budget()
+        self._reserved = 0  # сумма оценок памяти задач в пуле
+        # Воркеры и какие шаблоны (абсолютные пути) у них скомпилированы: без компиляции оценка меньше
+        self._pids: Set[int] = set()
+        self._warm: Dict[str, Set[int]] = {}
+        self._broken = False  # процесс пула умер, новые задачи не выполнятся
+        # RLock: колбэк future может выполниться сразу в add_done_callback
+        self._lock = threading.RLock()
+        # spawn: воркеры не наследуют потоки и блокировки процесса бота.
+        # Каждый воркер при старте компилирует шаблоны prewarm в свой кэш;
+        # логи воркеров идут в log_queue (logsetup.worker_log_queue), если она есть
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+            initializer=_worker_init, initargs=(list(prewarm), log_queue)
+        )
+        self._delivery = ThreadPoolExecutor(max_workers=DELIVERY_THREADS, thread_name_prefix="render-delivery")
+
+    # ── Состояние очереди ──────────────────────────────────────────
+    def queue_depth(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def next_position(self) -> int:
+        """Позиция, которую получит новая задача (0 — сразу уйдет в работу)."""
+        with self._lock:
+            return len(self._pending) + 1 if self._pending or self._busy >= self.workers else 0
+
+    def memory_reserved(self) -> int:
+        with self._lock:
+            return self._reserved
+
+    def running_count(self) -> int:
+        with self._lock:
+            return len(self._running)
+
+    def oldest_running_age(self) -> float:
+        """Сколько секунд в работе самая старая задача (0 — пул свободен)."""
+        with self._lock:
+            if not self._running:
+                return 0.0
+            return time.perf_counter() - min(j.started_at for j in self._running.values())
+
+    def warm_templates(self) -> int:
+        """Сколько шаблонов скомпилировано во всех известных воркерах."""
+        with self._lock:
+            return sum(1 for pids in self._warm.values() if self._pids and self._pids <= pids)
+
+    def is_broken(self) -> bool:
+        """Пул сломан: задача упала с BrokenProcessPool или пул сам заметил смерть процесса."""
+        with self._lock:
+            return self._broken or bool(getattr(self._pool, "_broken", False))
+
+    def has_job(self, chat_id: int) -> bool:
+        with self._lock:
+            return chat_id in self._running or any(j.chat_id == chat_id for j in self._pending)
+
+    def chat_ids(self) -> List[int]:
+        """Чаты с задачами в очереди или в работе."""
+        with self._lock:
+            return list(self._running) + [j.chat_id for j in self._pending]
+
+    # ── Управление задачами ────────────────────────────────────────
+    def estimate(self, job: RenderJob) -> None:
+        """
+        Оценивает память задачи и при нехватке бюджета выбирает уменьшенный
+        масштаб. Читает шаблон с диска, поэтому из цикла событий вызывается
+        через asyncio.to_thread до submit; без оценки задача памяти не резервирует.
+        """
+        warm = self._template_warm(job.tpl_path)
+        try:
+            job.mem_estimate = render.estimate_job_memory(job.tpl_path, job.photos, template_cached=warm)
+            if job.mem_estimate > self.memory_budget:
+                full = job.mem_estimate
+                job.render_scale, job.mem_estimate = render.fit_render_scale(
+                    job.tpl_path, job.photos, self.memory_budget, template_cached=warm)
+                logging.warning(
+                    f"Задача не помещается в бюджет памяти | chat={job.chat_id} оценка={full >> 20}МБ "
+                    f"бюджет={self.memory_budget >> 20}МБ → масштаб {job.render_scale:g} "
+                    f"({job.mem_estimate >> 20}МБ)"
+                )
+        except Exception as e:
+            # Без оценки задача не резервирует память, но и не теряется
+            logging.warning(f"Не удалось оценить память задачи | chat={job.chat_id}: {e}")
+            job.mem_estimate, job.render_scale = 0, 1.0
+
+    def submit(self, job: RenderJob) -> int:
+        """
+        Ставит задачу в очередь. Возвращает позицию в очереди
+        (0 — задача сразу ушла в работу). Память резервируется по
+        job.mem_estimate (см. estimate).
+        """
+        with self._lock:
+            if job.chat_id in self._running or any(j.chat_id == job.chat_id for j in self._pending):
+                raise ChatBusyError(job.chat_id)
+            if self._busy + len(self._pending) >= self.max_jobs:
+                raise QueueFullError(job.chat_id)
+            job.submitted_at = time.perf_counter()
+            self._pending.append(job)
+            # Очередь непуста только когда все воркеры заняты, поэтому
+            # здесь в работу может уйти лишь сама новая задача
+            started = self._dispatch_locked()
+            return 0 if started else len(self._pending)
+
+    def cancel(self, chat_id: int) -> bool:
+        """
+        Отменяет задачу чата. Ожидающая задача удаляется из очереди,
+        у выполняющейся результат будет отброшен, а чат сразу может
+        поставить новую задачу.
+        """
+        with self._lock:
+            for job in self._pending:
+                if job.chat_id == chat_id:
+                    self._pending.remove(job)
+                    job.cancelled = True
+                    logging.info(f"Задача рендера отменена в очереди | chat={chat_id}")
+                    return True
+            job = self._running.pop(chat_id, None)
+            if job is not None:
+                job.cancelled = True
+                logging.info(f"Задача рендера отменена во время выполнения | chat={chat_id}")
+                return True
+        return False
+
+    def wait_ready(self, timeout: float) -> bool:
+        """
+        Ждет, пока все воркеры запустятся и прогреются (см. prewarm), и
+        запоминает их шаблоны как скомпилированные. False — не успели за timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                missing = self.workers - len(self._pids)
+            if missing <= 0:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            # Пул запускает процесс на каждую пробу, пока свободных нет, поэтому
+            # пробы на все недостающие воркеры отправляются разом
+            probes = [self._pool.submit(_ready_probe) for _ in range(missing)]
+            done, _ = wait(probes, timeout=remaining)
+            for probe in done:
+                if probe.exception() is not None:
+                    raise probe.exception()
+                pid, templates = probe.result()
+                with self._lock:
+                    self._pids.add(pid)
+                    for tpl_path in templates:
+                        self._warm.setdefault(tpl_path, set()).add(pid)
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._delivery.shutdown(wait=False)
+
+    # ── Внутреннее ─────────────────────────────────────────────────
+    def _template_warm(self, tpl_path: str) -> bool:
+        """Шаблон скомпилирован во всех воркерах — задача попадет в любой из них."""
+        with self._lock:
+            warm = self._warm.get(os.path.abspath(tpl_path), set())
+            return len(self._pids) >= self.workers and self._pids <= warm
+
+    def _dispatch_locked(self) -> List[RenderJob]:
+        started = []
+        while self._pending and self._busy < self.workers:
+            job = self._pending[0]
+            # Пустой пул берет задачу в любом случае: иначе задача больше бюджета не запустится никогда
+            if self._busy and self._reserved + job.mem_estimate > self.memory_budget:
+                break
+            self._pending.popleft()
+            self._running[job.chat_id] = job
+            self._busy += 1
+            self._reserved += job.mem_estimate
+            job.started_at = time.perf_counter()
+            if job.preview_size and job.jitter is not None and self.on_preview is not None:
+                job.future = self._pool.submit(render.render_preview,
+                                              job.tpl_path, job.photos, job.jitter, job.preview_size)
+                job.future.add_done_callback(lambda f, j=job: self._on_preview_done(j, f))
+            else:
+                self._submit_full_locked(job)
+            started.append(job)
+        return started
+
+    def _submit_full_locked(self, job: RenderJob) -> None:
+        job.future = self._pool.submit(render.render_job_with_stats,
+                                      job.tpl_path, job.photos, job.mono_dir, job.jitter, job.render_scale)
+        job.future.add_done_callback(lambda f, j=job: self._on_future_done(j, f))
+
+    def _on_preview_done(self, job: RenderJob, future: Future) -> None:
+        """Превью готово: отдаем его получателю и продолжаем полный рендер в том же слоте."""
+        preview_time = time.perf_counter() - job.started_at
+        if not future.cancelled() and future.exception() is not None:
+            logging.warning(f"Превью не удалось, продолжаем без него | chat={job.chat_id}: {future.exception()}")
+        with self._lock:
+            if not job.cancelled and not future.cancelled():
+                try:
+                    self._submit_full_locked(job)
+                except RuntimeError:
+                    pass  # пул уже остановлен
+                else:
+                    if future.exception() is None:
+                        self._delivery.submit(self._safe_call, self.on_preview, job, future.result())
+                    job.stats["preview_total"] = preview_time
+                    return
+        # Задачу отменили (или пул остановлен) — слот освобождается как после полного рендера
+        self._on_future_done(job, future)
+
+    def _notify_started(self, started: List[RenderJob]) -> None:
+        if self.on_start is None:
+            return
+        for job in started:
+            self._delivery.submit(self._safe_call, self.on_start, job)
+
+    def _on_future_done(self, job: RenderJob, future: Future) -> None:
+        # Вызывается из служебного потока пула — здесь только учет и передача дальше
+        stats = None
+        if not future.cancelled() and future.exception() is None and isinstance(future.result(), tuple):
+            stats = future.result()[1]
+        with self._lock:
+            self._busy -= 1
+            self._reserved -= job.mem_estimate
+            if stats is not None:
+                self._pids.add(stats["pid"])
+                self._warm.setdefault(os.path.abspath(job.tpl_path), set()).add(stats["pid"])
+            if self._running.get(job.chat_id) is job:
+                del self._running[job.chat_id]
+            started = self._dispatch_locked()
+        self._notify_started(started)
+
+        job.photos = []
+        if future.cancelled():
+            return
+        if job.cancelled:
+            logging.info(f"Результат отмененной задачи отброшен | chat={job.chat_id}")
+            return
+        error = future.exception()
+        if isinstance(error, BrokenProcessPool):
+            with self._lock:
+                self._broken = True
+        result = None
+        if error is None:
+            result, stats = future.result()
+            job.stats.update(stats)
+            job.stats["mem_estimate_bytes"] = job.mem_estimate
+            logging.info(
+                f"Память задачи: оценка {job.mem_estimate >> 20} МБ, факт {stats['job_rss_bytes'] >> 20} МБ | "
+                f"chat={job.chat_id} масштаб={job.render_scale:g} компиляция={stats['template_compiled']} "
+                f"пик воркера={stats['peak_rss_bytes'] >> 20} МБ"
+            )
+        job.stats["queue_wait"] = job.started_at - job.submitted_at
+        self._delivery.submit(self._safe_call, self.on_done, job, result, error)
+
+    @staticmethod
+    def _safe_call(func, *args) -> None:
+        try:
+            func(*args)
+        except Exception:
+            logging.exception("Ошибка в колбэке движка рендера")
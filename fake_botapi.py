@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Локальный поддельный Bot API с лимитами Telegram: отвечает 429 с
+retry_after, если чат или бот в целом шлют быстрее разрешенного.
+
+Режимы:
+    python fake_botapi.py serve --port 8081      # бот: TG_API_BASE=http://127.0.0.1:8081
+    python fake_botapi.py bench --chats 20        # всплеск через планировщик outbox.py
+    python fake_botapi.py bench --chats 20 --direct   # тот же всплеск напрямую, для сравнения
+"""
+
+# ────────────────────────────────────────────────────────────────────
+# ► 0. ИМПОРТЫ
+# ────────────────────────────────────────────────────────────────────
+import io, sys, json, math, time, asyncio, argparse, logging
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+from PIL import Image
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+from outbox import Outbox, TokenBucket, with_retries
+
+# ────────────────────────────────────────────────────────────────────
+# ► 1. СЕРВЕР
+# ────────────────────────────────────────────────────────────────────
+# Лимиты Telegram по документации: ~30 запросов в секунду на бота, ~1 сообщение в секунду в чат
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_CHAT_RATE   = 1
+TELEGRAM_CHAT_BURST  = 3
+
+# Методы, создающие или меняющие сообщения: на них действует лимит чата
+CHAT_LIMITED = {"sendMessage", "sendPhoto", "sendDocument", "editMessageText", "editMessageMedia",
+                "editMessageReplyMarkup", "editMessageCaption"}
+
+
+class FakeBotApi:
+    """Минимальный Bot API: ответы-заглушки, лимиты и счетчики запросов."""
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int, latency: float = 0.0):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.latency = latency
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[str, TokenBucket] = {}
+        self._message_id = 0
+        self.calls: Dict[str, int] = {}
+        self.rejected: Dict[str, int] = {}
+        self._photo = self._make_photo()
+
+    @staticmethod
+    def _make_photo() -> bytes:
+        buf = io.BytesIO()
+        Image.new("RGB", (640, 480), (120, 90, 60)).save(buf, "JPEG")
+        return buf.getvalue()
+
+    def _retry_after(self, method: str, chat_id: Optional[str]) -> int:
+        """0 — запрос укладывается в лимиты, иначе сколько секунд ждать."""
+        now = time.monotonic()
+        wait = self._global.delay(now)
+        bucket = None
+        if chat_id is not None and method in CHAT_LIMITED:
+            bucket = self._chats.setdefault(chat_id, TokenBucket(self.chat_rate, self.chat_burst))
+            wait = max(wait, bucket.delay(now))
+        if wait > 0:
+            return max(1, math.ceil(wait))
+        self._global.take(now)
+        if bucket is not None:
+            bucket.take(now)
+        return 0
+
+    def _message(self, chat_id: Optional[str], text: Optional[str] = None) -> Dict[str, Any]:
+        self._message_id += 1
+        msg = {"message_id": self._message_id, "date": int(time.time()),
+               "chat": {"id": int(chat_id or 0), "type": "private"},
+               "from": {"id": 1, "is_bot": True, "first_name": "fake"}}
+        if text is not None:
+            msg["text"] = text
+        return msg
+
+    async def api(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = dict(await request.post()) if request.method == "POST" else dict(request.query)
+        if method == "getUpdates":
+            await asyncio.sleep(min(float(data.get("timeout", 0) or 0), 1.0))
+            return web.json_response({"ok": True, "result": []})
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        chat_id = data.get("chat_id")
+        chat_id = chat_id if isinstance(chat_id, str) else None
+        retry_after = self._retry_after(method, chat_id)
+        if retry_after:
+            self.rejected[method] = self.rejected.get(method, 0) + 1
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retry_after}",
+                "parameters": {"retry_after": retry_after}}, status=429)
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == "getMe":
+            result: Any = {"id": 1, "is_bot": True, "first_name": "fake", "username": "fake_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, data.get("text") if isinstance(data.get("text"), str) else None)
+        elif method in ("sendPhoto", "sendDocument", "editMessageMedia"):
+            result = self._message(chat_id)
+        elif method == "getFile":
+            result = {"file_id": data.get("file_id", "f"), "file_unique_id": "u", "file_path": "photos/fake.jpg"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def file(self, request: web.Request) -> web.Response:
+        return web.Response(body=self._photo, content_type="image/jpeg")
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.summary())
+
+    def summary(self) -> Dict[str, Any]:
+        return {"calls": dict(sorted(self.calls.items())), "rejected_429": dict(sorted(self.rejected.items())),
+                "total_429": sum(self.rejected.values())}
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.api)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.file)
+        app.router.add_get("/stats", self.stats)
+        return app
+
+
+async def start_server(api: FakeBotApi, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(api.make_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+# ────────────────────────────────────────────────────────────────────
+# ► 2. НАГРУЗКА
+# ────────────────────────────────────────────────────────────────────
+async def chat_session(bot: AsyncTeleBot, outbox: Optional[Outbox], chat_id: int, edits: int,
+                       result: bytes, latencies: List[float]) -> None:
+    """Типичный всплеск одного чата: статус, серия правок статуса, результат, удаления."""
+    async def send(func, *args, **kwargs):
+        return await with_retries(func, *args, **kwargs)
+
+    t0 = time.perf_counter()
+    if outbox is None:
+        status = await send(bot.send_message, chat_id, "⏳ 0%")
+        await asyncio.gather(*(send(bot.edit_message_text, f"⏳ {(i + 1) * 10}%", chat_id, status.message_id)
+                               for i in range(edits)))
+        await send(bot.send_photo, chat_id, result, caption="✅")
+        latencies.append(time.perf_counter() - t0)
+        await send(bot.delete_message, chat_id, status.message_id)
+    else:
+        status = await outbox.send_message(chat_id, "⏳ 0%")
+        # Правки не ждем по одной: так делает бот, когда статус меняется быстрее сети
+        edit_tasks = [asyncio.ensure_future(outbox.edit_message_text(f"⏳ {(i + 1) * 10}%", chat_id,
+                                                                     status.message_id))
+                      for i in range(edits)]
+        await outbox.send_photo(chat_id, result, caption="✅")
+        latencies.append(time.perf_counter() - t0)
+        await asyncio.gather(*edit_tasks)
+        outbox.delete_later(chat_id, status.message_id)
+
+
+async def bench(args) -> Dict[str, Any]:
+    api = FakeBotApi(args.global_rate, args.chat_rate, args.chat_burst, args.latency)
+    runner = await start_server(api, "127.0.0.1", args.port)
+    asyncio_helper.API_URL = f"http://127.0.0.1:{args.port}/bot{{0}}/{{1}}"
+    bot = AsyncTeleBot("0:fake")
+    outbox = None
+    if not args.direct:
+        outbox = Outbox(bot)  # лимиты планировщика — из окружения (TG_GLOBAL_RATE и др.)
+        outbox.start()
+
+    buf = io.BytesIO()
+    Image.new("RGB", (1280, 960), (30, 60, 90)).save(buf, "JPEG")
+    result = buf.getvalue()
+    latencies: List[float] = []
+    try:
+        t0 = time.perf_counter()
+        outcomes = await asyncio.gather(*(chat_session(bot, outbox, 1000 + i, args.edits, result, latencies)
+                                          for i in range(args.chats)), return_exceptions=True)
+        if outbox is not None:
+            while outbox.depth():
+                await asyncio.sleep(0.05)
+        wall = time.perf_counter() - t0
+    finally:
+        if outbox is not None:
+            await outbox.stop()
+        await bot.close_session()
+        await runner.cleanup()
+
+    latencies.sort()
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else 0.0
+    # Чат провален, если какой-то запрос не прошел и после всех повторов
+    failed = sum(1 for o in outcomes if isinstance(o, Exception))
+    return dict(api.summary(), mode="direct" if args.direct else "outbox", chats=args.chats, failed_chats=failed,
+                seconds=round(wall, 2), result_p50_s=round(pick(0.50), 2), result_p95_s=round(pick(0.95), 2))
+
+
+async def serve(args) -> None:
+    api = FakeBotApi(args.global_rate, args.chat_rate, args.chat_burst, args.latency)
+    runner = await start_server(api, args.host, args.port)
+    logging.info(f"Поддельный Bot API: http://{args.host}:{args.port} (счетчики — /stats)")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Поддельный Bot API с лимитами Telegram.")
+    parser.add_argument("mode", choices=("serve", "bench"))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--global-rate", type=float, default=TELEGRAM_GLOBAL_RATE, help="запросов в секунду на бота")
+    parser.add_argument("--chat-rate", type=float, default=TELEGRAM_CHAT_RATE, help="сообщений в секунду в чат")
+    parser.add_argument("--chat-burst", type=int, default=TELEGRAM_CHAT_BURST, help="всплеск сообщений в чат")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, секунд")
+    parser.add_argument("--chats", type=int, default=20, help="bench: чатов одновременно")
+    parser.add_argument("--edits", type=int, default=5, help="bench: правок статуса на чат")
+    parser.add_argument("--direct", action="store_true", help="bench: слать напрямую, без планировщика")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.mode == "serve":
+        asyncio.run(serve(args))
+        return 0
+    result = asyncio.run(bench(args))
+    print(json.dumps(result, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
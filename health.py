@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Живость и готовность бота для health-check контейнера.
+
+/healthz — процесс жив: цикл событий и получение обновлений отвечают
+(heartbeat свежий), пул рендера не сломан и не завис на одной задаче.
+/readyz — вдобавок закончен прогрев шаблонов. Оба эндпоинта на порту
+метрик; код 200 или 503, в теле JSON с причинами.
+"""
+
+# ────────────────────────────────────────────────────────────────────
+# ► 0. ИМПОРТЫ
+# ────────────────────────────────────────────────────────────────────
+import os, json, time, asyncio, threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from metrics import HttpResponse, add_http_route
+
+# ────────────────────────────────────────────────────────────────────
+# ► 1. КОНСТАНТЫ
+# ────────────────────────────────────────────────────────────────────
+HEARTBEAT_INTERVAL = 5  # секунд между отметками цикла событий
+HEALTH_LOOP_STALE  = int(os.getenv("HEALTH_LOOP_STALE", 30))   # секунд без отметки цикла событий
+HEALTH_POLL_STALE  = int(os.getenv("HEALTH_POLL_STALE", 90))   # секунд без ответа getUpdates (long poll — 20 с)
+HEALTH_JOB_STALE   = int(os.getenv("HEALTH_JOB_STALE", 600))   # секунд одной задачи в работе — рендер завис
+
+# ────────────────────────────────────────────────────────────────────
+# ► 2. СОСТОЯНИЕ
+# ────────────────────────────────────────────────────────────────────
+class Health:
+    """
+    Heartbeat-отметки с допустимым возрастом, проверки (функция возвращает
+    описание проблемы или None) и флаг готовности. Потокобезопасен: отметки
+    ставит цикл событий, читает HTTP-поток метрик.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._beats: Dict[str, Tuple[float, float]] = {}  # имя → (последняя отметка, допустимый возраст)
+        self._checks: Dict[str, Callable[[], Optional[str]]] = {}
+        self._ready = False
+        self._ready_info: Dict[str, Any] = {}
+
+    def expect(self, name: str, stale_after: float) -> None:
+        """Регистрирует heartbeat; отсчет идет с момента регистрации."""
+        with self._lock:
+            self._beats[name] = (time.monotonic(), stale_after)
+
+    def beat(self, name: str) -> None:
+        with self._lock:
+            if name in self._beats:
+                self._beats[name] = (time.monotonic(), self._beats[name][1])
+
+    def add_check(self, name: str, check: Callable[[], Optional[str]]) -> None:
+        with self._lock:
+            self._checks[name] = check
+
+    def set_ready(self, **info: Any) -> None:
+        """Старт закончен (прогрев и т.п.); info попадает в ответ /readyz."""
+        with self._lock:
+            self._ready = True
+            self._ready_info = info
+
+    def status(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            beats = dict(self._beats)
+            checks = dict(self._checks)
+            ready = self._ready
+            ready_info = dict(self._ready_info)
+        problems: List[str] = []
+        ages = {}
+        for name, (last, stale_after) in sorted(beats.items()):
+            ages[name] = round(now - last, 1)
+            if now - last > stale_after:
+                problems.append(f"{name}: нет отметки {now - last:.0f} с")
+        for name, check in sorted(checks.items()):
+            try:
+                problem = check()
+            except Exception as e:
+                problem = f"ошибка проверки: {e}"
+            if problem:
+                problems.append(f"{name}: {problem}")
+        live = not problems
+        return {"live": live, "ready": live and ready, "uptime_s": round(now - self._started, 1),
+                "heartbeats": ages, "problems": problems, **ready_info}
+
+    async def run_loop_heartbeat(self, name: str = "loop") -> None:
+        """Задача цикла событий: отметка раз в HEARTBEAT_INTERVAL. Застрявший цикл ее не поставит."""
+        self.expect(name, HEALTH_LOOP_STALE)
+        while True:
+            self.beat(name)
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+
+HEALTH = Health()
+
+# ────────────────────────────────────────────────────────────────────
+# ► 3. HTTP-ЭНДПОИНТЫ
+# ────────────────────────────────────────────────────────────────────
+def _response(ok: bool, status: Dict[str, Any]) -> HttpResponse:
+    body = json.dumps(status, ensure_ascii=False).encode("utf-8")
+    return (200 if ok else 503), "application/json; charset=utf-8", body
+
+
+def _healthz() -> HttpResponse:
+    status = HEALTH.status()
+    return _response(status["live"], status)
+
+
+def _readyz() -> HttpResponse:
+    status = HEALTH.status()
+    return _response(status["ready"], status)
+
+
+add_http_route("/healthz", _healthz)
+add_http_route("/readyz", _readyz)
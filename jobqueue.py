@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Очередь задач рендера в SQLite для режима RENDER_MODE=queue.
+
+Бот (фронтенд) только принимает обновления Telegram и кладет задачи в
+базу на общем томе; рендерят отдельные процессы worker.py — сколько угодно
+процессов или контейнеров. Воркер забирает задачу с арендой (lease) и
+продлевает ее, пока работает; результат кладет файлом рядом с базой.
+Задача воркера, который упал или пропал, после истечения аренды снова
+уходит в очередь, но не больше JOB_MAX_ATTEMPTS раз.
+"""
+
+# ────────────────────────────────────────────────────────────────────
+# ► 0. ИМПОРТЫ
+# ────────────────────────────────────────────────────────────────────
+import os, json, time, sqlite3, logging, threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from engine import RenderJob, QueueFullError, ChatBusyError, RENDER_QUEUE_SIZE, DELIVERY_THREADS
+
+# ────────────────────────────────────────────────────────────────────
+# ► 1. КОНСТАНТЫ
+# ────────────────────────────────────────────────────────────────────
+JOB_QUEUE_DIR      = os.getenv("JOB_QUEUE_DIR", "data/queue")
+JOB_LEASE          = int(os.getenv("JOB_LEASE", 60))           # секунд аренды без продления
+JOB_MAX_ATTEMPTS   = int(os.getenv("JOB_MAX_ATTEMPTS", 3))     # запусков задачи, включая повторы после падений
+JOB_POLL_INTERVAL  = float(os.getenv("JOB_POLL_INTERVAL", 0.2))  # секунд между опросами базы
+WORKER_STALE       = 3 * JOB_LEASE   # секунд без отметки, после которых воркер считается пропавшим
+WORKER_FORGET      = 24 * 3600       # записи о пропавших воркерах хранятся сутки — для /stats и отладки
+SQLITE_BUSY_MS     = 10_000
+
+
+class RemoteRenderError(Exception):
+    """Воркер не смог выполнить задачу; текст — описание ошибки от воркера."""
+
+# ────────────────────────────────────────────────────────────────────
+# ► 2. ХРАНИЛИЩЕ
+# ────────────────────────────────────────────────────────────────────
+class JobQueue:
+    """
+    Таблица задач и отметок воркеров. Каждый процесс открывает свое
+    соединение; изменения очереди идут в транзакциях BEGIN IMMEDIATE, так что
+    два воркера не заберут одну задачу. Работает на локальном диске или
+    bind-томе одного хоста (WAL не поддерживается на сетевых ФС).
+
+    Состояния задачи: queued → running → done | failed. Отмена и
+    подтверждение получения (ack) удаляют строку вместе с файлами.
+    """
+
+    def __init__(self, root: str = JOB_QUEUE_DIR, lease: int = JOB_LEASE, max_attempts: int = JOB_MAX_ATTEMPTS):
+        self.root = root
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.files_dir = os.path.join(root, "files")
+        os.makedirs(self.files_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        # Транзакции открываются явно (isolation_level=None), иначе BEGIN IMMEDIATE не задать
+        self._conn = sqlite3.connect(os.path.join(root, "jobs.db"), check_same_thread=False,
+                                     isolation_level=None, timeout=SQLITE_BUSY_MS / 1000)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " chat_id INTEGER NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " state TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " worker TEXT,"
+            " lease_until REAL,"
+            " created_at REAL NOT NULL,"
+            " started_at REAL,"
+            " preview INTEGER NOT NULL DEFAULT 0,"
+            " stats TEXT,"
+            " error TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS workers ("
+            " id TEXT PRIMARY KEY,"
+            " seen_at REAL NOT NULL,"
+            " ready INTEGER NOT NULL DEFAULT 0,"
+            " warm INTEGER NOT NULL DEFAULT 0,"
+            " job_id INTEGER)"
+        )
+
+    @contextmanager
+    def _tx(self):
+        """Транзакция с блокировкой записи с самого начала."""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._conn
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    # ── Файлы результатов ──────────────────────────────────────────
+    def file_path(self, job_id: int, kind: str) -> str:
+        """Файл результата (kind «result») или превью (kind «preview») задачи."""
+        return os.path.join(self.files_dir, f"{job_id}.{kind}")
+
+    def _put_file(self, job_id: int, worker_id: str, kind: str, data: bytes, sql: str, args: tuple) -> bool:
+        """
+        Пишет файл во временный и переносит на место в той же транзакции, что
+        и sql, — только если задача еще у этого воркера. Иначе воркер, потерявший
+        аренду, затер бы результат нового владельца.
+        """
+        path = self.file_path(job_id, kind)
+        tmp_path = f"{path}.{worker_id}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        with self._lock, self._tx() as conn:
+            owned = conn.execute("SELECT 1 FROM jobs WHERE id = ? AND worker = ? AND state = 'running'",
+                                 (job_id, worker_id)).fetchone()
+            if owned:
+                os.replace(tmp_path, path)
+                conn.execute(sql, args)
+        if not owned:
+            os.remove(tmp_path)
+        return bool(owned)
+
+    def read_file(self, job_id: int, kind: str) -> bytes:
+        with open(self.file_path(job_id, kind), "rb") as f:
+            return f.read()
+
+    def _remove_files(self, job_id: int) -> None:
+        for kind in ("result", "preview"):
+            try:
+                os.remove(self.file_path(job_id, kind))
+            except OSError:
+                pass
+
+    # ── Фронтенд ───────────────────────────────────────────────────
+    def enqueue(self, chat_id: int, payload: Dict[str, Any]) -> int:
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO jobs (chat_id, payload, state, created_at) VALUES (?, ?, 'queued', ?)",
+                (chat_id, json.dumps(payload, ensure_ascii=False), time.time()))
+            return cur.lastrowid
+
+    def fetch(self, job_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        """Текущее состояние задач по id; удаленных в ответе нет."""
+        if not job_ids:
+            return {}
+        marks = ",".join("?" * len(job_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, chat_id, payload, state, attempts, created_at, started_at, preview, stats, error "
+                f"FROM jobs WHERE id IN ({marks})", job_ids).fetchall()
+        return {r[0]: {"chat_id": r[1], "payload": json.loads(r[2]), "state": r[3], "attempts": r[4],
+                       "created_at": r[5], "started_at": r[6], "preview": bool(r[7]),
+                       "stats": json.loads(r[8]) if r[8] else {}, "error": r[9]} for r in rows}
+
+    def unfinished(self) -> List[int]:
+        """id всех задач в базе (в том числе готовых, но не полученных фронтендом)."""
+        with self._lock:
+            return [r[0] for r in self._conn.execute("SELECT id FROM jobs ORDER BY id")]
+
+    def ack(self, job_id: int) -> None:
+        """Фронтенд забрал результат (или отменил задачу) — строка и файлы больше не нужны."""
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        self._remove_files(job_id)
+
+    def counts(self) -> Tuple[int, int]:
+        """(в очереди, в работе)."""
+        with self._lock:
+            rows = dict(self._conn.execute(
+                "SELECT state, COUNT(*) FROM jobs WHERE state IN ('queued', 'running') GROUP BY state").fetchall())
+        return rows.get("queued", 0), rows.get("running", 0)
+
+    def live_workers(self) -> List[Dict[str, Any]]:
+        """Воркеры с недавней отметкой."""
+        with self._lock:
+            rows = self._conn.execute("SELECT id, ready, warm, job_id FROM workers WHERE seen_at > ?",
+                                      (time.time() - WORKER_STALE,)).fetchall()
+        return [{"id": r[0], "ready": bool(r[1]), "warm": r[2], "job_id": r[3]} for r in rows]
+
+    def forget_workers(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM workers WHERE seen_at < ?", (time.time() - WORKER_FORGET,))
+
+    def purge_orphan_files(self) -> int:
+        """Удаляет файлы задач, которых уже нет в базе (остатки аварийного завершения)."""
+        known = set(self.unfinished())
+        removed = 0
+        for name in os.listdir(self.files_dir):
+            job_id = name.split(".", 1)[0]
+            if not job_id.isdigit() or int(job_id) not in known:
+                try:
+                    os.remove(os.path.join(self.files_dir, name))
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    # ── Воркер ─────────────────────────────────────────────────────
+    def expire_leases(self) -> int:
+        """
+        Задачи с истекшей арендой (воркер упал или завис) возвращает в
+        очередь, а исчерпавшие попытки — помечает ошибкой.
+        """
+        now = time.time()
+        with self._lock, self._tx() as conn:
+            expired = conn.execute("SELECT id, attempts, worker FROM jobs WHERE state = 'running' AND lease_until < ?",
+                                   (now,)).fetchall()
+            for job_id, attempts, worker in expired:
+                if attempts >= self.max_attempts:
+                    conn.execute("UPDATE jobs SET state = 'failed', error = ? WHERE id = ?",
+                                 (f"воркер не завершил задачу за {attempts} попыток", job_id))
+                else:
+                    conn.execute("UPDATE jobs SET state = 'queued', worker = NULL, lease_until = NULL, "
+                                 "started_at = NULL, preview = 0 WHERE id = ?", (job_id,))
+        for job_id, attempts, worker in expired:
+            logging.warning(f"Аренда задачи {job_id} истекла (воркер {worker}, попытка {attempts}) — "
+                            f"{'задача не выполнена' if attempts >= self.max_attempts else 'повтор'}")
+        return len(expired)
+
+    def claim(self, worker_id: str) -> Optional[Tuple[int, Dict[str, Any], int]]:
+        """Забирает старейшую задачу из очереди: (id, payload, номер попытки) или None."""
+        self.expire_leases()
+        now = time.time()
+        with self._lock, self._tx() as conn:
+            row = conn.execute("SELECT id, payload, attempts FROM jobs WHERE state = 'queued' "
+                               "ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE jobs SET state = 'running', worker = ?, lease_until = ?, started_at = ?, "
+                         "attempts = attempts + 1 WHERE id = ?", (worker_id, now + self.lease, now, row[0]))
+        return row[0], json.loads(row[1]), row[2] + 1
+
+    def renew(self, job_id: int, worker_id: str) -> bool:
+        """Продлевает аренду. False — задачу отменили или отдали другому воркеру."""
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                (time.time() + self.lease, job_id, worker_id))
+        return cur.rowcount > 0
+
+    def put_preview(self, job_id: int, worker_id: str, data: bytes) -> bool:
+        return self._put_file(job_id, worker_id, "preview", data, "UPDATE jobs SET preview = 1 WHERE id = ?", (job_id,))
+
+    def complete(self, job_id: int, worker_id: str, result: bytes, stats: Dict[str, Any]) -> bool:
+        """
+        Сохраняет результат. False — аренда потеряна: задачу отменили или
+        она уже у другого воркера; тогда результат выбрасывается.
+        """
+        return self._put_file(job_id, worker_id, "result", result,
+                              "UPDATE jobs SET state = 'done', stats = ?, lease_until = NULL WHERE id = ?",
+                              (json.dumps(stats), job_id))
+
+    def fail(self, job_id: int, worker_id: str, error: str) -> bool:
+        """Ошибка рендера. Не повторяется: на тех же входах она повторилась бы."""
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE jobs SET state = 'failed', error = ?, lease_until = NULL WHERE id = ? AND worker = ? "
+                "AND state = 'running'", (error, job_id, worker_id))
+        return cur.rowcount > 0
+
+    def worker_beat(self, worker_id: str, ready: bool, warm: int, job_id: Optional[int]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO workers (id, seen_at, ready, warm, job_id) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET seen_at = excluded.seen_at, ready = excluded.ready, "
+                "warm = excluded.warm, job_id = excluded.job_id",
+                (worker_id, time.time(), int(ready), warm, job_id))
+
+    def worker_gone(self, worker_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM workers WHERE id = ?", (worker_id,))
+
+    def worker_seen(self, host: str) -> Optional[Dict[str, Any]]:
+        """
+        Последняя отметка воркеров хоста host (для health-check контейнера).
+        id воркера — «хост-pid»: совпадать должны хост целиком и цифры pid после него,
+        чтобы хост «a» не принял за свои отметки хоста «a-b».
+        """
+        prefix = host + "-"
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT w.seen_at, j.started_at FROM workers w LEFT JOIN jobs j ON j.id = w.job_id "
+                "WHERE substr(w.id, 1, ?) = ? AND substr(w.id, ?) <> '' AND substr(w.id, ?) NOT GLOB '*[^0-9]*' "
+                "ORDER BY w.seen_at DESC LIMIT 1",
+                (len(prefix), prefix, len(prefix) + 1, len(prefix) + 1)).fetchone()
+        return None if row is None else {"seen_at": row[0], "job_started_at": row[1]}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+# ────────────────────────────────────────────────────────────────────
+# ► 3. ДВИЖОК ФРОНТЕНДА
+# ────────────────────────────────────────────────────────────────────
+class QueueEngine:
+    """
+    Замена RenderEngine для фронтенда: тот же интерфейс и те же колбэки
+    (on_start, on_preview, on_done), но задачи уходят в JobQueue, а
+    состояние опрашивается фоновым потоком. Задачи переживают рестарт
+    фронтенда: при старте незавершенные задачи из базы снова отслеживаются.
+    """
+
+    def __init__(self,
+                 on_done: Callable[[RenderJob, Optional[bytes], Optional[BaseException]], None],
+                 on_start: Optional[Callable[[RenderJob], None]] = None,
+                 max_jobs: int = RENDER_QUEUE_SIZE,
+                 on_preview: Optional[Callable[[RenderJob, bytes], None]] = None,
+                 queue: Optional[JobQueue] = None, poll_interval: float = JOB_POLL_INTERVAL):
+        self.on_done = on_done
+        self.on_start = on_start
+        self.on_preview = on_preview
+        self.max_jobs = max(1, max_jobs)
+        self.memory_budget = 0  # бюджет памяти у каждого воркера свой (см. worker.py)
+        self.queue = queue or JobQueue()
+        self.poll_interval = poll_interval
+        self._lock = threading.RLock()
+        self._jobs: Dict[int, RenderJob] = {}       # id в базе → задача
+        self._notify_start: Dict[int, bool] = {}    # id → нужно ли сообщить о старте (задача ждала в очереди)
+        self._preview_sent: Dict[int, bool] = {}
+        self._broken = False  # база недоступна
+        self._stop = threading.Event()
+        self._delivery = ThreadPoolExecutor(max_workers=DELIVERY_THREADS, thread_name_prefix="queue-delivery")
+        self._recover()
+        self._poller = threading.Thread(target=self._poll_loop, name="job-queue-poller", daemon=True)
+        self._poller.start()
+
+    def _recover(self) -> None:
+        removed = self.queue.purge_orphan_files()
+        rows = self.queue.fetch(self.queue.unfinished())
+        for job_id, row in rows.items():
+            p = row["payload"]
+            job = RenderJob(p["chat_id"], p["tpl_path"], p["photos"], p.get("status_message_id"),
+                            mono_dir=p.get("mono_dir"), seed=p.get("seed"), preview_size=p.get("preview_size", 0),
+                            cache_key=p.get("cache_key"))
+            job.future = Future()
+            self._jobs[job_id] = job
+            self._notify_start[job_id] = row["state"] == "queued"
+            self._preview_sent[job_id] = row["preview"]
+        if rows or removed:
+            logging.info(f"Очередь задач: восстановлено задач {len(rows)}, удалено брошенных файлов {removed}")
+
+    # ── Состояние очереди ──────────────────────────────────────────
+    @property
+    def workers(self) -> int:
+        """Живых воркеров сейчас."""
+        return len(self.queue.live_workers())
+
+    def queue_depth(self) -> int:
+        return self.queue.counts()[0]
+
+    def running_count(self) -> int:
+        return self.queue.counts()[1]
+
+    def next_position(self) -> int:
+        queued, _ = self.queue.counts()
+        idle = sum(1 for w in self.queue.live_workers() if w["ready"] and w["job_id"] is None)
+        return queued + 1 if queued or not idle else 0
+
+    def memory_reserved(self) -> int:
+        return 0
+
+    def oldest_running_age(self) -> float:
+        """
+        Зависший воркер фронтенд не лечит: рестарт бота его не освободит.
+        Такие задачи снимает истечение аренды, сами воркеры — их health-check.
+        """
+        return 0.0
+
+    def warm_templates(self) -> int:
+        """Больше всего прогретых шаблонов среди живых воркеров."""
+        return max((w["warm"] for w in self.queue.live_workers()), default=0)
+
+    def is_broken(self) -> bool:
+        with self._lock:
+            return self._broken
+
+    def chat_ids(self) -> List[int]:
+        """Чаты с задачами в очереди — их сессии после рестарта не сбрасываются."""
+        with self._lock:
+            return [job.chat_id for job in self._jobs.values()]
+
+    def has_job(self, chat_id: int) -> bool:
+        with self._lock:
+            return any(job.chat_id == chat_id for job in self._jobs.values())
+
+    # ── Управление задачами ────────────────────────────────────────
+    def estimate(self, job: RenderJob) -> None:
+        """Память оценивает воркер по своему бюджету (см. worker.py)."""
+
+    def submit(self, job: RenderJob) -> int:
+        payload = {"chat_id": job.chat_id, "tpl_path": job.tpl_path, "photos": list(job.photos),
+                   "status_message_id": job.status_message_id, "mono_dir": job.mono_dir, "seed": job.seed,
+                   "preview_size": job.preview_size, "cache_key": job.cache_key}
+        with self._lock:
+            if self.has_job(job.chat_id):
+                raise ChatBusyError(job.chat_id)
+            queued, running = self.queue.counts()
+            if queued + running >= self.max_jobs:
+                raise QueueFullError(job.chat_id)
+            position = self.next_position()
+            job.submitted_at = time.perf_counter()
+            job.future = Future()
+            job_id = self.queue.enqueue(job.chat_id, payload)
+            self._jobs[job_id] = job
+            self._preview_sent[job_id] = False
+            self._notify_start[job_id] = position > 0
+            return position
+
+    def cancel(self, chat_id: int) -> bool:
+        """Удаляет задачу чата из базы; воркер, если уже рендерит, выбросит результат."""
+        with self._lock:
+            for job_id, job in list(self._jobs.items()):
+                if job.chat_id == chat_id:
+                    self._forget_locked(job_id)
+                    job.cancelled = True
+                    self.queue.ack(job_id)
+                    logging.info(f"Задача рендера отменена | chat={chat_id} job={job_id}")
+                    return True
+        return False
+
+    def wait_ready(self, timeout: float) -> bool:
+        """Ждет хотя бы одного живого прогретого воркера."""
+        deadline = time.monotonic() + timeout
+        while not any(w["ready"] for w in self.queue.live_workers()):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(min(1.0, self.poll_interval * 5))
+        return True
+
+    def shutdown(self) -> None:
+        # Задачи остаются в базе: воркеры их дорендерят, новый фронтенд доставит
+        self._stop.set()
+        self._poller.join(timeout=5)
+        self._delivery.shutdown(wait=False)
+
+    # ── Внутреннее ─────────────────────────────────────────────────
+    def _forget_locked(self, job_id: int) -> None:
+        self._jobs.pop(job_id, None)
+        self._notify_start.pop(job_id, None)
+        self._preview_sent.pop(job_id, None)
+
+    def _poll_loop(self) -> None:
+        last_forget = 0.0
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self._poll_once()
+                if time.monotonic() - last_forget > 3600:
+                    self.queue.forget_workers()
+                    last_forget = time.monotonic()
+                with self._lock:
+                    self._broken = False
+            except sqlite3.Error:
+                logging.exception("Очередь задач недоступна")
+                with self._lock:
+                    self._broken = True
+
+    def _poll_once(self) -> None:
+        with self._lock:
+            ids = list(self._jobs)
+        if not ids:
+            return
+        self.queue.expire_leases()
+        rows = self.queue.fetch(ids)
+        for job_id in ids:
+            with self._lock:
+                job = self._jobs.get(job_id)
+            if job is None:
+                continue  # отменена, пока шел опрос
+            row = rows.get(job_id)
+            if row is None:
+                # Строку удалили снаружи — сообщаем об ошибке, чтобы чат не завис в «rendering»
+                self._finish(job_id, job, None, RemoteRenderError("задача пропала из очереди"))
+                continue
+            if row["state"] != "queued" and self._notify_start.get(job_id):
+                self._notify_start[job_id] = False
+                if self.on_start is not None:
+                    self._delivery.submit(self._safe_call, self.on_start, job)
+            if row["preview"] and not self._preview_sent.get(job_id) and row["state"] == "running":
+                self._preview_sent[job_id] = True
+                self._deliver_preview(job_id, job)
+            if row["state"] == "done":
+                try:
+                    result = self.queue.read_file(job_id, "result")
+                except OSError as e:
+                    self._finish(job_id, job, None, e)
+                    continue
+                job.stats.update(row["stats"])
+                job.render_scale = row["stats"].get("render_scale", 1.0)
+                job.mem_estimate = row["stats"].get("mem_estimate_bytes", 0)
+                job.stats["queue_wait"] = max(0.0, row["started_at"] - row["created_at"])
+                self._finish(job_id, job, result, None)
+            elif row["state"] == "failed":
+                self._finish(job_id, job, None, RemoteRenderError(row["error"] or "ошибка воркера"))
+
+    def _deliver_preview(self, job_id: int, job: RenderJob) -> None:
+        if self.on_preview is None:
+            return
+        try:
+            preview = self.queue.read_file(job_id, "preview")
+        except OSError as e:
+            logging.warning(f"Превью не удалось прочитать, продолжаем без него | chat={job.chat_id}: {e}")
+            return
+        self._delivery.submit(self._safe_call, self.on_preview, job, preview)
+
+    def _finish(self, job_id: int, job: RenderJob, result: Optional[bytes], error: Optional[BaseException]) -> None:
+        with self._lock:
+            if self._jobs.get(job_id) is not job:
+                return
+            self._forget_locked(job_id)
+        self.queue.ack(job_id)
+        job.photos = []
+        job.future.set_result(None)
+        if error is None:
+            logging.info(f"Задача из очереди готова | chat={job.chat_id} job={job_id} "
+                         f"воркер={job.stats.get('worker')} попытка={job.stats.get('attempt')}")
+        self._delivery.submit(self._safe_call, self.on_done, job, result, error)
+
+    @staticmethod
+    def _safe_call(func, *args) -> None:
+        try:
+            func(*args)
+        except Exception:
+            logging.exception("Ошибка в колбэке очереди задач")
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Логирование без блокировок на пути запроса.
+
+Хендлеры бота и воркеры рендера только кладут запись в очередь; в файлы
+и stdout пишет фоновый поток QueueListener. Текстовый лог и JSON-записи
+по задачам (logs/jobs.jsonl) ротируются по размеру, уровни библиотек
+задаются переменной окружения.
+"""
+
+# ────────────────────────────────────────────────────────────────────
+# ► 0. ИМПОРТЫ
+# ────────────────────────────────────────────────────────────────────
+import os, sys, json, queue, logging, multiprocessing
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, Dict, List, Optional
+
+# ────────────────────────────────────────────────────────────────────
+# ► 1. КОНСТАНТЫ
+# ────────────────────────────────────────────────────────────────────
+LOG_DIR            = os.getenv("LOG_DIR", "logs")
+LOG_LEVEL          = os.getenv("LOG_LEVEL", "INFO").upper()
+# Уровни отдельных логгеров: "telebot=DEBUG,PIL=WARNING"
+LOG_LEVELS         = os.getenv("LOG_LEVELS", "")
+LOG_MAX_BYTES      = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUP_COUNT   = int(os.getenv("LOG_BACKUP_COUNT", 5))
+LOG_QUEUE_SIZE     = int(os.getenv("LOG_QUEUE_SIZE", 10_000))  # записей; при переполнении новые отбрасываются
+LOG_FORMAT         = "%(asctime)s %(levelname)s %(message)s"
+JOBS_LOGGER        = "taro.jobs"
+# Библиотеки, которые на DEBUG пишут на каждый запрос, — по умолчанию тише корня
+DEFAULT_LIBRARY_LEVELS = {"urllib3": "WARNING", "asyncio": "INFO", "PIL": "INFO"}
+
+# ────────────────────────────────────────────────────────────────────
+# ► 2. ФОРМАТЫ И ОЧЕРЕДЬ
+# ────────────────────────────────────────────────────────────────────
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON: время, уровень и поля из extra={"fields": {...}}."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {"ts": round(record.created, 3), "level": record.levelname}
+        entry.update(getattr(record, "fields", None) or {"msg": record.getMessage()})
+        return json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+
+
+_exc_format = logging.Formatter()
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """
+    QueueHandler, который никогда не ждет: если писатель не успевает и
+    очередь полна, запись отбрасывается и учитывается в dropped.
+    """
+    dropped = 0
+
+    def __init__(self, records: Any, prefix: str = ""):
+        super().__init__(records)
+        self.prefix = prefix
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Дешевле штатного prepare: без полного форматирования и копии записи —
+        # только подставляем аргументы и трассировку, чтобы запись пережила
+        # очередь (в том числе pickle между процессами). Время и формат — у писателя
+        msg = record.getMessage()
+        if record.exc_info:
+            record.exc_text = _exc_format.formatException(record.exc_info)
+            record.exc_info = None
+        record.msg, record.args = self.prefix + msg, None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DroppingQueueHandler.dropped += 1
+
+
+class _OnlyLogger(logging.Filter):
+    def __init__(self, name: str, include: bool):
+        super().__init__()
+        self.target, self.include = name, include
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return (record.name == self.target) == self.include
+
+
+_listeners: List[QueueListener] = []
+_handlers: List[logging.Handler] = []
+
+
+def _parse_levels(spec: str) -> Dict[str, str]:
+    levels = dict(DEFAULT_LIBRARY_LEVELS)
+    for item in spec.replace(" ", "").split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            levels[name] = level.upper()
+    return levels
+
+# ────────────────────────────────────────────────────────────────────
+# ► 3. НАСТРОЙКА
+# ────────────────────────────────────────────────────────────────────
+def setup_logging(log_file: str = "bot.log", jobs_file: Optional[str] = "jobs.jsonl") -> None:
+    """
+    Основной процесс: корневой логгер пишет в очередь, фоновый поток —
+    в ротируемый текстовый лог, stdout и JSON-лог задач (jobs_file=None — без него).
+    """
+    os.makedirs(LOG_DIR, exist_ok=True)
+    text_format = logging.Formatter(LOG_FORMAT)
+    text_file = RotatingFileHandler(os.path.join(LOG_DIR, log_file), maxBytes=LOG_MAX_BYTES,
+                                    backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+    stdout = logging.StreamHandler(sys.stdout)
+    for handler in (text_file, stdout):
+        handler.setFormatter(text_format)
+        handler.addFilter(_OnlyLogger(JOBS_LOGGER, include=False))
+    _handlers[:] = [text_file, stdout]
+    if jobs_file:
+        jobs = RotatingFileHandler(os.path.join(LOG_DIR, jobs_file), maxBytes=LOG_MAX_BYTES,
+                                   backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+        jobs.setFormatter(JsonFormatter())
+        jobs.addFilter(_OnlyLogger(JOBS_LOGGER, include=True))
+        _handlers.append(jobs)
+
+    records: "queue.Queue[logging.LogRecord]" = queue.Queue(LOG_QUEUE_SIZE)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_DroppingQueueHandler(records))
+    root.setLevel(LOG_LEVEL)
+    for name, level in _parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+    # Записи задач пишутся при любом LOG_LEVEL
+    logging.getLogger(JOBS_LOGGER).setLevel(logging.INFO)
+
+    listener = QueueListener(records, *_handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+
+
+def worker_log_queue() -> Optional["multiprocessing.Queue"]:
+    """
+    Очередь для процессов пула рендера (контекст spawn): их записи попадают
+    в те же файлы через отдельный поток-писатель основного процесса.
+    None — setup_logging не вызывался, воркеры логируют сами.
+    """
+    if not _handlers:
+        return None
+    records = multiprocessing.get_context("spawn").Queue(LOG_QUEUE_SIZE)
+    listener = QueueListener(records, *_handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+    return records
+
+
+def setup_worker_logging(records: "multiprocessing.Queue", level: str = LOG_LEVEL) -> None:
+    """В процессе пула: все записи — в очередь основного процесса."""
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_DroppingQueueHandler(records, prefix="[render] "))
+    root.setLevel(level)
+    for name, lib_level in _parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(lib_level)
+
+
+def stop_logging() -> None:
+    """Дописывает оставшиеся записи и останавливает потоки-писатели."""
+    while _listeners:
+        _listeners.pop().stop()
+    if _DroppingQueueHandler.dropped:
+        print(f"Логирование: отброшено записей при переполнении очереди: {_DroppingQueueHandler.dropped}",
+              file=sys.stderr)
+
+
+def dropped_records() -> int:
+    return _DroppingQueueHandler.dropped
+
+# ────────────────────────────────────────────────────────────────────
+# ► 4. ЗАПИСИ ПО ЗАДАЧАМ
+# ────────────────────────────────────────────────────────────────────
+_jobs_logger = logging.getLogger(JOBS_LOGGER)
+
+
+def log_job(**fields: Any) -> None:
+    """Компактная JSON-запись о задаче в jobs.jsonl (поля — простые типы)."""
+    _jobs_logger.info("job", extra={"fields": fields})
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Метрики бота: длительности этапов, счетчики задач и очередь рендера.
+
+Отдаются в текстовом формате Prometheus по локальному HTTP-порту
+и в виде сводки для админской команды /stats.
+"""
+
+# ────────────────────────────────────────────────────────────────────
+# ► 0. ИМПОРТЫ
+# ────────────────────────────────────────────────────────────────────
+import os, time, logging, threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+# ────────────────────────────────────────────────────────────────────
+# ► 1. КОНСТАНТЫ
+# ────────────────────────────────────────────────────────────────────
+METRICS_HOST       = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT       = int(os.getenv("METRICS_PORT", 9100))  # 0 — не поднимать HTTP-сервер
+METRICS_PREFIX     = "taro"
+WINDOW_SIZE        = 1000        # последних замеров на этап для p50/p95
+JOBS_RATE_WINDOW   = 300         # секунд для расчета задач в минуту
+BUCKETS            = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# ────────────────────────────────────────────────────────────────────
+# ► 2. РЕЕСТР МЕТРИК
+# ────────────────────────────────────────────────────────────────────
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, int(round(q * (len(values) - 1)))))
+    return values[idx]
+
+
+class _Histogram:
+    __slots__ = ("counts", "total", "count", "window")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+        self.window: Deque[float] = deque(maxlen=WINDOW_SIZE)
+
+    def observe(self, value: float) -> None:
+        for i, le in enumerate(BUCKETS):
+            if value <= le:
+                self.counts[i] += 1
+        self.total += value
+        self.count += 1
+        self.window.append(value)
+
+
+class Metrics:
+    """Потокобезопасный реестр: гистограммы этапов, счетчики и гейджи."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: Dict[str, _Histogram] = {}
+        self._counters: Dict[Tuple[str, str], float] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+        self._last: Dict[str, float] = {}
+        self._job_times: Deque[float] = deque()
+
+    # ── Запись ──────────────────────────────────────────────────────
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self._stages.setdefault(stage, _Histogram()).observe(seconds)
+
+    def observe_stages(self, timings: Dict[str, float]) -> None:
+        for stage, seconds in timings.items():
+            self.observe(stage, seconds)
+
+    def inc(self, name: str, label: str = "", value: float = 1.0) -> None:
+        with self._lock:
+            key = (name, label)
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def set_last(self, name: str, value: float) -> None:
+        """Последнее значение величины (например, пиковая память последней задачи)."""
+        with self._lock:
+            self._last[name] = value
+
+    def register_gauge(self, name: str, func: Callable[[], float]) -> None:
+        """Гейдж, значение которого считывается в момент экспорта."""
+        with self._lock:
+            self._gauges[name] = func
+
+    def job_finished(self, status: str) -> None:
+        now = time.time()
+        self.inc("jobs_total", status)
+        with self._lock:
+            self._job_times.append(now)
+            while self._job_times and self._job_times[0] < now - JOBS_RATE_WINDOW:
+                self._job_times.popleft()
+
+    # ── Чтение ──────────────────────────────────────────────────────
+    def jobs_per_minute(self) -> float:
+        now = time.time()
+        with self._lock:
+            recent = sum(1 for t in self._job_times if t >= now - JOBS_RATE_WINDOW)
+        return recent * 60.0 / JOBS_RATE_WINDOW
+
+    def stage_percentiles(self) -> Dict[str, Tuple[float, float, int]]:
+        """{этап: (p50, p95, число замеров в окне)}."""
+        with self._lock:
+            windows = {name: list(h.window) for name, h in self._stages.items()}
+        return {name: (_percentile(v, 0.50), _percentile(v, 0.95), len(v)) for name, v in sorted(windows.items())}
+
+    def _gauge_values(self) -> Dict[str, float]:
+        with self._lock:
+            gauges = dict(self._gauges)
+        values = {}
+        for name, func in gauges.items():
+            try:
+                values[name] = float(func())
+            except Exception:
+                logging.exception(f"Не удалось получить значение метрики {name}")
+        return values
+
+    def gauge(self, name: str) -> Optional[float]:
+        return self._gauge_values().get(name)
+
+    def render_prometheus(self) -> str:
+        """Текстовый формат экспозиции Prometheus (version 0.0.4)."""
+        p = METRICS_PREFIX
+        lines = [f"# HELP {p}_stage_seconds Длительность этапов обработки.",
+                 f"# TYPE {p}_stage_seconds histogram"]
+        with self._lock:
+            stages = {k: (list(h.counts), h.total, h.count) for k, h in sorted(self._stages.items())}
+            counters = dict(self._counters)
+            last = dict(self._last)
+        for stage, (counts, total, count) in stages.items():
+            for le, c in zip(BUCKETS, counts):
+                lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {c}')
+            lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+            lines.append(f'{p}_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+            lines.append(f'{p}_stage_seconds_count{{stage="{stage}"}} {count}')
+
+        names = sorted({name for name, _ in counters})
+        for name in names:
+            lines.append(f"# TYPE {p}_{name} counter")
+            for (n, label), value in sorted(counters.items()):
+                if n != name:
+                    continue
+                label_str = f'{{status="{label}"}}' if label else ""
+                lines.append(f"{p}_{name}{label_str} {value:g}")
+
+        gauges = self._gauge_values()
+        gauges.update(last)
+        gauges["jobs_per_minute"] = self.jobs_per_minute()
+        for name, value in sorted(gauges.items()):
+            lines.append(f"# TYPE {p}_{name} gauge")
+            lines.append(f"{p}_{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def format_stats(self) -> str:
+        """Сводка для /stats: p50/p95 по этапам, очередь и задач в минуту."""
+        rows = [f"{'этап':<18}{'p50':>8}{'p95':>8}{'n':>6}"]
+        for stage, (p50, p95, n) in self.stage_percentiles().items():
+            rows.append(f"{stage:<18}{p50:>8.2f}{p95:>8.2f}{n:>6}")
+        if len(rows) == 1:
+            rows.append("нет данных")
+        gauges = self._gauge_values()
+        with self._lock:
+            counters = dict(self._counters)
+            last = dict(self._last)
+        jobs = ", ".join(f"{label}={int(v)}" for (n, label), v in sorted(counters.items()) if n == "jobs_total")
+        tail = [
+            f"Очередь: {int(gauges.get('render_queue_depth', 0))}, "
+            f"в работе: {int(gauges.get('render_running', 0))}",
+            f"Задач в минуту (за {JOBS_RATE_WINDOW // 60} мин): {self.jobs_per_minute():.2f}",
+            f"Задачи: {jobs or 'нет'}",
+        ]
+        if "job_peak_rss_bytes" in last:
+            tail.append(f"Пик памяти последней задачи: {last['job_peak_rss_bytes'] / 1024 / 1024:.0f} МБ")
+        if "job_mem_estimate_bytes" in last and "job_actual_mem_bytes" in last:
+            tail.append(f"Память последней задачи: оценка {last['job_mem_estimate_bytes'] / 1024 / 1024:.0f} МБ, "
+                        f"факт {last['job_actual_mem_bytes'] / 1024 / 1024:.0f} МБ")
+        return "<pre>" + "\n".join(rows) + "</pre>\n" + "\n".join(tail)
+
+
+METRICS = Metrics()
+
+# ────────────────────────────────────────────────────────────────────
+# ► 3. HTTP-ЭНДПОИНТ
+# ────────────────────────────────────────────────────────────────────
+# Ответ эндпоинта: код, Content-Type и тело
+HttpResponse = Tuple[int, str, bytes]
+_routes: Dict[str, Callable[[], HttpResponse]] = {}
+
+
+def add_http_route(path: str, handler: Callable[[], HttpResponse]) -> None:
+    """Дополнительный GET-эндпоинт на порту метрик (например, /healthz из health.py)."""
+    _routes[path] = handler
+
+
+def _metrics_response() -> HttpResponse:
+    return 200, "text/plain; version=0.0.4; charset=utf-8", METRICS.render_prometheus().encode("utf-8")
+
+
+add_http_route("/metrics", _metrics_response)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        handler = _routes.get(self.path.split("?", 1)[0])
+        if handler is None:
+            self.send_error(404)
+            return
+        status, content_type, body = handler()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # запросы Prometheus и health-check не засоряют лог
+
+
+def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> Optional[ThreadingHTTPServer]:
+    """Поднимает /metrics в фоновом потоке; port=0 отключает сервер."""
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
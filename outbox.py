@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Планировщик исходящих запросов к Bot API.
+
+Все сообщения, правки и удаления идут через одну очередь с приоритетами.
+Отправку ограничивают два token bucket — общий на бота и отдельный на
+каждый чат, — поэтому всплески не упираются в лимиты Telegram (429).
+Повторные правки одного сообщения одним методом, еще не ушедшие в сеть, схлопываются
+в одну — уходит последняя версия текста.
+"""
+
+# ────────────────────────────────────────────────────────────────────
+# ► 0. ИМПОРТЫ
+# ────────────────────────────────────────────────────────────────────
+import os, time, random, asyncio, logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+import aiohttp
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException, RequestTimeout
+from telebot.types import Message
+
+from metrics import METRICS
+
+# ────────────────────────────────────────────────────────────────────
+# ► 1. КОНСТАНТЫ
+# ────────────────────────────────────────────────────────────────────
+TG_GLOBAL_RATE     = float(os.getenv("TG_GLOBAL_RATE", 25))  # запросов в секунду на бота (у Telegram ~30, запас на неровную сеть)
+TG_CHAT_RATE       = float(os.getenv("TG_CHAT_RATE", 1))     # запросов в секунду в один чат
+TG_CHAT_BURST      = int(os.getenv("TG_CHAT_BURST", 3))      # короткий всплеск в один чат
+SEND_RETRIES       = 5
+BACKOFF_BASE       = 1.0     # секунд до первой повторной попытки
+BACKOFF_MAX        = 30.0    # потолок паузы между попытками
+BUCKET_PRUNE_EVERY = 60      # секунд между чистками бакетов неактивных чатов
+
+# Приоритеты: меньше — раньше
+PRIORITY_RESULT    = 0       # результат рендера и превью
+PRIORITY_PROMPT    = 1       # подсказки, меню, статусы
+PRIORITY_DELETE    = 2       # удаление служебных сообщений; лимит чата не расходует
+
+# ────────────────────────────────────────────────────────────────────
+# ► 2. ПОВТОРЫ
+# ────────────────────────────────────────────────────────────────────
+def retry_delay(attempt: int, error: Exception) -> Optional[float]:
+    """
+    Пауза перед следующей попыткой или None, если ошибку повторять бессмысленно.
+    429 ждет ровно retry_after от Telegram, сетевые ошибки и 5xx — экспоненту с джиттером.
+    """
+    if isinstance(error, ApiTelegramException):
+        if error.error_code == 429:
+            retry_after = error.result_json.get("parameters", {}).get("retry_after", 1)
+            return float(retry_after) + random.uniform(0, 0.5)
+        if error.error_code < 500:
+            return None
+    elif not isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, RequestTimeout)):
+        return None
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+
+async def with_retries(func: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+    """Вызывает метод Bot API с повторами, минуя очередь (скачивание файлов, getFile)."""
+    for attempt in range(1, SEND_RETRIES + 1):
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            delay = retry_delay(attempt, e)
+            if delay is None or attempt == SEND_RETRIES:
+                raise
+            logging.warning(
+                f"Ошибка запроса {getattr(func, '__name__', func)} (попытка {attempt}/{SEND_RETRIES}), "
+                f"повтор через {delay:.1f} с: {e}")
+            await asyncio.sleep(delay)
+
+
+def _is_rate_limited(error: Exception) -> bool:
+    return isinstance(error, ApiTelegramException) and error.error_code == 429
+
+# ────────────────────────────────────────────────────────────────────
+# ► 3. TOKEN BUCKET
+# ────────────────────────────────────────────────────────────────────
+class TokenBucket:
+    """Бакет на rate запросов в секунду с запасом capacity; время — time.monotonic()."""
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Сколько секунд ждать до следующего запроса (0 — можно сразу)."""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, until: float) -> None:
+        """Пауза до until (retry_after от Telegram)."""
+        self.blocked_until = max(self.blocked_until, until)
+
+    def blocked_for(self, now: float) -> float:
+        return max(0.0, self.blocked_until - now)
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+# ────────────────────────────────────────────────────────────────────
+# ► 4. ПЛАНИРОВЩИК
+# ────────────────────────────────────────────────────────────────────
+class _Request:
+    __slots__ = ("priority", "seq", "chat_id", "func", "args", "kwargs", "key", "waiters",
+                 "attempt", "not_before", "enqueued_at")
+
+    def __init__(self, priority: int, seq: int, chat_id: Optional[int], func: Callable[..., Awaitable[Any]],
+                 args: Tuple[Any, ...], kwargs: Dict[str, Any], key: Optional[Hashable]):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key          # ключ схлопывания: правки одного сообщения
+        self.waiters: List[asyncio.Future] = []
+        self.attempt = 1
+        self.not_before = 0.0   # пауза перед повтором после сетевой ошибки
+        self.enqueued_at = time.monotonic()
+
+    def resolve(self, result: Any = None, error: Optional[BaseException] = None) -> None:
+        for fut in self.waiters:
+            if fut.done():
+                continue
+            if error is None:
+                fut.set_result(result)
+            else:
+                fut.set_exception(error)
+
+
+def _spends_chat_limit(req: _Request) -> bool:
+    return req.priority < PRIORITY_DELETE
+
+
+# Схлопываются только правки одним методом: замена фото не должна
+# поглотить правку текста того же сообщения, и наоборот
+_EDIT_METHODS = ("edit_message_text", "edit_message_media")
+
+
+def _edit_key(method: str, chat_id: int, message_id: int) -> Tuple[str, int, int]:
+    return (method, chat_id, message_id)
+
+
+class Outbox:
+    """
+    Очередь исходящих запросов. Работает в цикле событий бота: start()
+    запускает диспетчер, который выбирает самый приоритетный запрос среди
+    тех, чей чат не упирается в лимит, и отправляет его отдельной задачей —
+    медленная загрузка фото не держит остальные чаты.
+    """
+
+    def __init__(self, bot: AsyncTeleBot, global_rate: float = TG_GLOBAL_RATE,
+                 chat_rate: float = TG_CHAT_RATE, chat_burst: int = TG_CHAT_BURST):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._queue: List[_Request] = []
+        self._by_key: Dict[Hashable, _Request] = {}
+        self._seq = 0
+        self._inflight: Set[asyncio.Task] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._last_prune = time.monotonic()
+
+    # ── Управление ─────────────────────────────────────────────────
+    def start(self) -> None:
+        """Запускает диспетчер в текущем цикле событий."""
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name="outbox")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        for req in self._queue:
+            req.resolve(error=asyncio.CancelledError())
+        self._queue.clear()
+        self._by_key.clear()
+
+    def depth(self) -> int:
+        return len(self._queue)
+
+    # ── Постановка запросов ────────────────────────────────────────
+    def submit(self, priority: int, chat_id: Optional[int], func: Callable[..., Awaitable[Any]],
+               *args: Any, coalesce_key: Optional[Hashable] = None, **kwargs: Any) -> asyncio.Future:
+        """
+        Ставит вызов func(*args, **kwargs) в очередь и возвращает future с его
+        результатом. Если в очереди уже ждет запрос с тем же coalesce_key,
+        он заменяется новым, а оба future получат результат последнего.
+        """
+        fut = asyncio.get_running_loop().create_future()
+        pending = self._by_key.get(coalesce_key) if coalesce_key is not None else None
+        if pending is not None:
+            pending.func, pending.args, pending.kwargs = func, args, kwargs
+            pending.priority = min(pending.priority, priority)
+            pending.waiters.append(fut)
+            METRICS.inc("tg_requests_total", "coalesced")
+            return fut
+
+        self._seq += 1
+        req = _Request(priority, self._seq, chat_id, func, args, kwargs, coalesce_key)
+        req.waiters.append(fut)
+        self._queue.append(req)
+        if coalesce_key is not None:
+            self._by_key[coalesce_key] = req
+        self._wakeup.set()
+        return fut
+
+    async def call(self, priority: int, chat_id: Optional[int], func: Callable[..., Awaitable[Any]],
+                   *args: Any, coalesce_key: Optional[Hashable] = None, **kwargs: Any) -> Any:
+        return await self.submit(priority, chat_id, func, *args, coalesce_key=coalesce_key, **kwargs)
+
+    # ── Методы Bot API ─────────────────────────────────────────────
+    async def send_message(self, chat_id: int, text: str, **kwargs: Any) -> Message:
+        return await self.call(PRIORITY_PROMPT, chat_id, self.bot.send_message, chat_id, text, **kwargs)
+
+    async def reply_to(self, message: Message, text: str, **kwargs: Any) -> Message:
+        return await self.call(PRIORITY_PROMPT, message.chat.id, self.bot.reply_to, message, text, **kwargs)
+
+    async def edit_message_text(self, text: str, chat_id: int, message_id: int, **kwargs: Any) -> Any:
+        return await self.call(PRIORITY_PROMPT, chat_id, self.bot.edit_message_text, text, chat_id, message_id,
+                               coalesce_key=_edit_key("edit_message_text", chat_id, message_id), **kwargs)
+
+    async def send_photo(self, chat_id: int, photo: Any, **kwargs: Any) -> Message:
+        return await self.call(PRIORITY_RESULT, chat_id, self.bot.send_photo, chat_id, photo, **kwargs)
+
+    async def send_document(self, chat_id: int, document: Any, **kwargs: Any) -> Message:
+        return await self.call(PRIORITY_RESULT, chat_id, self.bot.send_document, chat_id, document, **kwargs)
+
+    async def edit_message_media(self, media: Any, chat_id: int, message_id: int, **kwargs: Any) -> Any:
+        return await self.call(PRIORITY_RESULT, chat_id, self.bot.edit_message_media, media, chat_id, message_id,
+                               coalesce_key=_edit_key("edit_message_media", chat_id, message_id), **kwargs)
+
+    def delete_later(self, chat_id: int, message_id: int) -> None:
+        """
+        Удаляет сообщение в фоне с низшим приоритетом, ошибки только логируются.
+        Ждущие правки этого сообщения отбрасываются — они бы ушли впустую.
+        """
+        for method in _EDIT_METHODS:
+            pending = self._by_key.pop(_edit_key(method, chat_id, message_id), None)
+            if pending is not None:
+                self._queue.remove(pending)
+                pending.resolve(None)
+                METRICS.inc("tg_requests_total", "dropped")
+        fut = self.submit(PRIORITY_DELETE, chat_id, self.bot.delete_message, chat_id, message_id)
+        fut.add_done_callback(_log_background_error)
+
+    # ── Диспетчер ──────────────────────────────────────────────────
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _pick(self, now: float) -> Tuple[Optional[_Request], Optional[float]]:
+        """Запрос, который можно отправить сейчас, или (None, сколько ждать)."""
+        if not self._queue:
+            return None, None
+        global_wait = self._global.delay(now)
+        if global_wait > 0:
+            return None, global_wait
+        best, wait = None, None
+        for req in self._queue:
+            d = req.not_before - now
+            if req.chat_id is not None:
+                bucket = self._bucket(req.chat_id)
+                # Удаление не новое сообщение: лимит чата не тратит, но паузу после 429 соблюдает
+                d = max(d, bucket.delay(now) if _spends_chat_limit(req) else bucket.blocked_for(now))
+            if d <= 0:
+                if best is None or (req.priority, req.seq) < (best.priority, best.seq):
+                    best = req
+            elif wait is None or d < wait:
+                wait = d
+        return best, wait
+
+    def _prune(self, now: float) -> None:
+        if now - self._last_prune < BUCKET_PRUNE_EVERY:
+            return
+        self._last_prune = now
+        busy = {req.chat_id for req in self._queue}
+        for chat_id in [c for c, b in self._chats.items() if c not in busy and b.idle(now)]:
+            del self._chats[chat_id]
+
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            self._prune(now)
+            req, wait = self._pick(now)
+            if req is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._queue.remove(req)
+            if req.key is not None and self._by_key.get(req.key) is req:
+                del self._by_key[req.key]
+            self._global.take(now)
+            if req.chat_id is not None and _spends_chat_limit(req):
+                self._bucket(req.chat_id).take(now)
+            METRICS.observe("tg_send_wait", now - req.enqueued_at)
+            task = asyncio.create_task(self._execute(req))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _execute(self, req: _Request) -> None:
+        try:
+            result = await req.func(*req.args, **req.kwargs)
+        except Exception as e:
+            delay = retry_delay(req.attempt, e)
+            if delay is None or req.attempt >= SEND_RETRIES:
+                METRICS.inc("tg_requests_total", "error")
+                req.resolve(error=e)
+                return
+            self._requeue(req, e, delay)
+        else:
+            METRICS.inc("tg_requests_total", "ok")
+            req.resolve(result)
+
+    def _requeue(self, req: _Request, error: Exception, delay: float) -> None:
+        now = time.monotonic()
+        name = getattr(req.func, "__name__", req.func)
+        logging.warning(f"Ошибка запроса {name} (попытка {req.attempt}/{SEND_RETRIES}), "
+                        f"повтор через {delay:.1f} с: {error}")
+        req.attempt += 1
+        if _is_rate_limited(error):
+            # retry_after относится ко всему чату: следующие запросы в него тоже ждут
+            METRICS.inc("tg_requests_total", "rate_limited")
+            (self._bucket(req.chat_id) if req.chat_id is not None else self._global).block(now + delay)
+        else:
+            METRICS.inc("tg_requests_total", "retried")
+            req.not_before = now + delay
+        if req.key is not None:
+            newer = self._by_key.get(req.key)
+            if newer is not None:
+                # Пока запрос был в сети, пришла более свежая правка — повтор не нужен
+                newer.waiters.extend(req.waiters)
+                return
+            self._by_key[req.key] = req
+        self._queue.append(req)
+        self._wakeup.set()
+
+
+def _log_background_error(fut: asyncio.Future) -> None:
+    if not fut.cancelled() and fut.exception() is not None:
+        logging.debug(f"Фоновый запрос к Bot API не удался: {fut.exception()}")
@@ -0,0 +1,1329 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ядро рендера: анализ шаблонов и вставка фотографий в зеленые области.
+
+Модуль не зависит от Telegram и может импортироваться воркерами,
+утилитами и тестовыми скриптами без BOT_TOKEN.
+"""
+
+# ────────────────────────────────────────────────────────────────────
+# ► 0. ИМПОРТЫ
+# ────────────────────────────────────────────────────────────────────
+import io, os, json, math, mmap, random, warnings, logging, threading, time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Tuple, Optional, Union
+
+import numpy as np
+import cv2
+from PIL import Image, ImageFilter, ImageOps
+
+# ────────────────────────────────────────────────────────────────────
+# ► 1. НАСТРОЙКА PIL
+# ────────────────────────────────────────────────────────────────────
+Image.MAX_IMAGE_PIXELS = None
+warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+
+# ────────────────────────────────────────────────────────────────────
+# ► 2. КОНСТАНТЫ РЕНДЕРА
+# ────────────────────────────────────────────────────────────────────
+templates_dir      = "templates"
+filter_path        = "filter.png"
+OUT_DIM            = 2048
+scale_pixels       = 75
+upscale_factor     = 0.5
+SCALE_MONO         = 8
+min_shift, max_shift       = 2, 8
+min_rotation, max_rotation = 1, 3
+thickness, box_blur_radius = 25, 5
+MAX_PIXELS_TPL     = 80_000_000
+TG_PHOTO_LIMIT     = 10_485_760
+VALID_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+MIN_CONTOUR_AREA = 1000 # Минимальная площадь зеленой области для учета
+COMPOSITE_MODE     = os.getenv("COMPOSITE_MODE", "canvas")  # "canvas" | "roi" | "full"
+ROI_PAD            = 5     # радиус ядра LANCZOS4 + запас на округление, в пикселях монолита
+PERSP_STRETCH      = 8     # пикселей монолита, срезаемых слева и справа перед перспективой
+MONO_MODE          = os.getenv("MONO_MODE", "bounded")  # "bounded" | "classic"
+MONO_SUPERSAMPLE   = int(os.getenv("MONO_SUPERSAMPLE", 2))  # суперсэмплинг поворота в режиме "bounded"
+MONO_PIXEL_BUDGET  = int(os.getenv("MONO_PIXEL_BUDGET", 24_000_000))  # пикселей монолитов на задачу
+TEMPLATE_CACHE_MAX_BYTES = int(os.getenv("TEMPLATE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+GEOMETRY_CACHE_SIZE = 512  # шаблонов в кэше геометрии (без растров, десятки КБ на шаблон)
+FILTER_CACHE_MAX_BYTES = int(os.getenv("FILTER_CACHE_MAX_BYTES", 128 * 1024 * 1024))
+# Сколько кэша шаблонов заполнять прогревом при старте; остальное — под шаблоны по запросу
+PREWARM_MAX_BYTES  = int(os.getenv("PREWARM_MAX_BYTES", TEMPLATE_CACHE_MAX_BYTES // 2))
+OUTPUT_FORMAT      = os.getenv("OUTPUT_FORMAT", "jpeg").lower()  # "jpeg" | "webp" | "png"
+OUTPUT_QUALITY     = int(os.getenv("OUTPUT_QUALITY", 95))  # стартовое (максимальное) качество JPEG/WebP
+OUTPUT_MIN_QUALITY = 40    # ниже качество не опускаем, даже если не укладываемся в лимит
+OUTPUT_SIZE_MARGIN = 0.95  # цель поиска качества — доля от TG_PHOTO_LIMIT
+PROBE_REDUCE       = 4     # во сколько раз по каждой стороне уменьшать пробу для поиска качества
+MONO_CACHE_META    = "monoliths.json"  # описание сохраненных монолитов в каталоге кэша
+PREVIEW_SIZE       = int(os.getenv("PREVIEW_SIZE", 512))  # длинная сторона превью; 0 — без превью
+PREVIEW_SUPERSAMPLE = 2    # суперсэмплинг монолитов превью
+# Версия алгоритма рендера: повышать, если при тех же входах и сиде меняются байты результата
+RENDER_VERSION     = 1
+# Модель пиковой памяти задачи сверх простоя воркера (см. estimate_job_memory);
+# коэффициенты подобраны по замерам, сверять с логом «Память задачи»
+MEM_JOB_OVERHEAD   = 32 * 1024 * 1024  # буферы библиотек, арены аллокатора
+MEM_PER_CANVAS_PX  = 7     # холст RGBA + RGB-копия при кодировании
+MEM_PER_MONO_PX    = 12    # монолит, холст под фильтр и alpha_composite
+MEM_PER_PHOTO_BYTE = 3     # mmap файла + декодированный растр + копия
+MEM_COMPILE_PER_SRC_PX = 20  # декодирование шаблона, HSV и маски поиска контуров
+MEM_COMPILE_PER_BIG_PX = 8   # апскейл шаблона и его RGBA-растр
+LOW_MEMORY_SCALES  = (0.85, 0.7, 0.6, 0.5)  # масштабы результата, если задача не влезает в бюджет
+
+# ────────────────────────────────────────────────────────────────────
+# ► 3. ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
+# ────────────────────────────────────────────────────────────────────
+def order_corners(pts: np.ndarray) -> np.ndarray:
+    pts = np.asarray(pts, dtype="float32")
+    s = pts.sum(1)
+    diff = np.diff(pts, axis=1)
+    tl, br = pts[np.argmin(s)], pts[np.argmax(s)]
+    tr, bl = pts[np.argmin(diff)], pts[np.argmax(diff)]
+    return np.array([tl, tr, br, bl], dtype="float32")
+
+_encode_local = threading.local()
+
+
+def _encode(img: Image.Image, fmt: str, quality: int = OUTPUT_QUALITY) -> bytes:
+    """
+    Кодирует img в один и тот же буфер потока: память под вывод не
+    выделяется заново на каждый проход поиска качества.
+    """
+    buf = getattr(_encode_local, "buf", None)
+    if buf is None:
+        buf = _encode_local.buf = io.BytesIO()
+    buf.seek(0)
+    buf.truncate()
+    if fmt == "png":
+        img.save(buf, "PNG")
+    elif fmt == "webp":
+        img.save(buf, "WEBP", quality=quality, method=4)
+    else:
+        img.save(buf, "JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def _search_quality(rgb: Image.Image, fmt: str, q_hi: int, full_size: int, limit: int) -> int:
+    """
+    Двоичный поиск качества по уменьшенной пробе. Размер полного кадра
+    оценивается как размер пробы, умноженный на отношение полного размера
+    к размеру пробы при q_hi (оно уже известно после первого прохода).
+    """
+    probe = rgb.reduce(PROBE_REDUCE) if min(rgb.size) >= PROBE_REDUCE * 64 else rgb
+    ratio = full_size / max(1, len(_encode(probe, fmt, q_hi)))
+    target = limit * OUTPUT_SIZE_MARGIN
+    lo, hi, best = OUTPUT_MIN_QUALITY, q_hi - 1, OUTPUT_MIN_QUALITY
+    while lo <= hi:
+        q = (lo + hi) // 2
+        if len(_encode(probe, fmt, q)) * ratio <= target:
+            best, lo = q, q + 1
+        else:
+            hi = q - 1
+    return best
+
+
+def encode_result(img: Image.Image, fmt: Optional[str] = None, limit: int = TG_PHOTO_LIMIT) -> bytes:
+    """
+    Кодирует итог сразу в формат доставки (fmt, по умолчанию OUTPUT_FORMAT)
+    и укладывает его в limit байт.
+    Обычно это один полный проход; если кадр не влез — качество подбирается
+    по уменьшенной пробе и выполняется второй проход. PNG, не уложившийся
+    в лимит, перекодируется в JPEG тем же способом.
+    """
+    fmt = fmt or OUTPUT_FORMAT
+    if fmt == "png":
+        data = _encode(img, "png")
+        if len(data) <= limit:
+            return data
+        fmt = "jpeg"
+    rgb = img.convert("RGB")
+    q_hi = min(100, max(OUTPUT_MIN_QUALITY, OUTPUT_QUALITY))
+    data = _encode(rgb, fmt, q_hi)
+    if len(data) <= limit:
+        return data
+    q = _search_quality(rgb, fmt, q_hi, len(data), limit)
+    data = _encode(rgb, fmt, q)
+    # Оценка по пробе промахнулась — редкий случай, дожимаем шагами
+    while len(data) > limit and q > OUTPUT_MIN_QUALITY:
+        q = max(OUTPUT_MIN_QUALITY, q - 10)
+        data = _encode(rgb, fmt, q)
+    logging.debug(f"Результат {fmt} q={q}: {len(data)} байт (лимит {limit})")
+    return data
+
+_stage_local = threading.local()
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Замер длительности этапа рендера; пишется, только если включен collect_stages()."""
+    timings = getattr(_stage_local, "timings", None)
+    if timings is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - t0
+
+
+@contextmanager
+def collect_stages() -> Iterator[Dict[str, float]]:
+    """Собирает длительности этапов (в секундах) всех stage() в текущем потоке."""
+    prev = getattr(_stage_local, "timings", None)
+    timings: Dict[str, float] = {}
+    _stage_local.timings = timings
+    try:
+        yield timings
+    finally:
+        _stage_local.timings = prev
+
+
+def _reset_peak_rss() -> bool:
+    """Сбрасывает пик RSS процесса (VmHWM), чтобы измерить пик отдельной задачи."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _rss_bytes() -> int:
+    """Текущий RSS процесса в байтах (0, если /proc недоступен)."""
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _peak_rss_bytes() -> int:
+    """Пиковый RSS процесса в байтах: VmHWM из /proc, иначе ru_maxrss."""
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Linux: КБ
+
+
+# ────────────────────────────────────────────────────────────────────
+# ► 4. АНАЛИЗ ШАБЛОНОВ
+# ────────────────────────────────────────────────────────────────────
+
+def find_and_sort_green_areas(tpl_img: Image.Image) -> List[np.ndarray]:
+    """
+    Находит все зеленые области в шаблоне, фильтрует слишком маленькие
+    и сортирует их слева направо по X-координате центра.
+    """
+    tpl_rgba = tpl_img.convert("RGBA")
+    b, g, r, _ = np.asarray(tpl_rgba).transpose(2, 0, 1)
+    mask = ((g > 200) & (r < 100) & (b < 100)).astype(np.uint8) * 255
+
+    cnts, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    # Фильтруем контуры по минимальной площади
+    significant_contours = [
+        cnt for cnt in cnts if cv2.contourArea(cnt) > MIN_CONTOUR_AREA
+    ]
+
+    if not significant_contours:
+        return []
+
+    # Сортируем контуры по X-координате их ограничивающего прямоугольника
+    # Это гарантирует обработку слева направо
+    sorted_contours = sorted(significant_contours, key=lambda c: cv2.boundingRect(c)[0])
+    
+    return sorted_contours
+
+# ────────────────────────────────────────────────────────────────────
+# ► 5. КЭШ СКОМПИЛИРОВАННЫХ ШАБЛОНОВ
+# ────────────────────────────────────────────────────────────────────
+class CompiledArea:
+    """
+    План вставки одной зеленой области в координатах апскейленного шаблона:
+    все, что не зависит от случайного поворота и сдвига. Задаче остается
+    сдвинуть готовую матрицу (warp_matrix) или точку вставки (paste_position).
+    """
+    __slots__ = ("contour", "persp", "quad", "rect", "long_side", "short_side",
+                 "mono_size", "src_quad", "base_matrix", "center", "paste_angle")
+
+    def __init__(self, contour: np.ndarray, out_scale: float):
+        # Масштабируем контур в соответствии с апскейлом шаблона
+        self.contour = (contour * out_scale).astype(np.int32)
+
+        # 7.3 --- ПРОВЕРКА: 4-угольник или нет
+        peri = cv2.arcLength(self.contour, True)
+        approx = cv2.approxPolyDP(self.contour, 0.02 * peri, True)
+        self.persp = len(approx) == 4
+
+        # minAreaRect используется в обоих случаях: для 4-угольника он дает
+        # наиболее точные, неискаженные размеры «монолита», для остальных
+        # областей — еще и центр/угол вставки.
+        self.rect = cv2.minAreaRect(self.contour)
+        (_, _), (w0, h0), _ = self.rect
+        self.long_side, self.short_side = int(max(w0, h0)), int(min(w0, h0))
+
+        self.quad: Optional[np.ndarray] = None
+        if self.persp:
+            # Для вставки используем warpPerspective с точными углами 4-угольника.
+            quad = order_corners([p[0] for p in approx])
+            center = quad.mean(0, keepdims=True)
+            vecs = quad - center
+            lens = np.linalg.norm(vecs, 1, keepdims=True)
+            self.quad = quad + vecs / (lens + 1e-6) * scale_pixels * out_scale
+
+        # Размер монолита (W — короткая сторона, H — длинная) в масштабе SCALE_MONO
+        self.mono_size = (int((self.short_side + scale_pixels * out_scale) * upscale_factor) * SCALE_MONO,
+                          int((self.long_side + scale_pixels * out_scale) * upscale_factor) * SCALE_MONO)
+
+        self.src_quad: Optional[np.ndarray] = None
+        self.base_matrix: Optional[np.ndarray] = None
+        if self.persp:
+            # По просьбе пользователя, добавляем искусственное растягивание по горизонтали.
+            # Мы берем исходное изображение (монолит) и делаем вид, что оно на 16 пикселей уже,
+            # обрезая по PERSP_STRETCH пикселей слева и справа. Когда cv2.getPerspectiveTransform
+            # будет растягивать эту "узкую" версию до полного размера целевого
+            # четырехугольника (quad), изображение растянется.
+            w, h = self.mono_size[0] // SCALE_MONO, self.mono_size[1] // SCALE_MONO
+            self.src_quad = np.array([
+                [PERSP_STRETCH, 0], [w - PERSP_STRETCH, 0], [w - PERSP_STRETCH, h], [PERSP_STRETCH, h]
+            ], dtype="float32")
+            self.base_matrix = cv2.getPerspectiveTransform(self.src_quad, self.quad.astype("float32"))
+
+        # Вставка без перспективы: центр и угол minAreaRect
+        (cx, cy), (w_rect, h_rect), ang_rect = self.rect
+        self.center = (cx, cy)
+        self.paste_angle = -ang_rect if w_rect < h_rect else -ang_rect - 90
+
+    @property
+    def degenerate(self) -> bool:
+        return self.long_side == 0 or self.short_side == 0 or 0 in self.mono_size
+
+    def warp_matrix(self, dx: float, dy: float, scale: float = 1.0) -> np.ndarray:
+        """
+        Перспектива монолита со сдвигом (dx, dy): T·M. Для превью та же
+        проекция в координатах уменьшенного холста: S·T·M·S⁻¹.
+        """
+        M = self.base_matrix.copy()
+        M[0] += dx * M[2]
+        M[1] += dy * M[2]
+        if scale != 1.0:
+            M[:2] *= scale
+            M[:, :2] /= scale
+        return M
+
+    def paste_position(self, size: Tuple[int, int], dx: float, dy: float, scale: float = 1.0) -> Tuple[int, int]:
+        """Левый верхний угол повернутого монолита размера size со сдвигом (dx, dy)."""
+        cx, cy = self.center
+        return int((cx + dx) * scale - size[0] / 2), int((cy + dy) * scale - size[1] / 2)
+
+
+def _upscale_steps(size: Tuple[int, int]) -> Tuple[float, List[Tuple[int, int]]]:
+    """
+    Итоговый масштаб апскейла шаблона и размеры его шагов: до OUT_DIM по
+    длинной стороне, затем, если вышло больше MAX_PIXELS_TPL, уменьшение.
+    """
+    width, height = size
+    out_scale = OUT_DIM / max(size) if max(size) < OUT_DIM else 1.0
+    steps = [(int(width * out_scale), int(height * out_scale))]
+    if steps[0][0] * steps[0][1] > MAX_PIXELS_TPL:
+        factor = math.sqrt(MAX_PIXELS_TPL / (steps[0][0] * steps[0][1]))
+        steps.append((int(steps[0][0] * factor), int(steps[0][1] * factor)))
+        out_scale *= factor
+    return out_scale, steps
+
+
+class TemplateGeometry:
+    """
+    Геометрия шаблона без растров: размеры исходника и холста, контуры и
+    области. Ее хватает, чтобы посчитать фото и оценить память задачи, —
+    боту не нужно держать апскейленный растр.
+    """
+    __slots__ = ("path", "mtime_ns", "file_size", "size", "big_size", "out_scale", "contours", "areas")
+
+    def __init__(self, tpl_img: Image.Image, path: Optional[str] = None, mtime_ns: int = 0, file_size: int = 0):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.file_size = file_size
+        self.size = tpl_img.size
+        self.out_scale, steps = _upscale_steps(tpl_img.size)
+        self.big_size = steps[-1]
+        # Используем оригинальный, не масштабированный шаблон для поиска
+        with stage("contours"):
+            self.contours = find_and_sort_green_areas(tpl_img)
+            self.areas = [CompiledArea(cnt, self.out_scale) for cnt in self.contours]
+
+
+class CompiledTemplate:
+    """
+    Все, что можно посчитать по шаблону один раз: апскейленный RGBA-растр,
+    отсортированные контуры и геометрию областей. Исходное изображение нужно
+    только при компиляции — от него остаются размер и число каналов.
+    """
+
+    def __init__(self, tpl_img: Image.Image, path: Optional[str] = None,
+                 mtime_ns: int = 0, file_size: int = 0, geometry: Optional[TemplateGeometry] = None):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.file_size = file_size
+        self._previews: Dict[Tuple[int, int], Image.Image] = {}
+        tpl_img.load()
+        self.size = tpl_img.size
+        self.bands = len(tpl_img.getbands())
+
+        # 7.1 --- АПСКЕЙЛ ШАБЛОНА
+        with stage("template_upscale"):
+            out_scale, steps = _upscale_steps(tpl_img.size)
+            tpl_big = tpl_img
+            for step in steps:
+                tpl_big = tpl_big.resize(step, Image.LANCZOS)
+            self.out_scale = out_scale
+            self.tpl_big = tpl_big.convert("RGBA")
+
+        # 7.2 --- ПОИСК И СОРТИРОВКА ЗЕЛЕНЫХ ОБЛАСТЕЙ
+        # Геометрия уже посчитана (например, для оценки памяти) — контуры не ищем заново
+        if geometry is None:
+            geometry = TemplateGeometry(tpl_img, path, mtime_ns, file_size)
+        self.geometry = geometry
+        self.contours = geometry.contours
+        self.areas = geometry.areas
+
+    def preview_base(self, scale: float, cache: bool = True) -> Image.Image:
+        """
+        tpl_big, уменьшенный в scale раз, для превью; считается один раз на масштаб.
+        cache=False — для разовых уменьшенных рендеров, которые не стоит держать в памяти.
+        """
+        size = (max(1, round(self.tpl_big.width * scale)), max(1, round(self.tpl_big.height * scale)))
+        cached = self._previews.get(size)
+        if cached is None:
+            cached = self.tpl_big.resize(size, Image.LANCZOS)
+            if cache:
+                self._previews[size] = cached
+        return cached
+
+    @property
+    def nbytes(self) -> int:
+        """Примерный объем памяти, занимаемый растрами шаблона."""
+        return (self.tpl_big.width * self.tpl_big.height * 4
+                + sum(w * h * 4 for w, h in self._previews))
+
+
+_tpl_cache: "OrderedDict[str, CompiledTemplate]" = OrderedDict()
+_tpl_cache_lock = threading.Lock()
+# Блокировки компиляции — фиксированный набор по хэшу пути, а не по блокировке
+# на шаблон: словарь таких блокировок только рос бы. Два шаблона в одной
+# полосе компилируются по очереди — это редкость и лишь задержка
+TPL_BUILD_STRIPES = 16
+_tpl_build_locks = [threading.Lock() for _ in range(TPL_BUILD_STRIPES)]
+
+
+def get_compiled_template(tpl_path: str) -> CompiledTemplate:
+    """
+    Возвращает скомпилированный шаблон из кэша. Запись инвалидируется,
+    если у файла изменились mtime или размер; при превышении
+    TEMPLATE_CACHE_MAX_BYTES вытесняются давно не использованные шаблоны.
+    """
+    key = os.path.abspath(tpl_path)
+    st = os.stat(key)
+    build_lock = _tpl_build_locks[hash(key) % TPL_BUILD_STRIPES]
+
+    # Один поток компилирует шаблон, остальные ждут и берут готовый результат
+    with build_lock:
+        with _tpl_cache_lock:
+            cached = _tpl_cache.get(key)
+            if cached and cached.mtime_ns == st.st_mtime_ns and cached.file_size == st.st_size:
+                _tpl_cache.move_to_end(key)
+                return cached
+
+        with stage("template_load"), Image.open(key) as img:
+            tpl_img = img.copy()
+        compiled = CompiledTemplate(tpl_img, key, st.st_mtime_ns, st.st_size,
+                                    geometry=_cached_geometry(key, st))
+        _remember_geometry(compiled.geometry)
+        logging.debug(f"Шаблон скомпилирован: {key} areas={len(compiled.areas)}")
+
+        with _tpl_cache_lock:
+            _tpl_cache[key] = compiled
+            _tpl_cache.move_to_end(key)
+            total = sum(t.nbytes for t in _tpl_cache.values())
+            while total > TEMPLATE_CACHE_MAX_BYTES and len(_tpl_cache) > 1:
+                _, evicted = _tpl_cache.popitem(last=False)
+                total -= evicted.nbytes
+        return compiled
+
+
+_geometry_cache: "OrderedDict[str, TemplateGeometry]" = OrderedDict()
+
+
+def _cached_geometry(key: str, st: os.stat_result) -> Optional[TemplateGeometry]:
+    with _tpl_cache_lock:
+        geometry = _geometry_cache.get(key)
+        if geometry and geometry.mtime_ns == st.st_mtime_ns and geometry.file_size == st.st_size:
+            _geometry_cache.move_to_end(key)
+            return geometry
+    return None
+
+
+def _remember_geometry(geometry: TemplateGeometry) -> None:
+    with _tpl_cache_lock:
+        _geometry_cache[geometry.path] = geometry
+        _geometry_cache.move_to_end(geometry.path)
+        while len(_geometry_cache) > GEOMETRY_CACHE_SIZE:
+            _geometry_cache.popitem(last=False)
+
+
+def template_geometry(tpl_path: str) -> TemplateGeometry:
+    """
+    Геометрия шаблона из кэша (по пути, mtime и размеру файла). Без апскейла
+    и RGBA-растра: декодируется исходник и ищутся контуры, после чего растр
+    отпускается. Скомпилированный шаблон отдает свою геометрию без пересчета.
+    """
+    key = os.path.abspath(tpl_path)
+    st = os.stat(key)
+    geometry = _cached_geometry(key, st)
+    if geometry is not None:
+        return geometry
+    with _tpl_cache_lock:
+        compiled = _tpl_cache.get(key)
+    if compiled and compiled.mtime_ns == st.st_mtime_ns and compiled.file_size == st.st_size:
+        geometry = compiled.geometry
+    else:
+        with stage("template_load"):
+            img = Image.open(key)
+            img.load()
+        try:
+            geometry = TemplateGeometry(img, key, st.st_mtime_ns, st.st_size)
+        finally:
+            img.close()
+    _remember_geometry(geometry)
+    return geometry
+
+
+# Оверлей filter.png: исходник декодируется один раз (и заново при смене
+# mtime/размера файла), уменьшенные под монолиты копии лежат в LRU по размеру
+_filter_src: Optional[Image.Image] = None
+_filter_sig: Optional[Tuple[int, int]] = None
+_filter_resized: "OrderedDict[Tuple[int, int], Image.Image]" = OrderedDict()
+_filter_resized_bytes = 0
+_filter_lock = threading.Lock()
+
+
+def _load_filter_locked() -> Optional[Image.Image]:
+    global _filter_src, _filter_sig, _filter_resized_bytes
+    try:
+        st = os.stat(filter_path)
+    except OSError:
+        if _filter_src is not None:
+            logging.info(f"Фильтр {filter_path} удален, оверлей отключен")
+        _filter_src, _filter_sig = None, None
+        _filter_resized.clear()
+        _filter_resized_bytes = 0
+        return None
+    sig = (st.st_mtime_ns, st.st_size)
+    if sig != _filter_sig:
+        with Image.open(filter_path) as img:
+            _filter_src = img.convert("RGBA")
+        _filter_sig = sig
+        _filter_resized.clear()
+        _filter_resized_bytes = 0
+        logging.debug(f"Фильтр загружен: {filter_path} {_filter_src.size}")
+    return _filter_src
+
+
+def _filter_signature() -> Optional[Tuple[int, int]]:
+    """(mtime_ns, размер) текущего filter.png или None, если файла нет."""
+    with _filter_lock:
+        _load_filter_locked()
+        return _filter_sig
+
+
+def preload_filter() -> None:
+    """Декодирует filter.png заранее, чтобы первая задача не платила за загрузку."""
+    with _filter_lock:
+        _load_filter_locked()
+
+
+def get_filter_overlay(size: Tuple[int, int]) -> Optional[Image.Image]:
+    """
+    Оверлей filter.png, приведенный к size (LANCZOS), или None, если файла нет.
+    Возвращаемое изображение общее для всех вызовов — его нельзя менять.
+    """
+    global _filter_resized_bytes
+    with _filter_lock:
+        src = _load_filter_locked()
+        if src is None:
+            return None
+        cached = _filter_resized.get(size)
+        if cached is not None:
+            _filter_resized.move_to_end(size)
+            return cached
+
+    # Ресайз вне блокировки: потоки с другими размерами не ждут друг друга
+    resized = src.resize(size, Image.LANCZOS)
+    nbytes = size[0] * size[1] * 4
+    with _filter_lock:
+        if src is not _filter_src or nbytes > FILTER_CACHE_MAX_BYTES:
+            return resized  # файл успели заменить или кадр больше всего кэша
+        if size not in _filter_resized:
+            _filter_resized[size] = resized
+            _filter_resized_bytes += nbytes
+        while _filter_resized_bytes > FILTER_CACHE_MAX_BYTES:
+            (w, h), _ = _filter_resized.popitem(last=False)
+            _filter_resized_bytes -= w * h * 4
+    return resized
+
+
+# ────────────────────────────────────────────────────────────────────
+# ► 6. КОМПОЗИТИНГ В ОГРАНИЧИВАЮЩЕМ ПРЯМОУГОЛЬНИКЕ (ROI)
+# ────────────────────────────────────────────────────────────────────
+def _warp_roi(M: np.ndarray, src_size: Tuple[int, int],
+              canvas_size: Tuple[int, int]) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Ограничивающий прямоугольник (x0, y0, x1, y1) пикселей холста, которые
+    может задеть warpPerspective монолита. Исходный прямоугольник расширяется
+    на радиус ядра LANCZOS4, результат обрезается по границам холста.
+    """
+    w, h = src_size
+    pad = ROI_PAD
+    corners = np.array([[[-pad, -pad], [w + pad, -pad], [w + pad, h + pad], [-pad, h + pad]]],
+                       dtype=np.float64)
+    pts = cv2.perspectiveTransform(corners, M.astype(np.float64))[0]
+    x0 = max(int(math.floor(pts[:, 0].min())) - 1, 0)
+    y0 = max(int(math.floor(pts[:, 1].min())) - 1, 0)
+    x1 = min(int(math.ceil(pts[:, 0].max())) + 2, canvas_size[0])
+    y1 = min(int(math.ceil(pts[:, 1].max())) + 2, canvas_size[1])
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return x0, y0, x1, y1
+
+
+def _warp_blend_roi(res: Image.Image, mono: Image.Image, M: np.ndarray) -> None:
+    """
+    То же, что полноразмерный warpPerspective + смешивание по альфе,
+    но только внутри ROI. Меняет res на месте; результат попиксельно
+    совпадает с режимом COMPOSITE_MODE="full".
+    """
+    box = _warp_roi(M, mono.size, res.size)
+    if box is None:
+        return
+    x0, y0, x1, y1 = box
+    # Обратное преобразование считаем так же, как OpenCV внутри warpPerspective,
+    # и сдвигаем его на начало ROI — сетка выборки остается той же.
+    _, M_inv = cv2.invert(M.astype(np.float64))
+    M_inv[:, 2] += M_inv[:, 0] * x0 + M_inv[:, 1] * y0
+    warp = cv2.warpPerspective(
+        np.asarray(mono), M_inv, dsize=(x1 - x0, y1 - y0),
+        flags=cv2.INTER_LANCZOS4 | cv2.WARP_INVERSE_MAP,
+        borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0)
+    )
+    canvas = np.array(res.crop(box))
+    alpha = warp[:, :, 3:4] / 255.0
+    canvas[:, :, :3] = canvas[:, :, :3] * (1 - alpha) + warp[:, :, :3] * alpha
+    res.paste(Image.fromarray(canvas, "RGBA"), box)
+
+
+def _paste_composite_roi(res: Image.Image, mono_rot: Image.Image, paste_x: int, paste_y: int) -> None:
+    """
+    Аналог paste в прозрачный слой размера холста + alpha_composite,
+    выполненный только в пределах прямоугольника монолита. Меняет res на месте.
+    """
+    x0, y0 = max(paste_x, 0), max(paste_y, 0)
+    x1 = min(paste_x + mono_rot.width, res.width)
+    y1 = min(paste_y + mono_rot.height, res.height)
+    if x0 >= x1 or y0 >= y1:
+        return
+    layer = Image.new("RGBA", mono_rot.size, (0, 0, 0, 0))
+    layer.paste(mono_rot, (0, 0), mono_rot)
+    src_box = (x0 - paste_x, y0 - paste_y, x1 - paste_x, y1 - paste_y)
+    res.alpha_composite(layer, dest=(x0, y0), source=src_box)
+
+
+# Режим COMPOSITE_MODE="canvas": один uint8-массив HxWx4 от копии шаблона до
+# кодирования, смешивание в целых числах на месте, без cvtColor и слоев PIL.
+def _div255(x: np.ndarray) -> np.ndarray:
+    """floor(x / 255) для целых 0..65025 без деления (на месте, x — uint16/uint32)."""
+    t = x >> 8
+    t += x
+    t += 1
+    t >>= 8
+    return t
+
+
+def _blend_over(dst: np.ndarray, src: np.ndarray) -> None:
+    """dst.rgb = dst.rgb*(255-a)/255 + src.rgb*a/255, a — альфа src; альфа dst не меняется."""
+    a = src[:, :, 3:4].astype(np.uint16)
+    acc = src[:, :, :3] * a
+    a ^= 255  # 255 - a для 0..255
+    acc += dst[:, :, :3] * a
+    dst[:, :, :3] = _div255(acc)
+
+
+def _warp_blend_canvas(canvas: np.ndarray, mono: Image.Image, M: np.ndarray) -> None:
+    """_warp_blend_roi() для холста-массива: тот же варп, смешивание в uint16."""
+    box = _warp_roi(M, mono.size, (canvas.shape[1], canvas.shape[0]))
+    if box is None:
+        return
+    x0, y0, x1, y1 = box
+    _, M_inv = cv2.invert(M.astype(np.float64))
+    M_inv[:, 2] += M_inv[:, 0] * x0 + M_inv[:, 1] * y0
+    warp = cv2.warpPerspective(
+        np.asarray(mono), M_inv, dsize=(x1 - x0, y1 - y0),
+        flags=cv2.INTER_LANCZOS4 | cv2.WARP_INVERSE_MAP,
+        borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0)
+    )
+    _blend_over(canvas[y0:y1, x0:x1], warp)
+
+
+def _div255_round(v: np.ndarray) -> np.ndarray:
+    """DIV255 из PIL: v уже содержит +128, результат — round(x / 255). На месте."""
+    t = v >> 8
+    v += t
+    v >>= 8
+    return v
+
+
+def _paste_composite_canvas(canvas: np.ndarray, mono_rot: Image.Image, paste_x: int, paste_y: int) -> None:
+    """
+    _paste_composite_roi() для холста-массива. Повторяет целочисленную
+    арифметику PIL: paste по собственной альфе в прозрачный слой
+    (цвет и альфа умножаются на альфу) и затем alpha_composite.
+    """
+    h, w = canvas.shape[:2]
+    x0, y0 = max(paste_x, 0), max(paste_y, 0)
+    x1, y1 = min(paste_x + mono_rot.width, w), min(paste_y + mono_rot.height, h)
+    if x0 >= x1 or y0 >= y1:
+        return
+    src = np.asarray(mono_rot)[y0 - paste_y:y1 - paste_y, x0 - paste_x:x1 - paste_x]
+    dst = canvas[y0:y1, x0:x1]
+
+    # Слой после paste: v * a / 255 с округлением (Paste.c)
+    sa = src[:, :, 3:4].astype(np.uint16)
+    layer = src * sa
+    layer += 128
+    _div255_round(layer)
+    la = layer[:, :, 3:4]
+
+    if dst[:, :, 3].min() == 255:
+        # Непрозрачный холст (обычный случай): alpha_composite сводится к
+        # round((lc*la + dc*(255-la)) / 255), альфа остается 255. Все в uint16.
+        acc = layer[:, :, :3] * la
+        acc += dst[:, :, :3] * (255 - la)
+        acc += 128
+        dst[:, :, :3] = _div255_round(acc)
+        return
+
+    # Общий случай — alpha_composite (AlphaComposite.c), точность 7 бит
+    la = la.astype(np.int32)
+    da = dst[:, :, 3:4].astype(np.int32)
+    outa255 = la * 255 + da * (255 - la)
+    coef1 = la * (255 * 255 * 128) // np.maximum(outa255, 1)
+    coef2 = 255 * 128 - coef1
+    tmp = layer[:, :, :3] * coef1 + dst[:, :, :3] * coef2 + (0x80 << 7)
+    tmp += tmp >> 8
+    tmp >>= 15
+    out_a = outa255 + 0x80
+    out_a += out_a >> 8
+    out_a >>= 8
+    visible = la[:, :, 0] > 0
+    dst[:, :, :3][visible] = tmp[visible]
+    dst[:, :, 3:4][visible] = out_a[visible]
+
+
+# ────────────────────────────────────────────────────────────────────
+# ► 7. ПОСТРОЕНИЕ «МОНОЛИТА»
+# ────────────────────────────────────────────────────────────────────
+def _fill_crop_classic(user_img: Image.Image, W: int, H: int) -> Image.Image:
+    """Исходный вариант: апскейл фото в upscale_factor*SCALE_MONO раз, заполнение и обрезка W×H."""
+    usr_big = user_img.convert("RGBA").resize(
+        (int(user_img.width * upscale_factor * SCALE_MONO), int(user_img.height * upscale_factor * SCALE_MONO)),
+        Image.LANCZOS
+    )
+    sc_fill = max(W / usr_big.width, H / usr_big.height)
+    usr_fill = usr_big.resize(
+        (int(usr_big.width * sc_fill), int(usr_big.height * sc_fill)),
+        Image.BICUBIC if sc_fill > 1 else Image.LANCZOS
+    )
+    lft, top = (usr_fill.width - W) // 2, (usr_fill.height - H) // 2
+    return usr_fill.crop((lft, top, lft + W, top + H))
+
+
+def _fill_crop_bounded(user_img: Image.Image, W: int, H: int) -> Image.Image:
+    """
+    Заполнение и обрезка W×H за одну передискретизацию: сначала выбираем
+    центральный фрагмент исходника с пропорциями W:H, затем масштабируем
+    только его. Промежуточных растров крупнее W×H не создается.
+    """
+    sc_fill = max(W / user_img.width, H / user_img.height)
+    crop_w, crop_h = min(W / sc_fill, user_img.width), min(H / sc_fill, user_img.height)
+    lft, top = max(0.0, (user_img.width - crop_w) / 2), max(0.0, (user_img.height - crop_h) / 2)
+    img = user_img if user_img.mode in ("RGB", "RGBA") else user_img.convert("RGBA")
+    fitted = img.resize(
+        (W, H), Image.BICUBIC if sc_fill > 1 else Image.LANCZOS,
+        box=(lft, top, lft + crop_w, top + crop_h),
+        reducing_gap=None if sc_fill > 1 else 3.0
+    )
+    return fitted.convert("RGBA")
+
+
+def _rotation_matrix(w: int, h: int, angle: float) -> List[float]:
+    """Аффинная матрица поворота вокруг центра w×h — так же, как в Image.rotate."""
+    rad = -math.radians(angle % 360.0)
+    a, b = round(math.cos(rad), 15), round(math.sin(rad), 15)
+    cx, cy = w / 2, h / 2
+    return [a, b, -a * cx - b * cy + cx, -b, a, b * cx - a * cy + cy]
+
+
+def _rotated_size(w: int, h: int, angle: float) -> Tuple[int, int]:
+    """Размер холста, который дал бы Image.rotate(angle, expand=True) для w×h."""
+    a, b, c, d, e, f = _rotation_matrix(w, h, angle)
+    xx = [a * x + b * y + c for x, y in ((0, 0), (w, 0), (w, h), (0, h))]
+    yy = [d * x + e * y + f for x, y in ((0, 0), (w, 0), (w, h), (0, h))]
+    return (math.ceil(max(xx)) - math.floor(min(xx)),
+            math.ceil(max(yy)) - math.floor(min(yy)))
+
+
+def _rotate_to_size(img: Image.Image, angle: float, size: Tuple[int, int]) -> Image.Image:
+    """Поворот с центрированием результата на холсте заданного размера."""
+    w, h = img.size
+    a, b, c, d, e, f = _rotation_matrix(w, h, angle)
+    nw, nh = size
+    ox, oy = -(nw - w) / 2.0, -(nh - h) / 2.0
+    matrix = [a, b, a * ox + b * oy + c, d, e, d * ox + e * oy + f]
+    return img.transform(size, Image.AFFINE, matrix, Image.BICUBIC)
+
+
+def _fill_target(area: CompiledArea, area_budget: int, scale: float = 1.0) -> Tuple[int, int]:
+    """Размер, до которого фото заполняет и обрезается для монолита области."""
+    W, H = area.mono_size
+    if scale < 1.0:
+        ss = scale * PREVIEW_SUPERSAMPLE
+        return max(1, round(W // SCALE_MONO * ss)), max(1, round(H // SCALE_MONO * ss))
+    if MONO_MODE == "classic":
+        return W, H
+    ss = _mono_supersample(W // SCALE_MONO, H // SCALE_MONO, area_budget)
+    return W // SCALE_MONO * ss, H // SCALE_MONO * ss
+
+
+def _mono_supersample(w: int, h: int, pixel_budget: int) -> int:
+    """
+    Целый коэффициент суперсэмплинга для монолита итогового размера w×h:
+    не больше MONO_SUPERSAMPLE и такой, чтобы (w*ss)*(h*ss) укладывалось в бюджет.
+    """
+    if w <= 0 or h <= 0:
+        return 1
+    fit = int(math.sqrt(pixel_budget / (w * h)))
+    return max(1, min(MONO_SUPERSAMPLE, SCALE_MONO, fit))
+
+
+# ────────────────────────────────────────────────────────────────────
+# ► 8. ОСНОВНАЯ ОБРАБОТКА
+# ────────────────────────────────────────────────────────────────────
+# Монолит области: RGBA-растр в суперсэмплинге ss и сам коэффициент ss
+# (для превью ss дробный: масштаб превью, умноженный на PREVIEW_SUPERSAMPLE)
+Monolith = Tuple[Image.Image, float]
+# Случайные параметры вставки области: угол поворота и сдвиг (dx, dy)
+Jitter = Tuple[float, int, int]
+
+
+def new_seed() -> int:
+    """Случайный сид для новой вариации (кнопка «Сгенерировать снова»)."""
+    return random.SystemRandom().getrandbits(32)
+
+
+def draw_jitter(count: int, seed: Optional[int] = None) -> List[Jitter]:
+    """
+    Заранее выбирает поворот и сдвиг для count областей. Один и тот же
+    набор передается в превью и в полный рендер, чтобы они совпали.
+    При одном seed набор всегда один и тот же (None — случайный).
+    """
+    rng = random.Random(seed)
+    jitter = []
+    for _ in range(count):
+        angle = rng.choice([-1, 1]) * rng.uniform(min_rotation, max_rotation)
+        dx, dy = rng.choice([-1, 1]) * rng.randint(min_shift, max_shift), rng.choice([-1, 1]) * rng.randint(min_shift, max_shift)
+        jitter.append((angle, dx, dy))
+    return jitter
+
+
+def preview_scale(tpl: CompiledTemplate, size: int = PREVIEW_SIZE) -> float:
+    """Во сколько раз превью меньше полного результата (1.0 — шаблон и так не больше size)."""
+    return min(1.0, size / max(tpl.tpl_big.size))
+
+
+def build_monoliths(tpl: CompiledTemplate, user_imgs: List[Image.Image],
+                    scale: float = 1.0) -> List[Optional[Monolith]]:
+    """
+    Дорогая часть рендера без случайности: заполнение, обрезка и фильтр
+    для каждой области. None — область вырожденная и пропускается.
+    scale < 1 — монолиты для превью того же масштаба.
+    """
+    monos: List[Optional[Monolith]] = []
+    if not tpl.areas:
+        return monos
+
+    # Бюджет пикселей суперсэмплированных монолитов делится поровну между областями
+    area_budget = MONO_PIXEL_BUDGET // max(1, min(len(tpl.areas), len(user_imgs)))
+
+    # Итерируемся по отсортированным областям и предоставленным фото
+    # min(len(..)) для безопасности, если фото прислали меньше чем надо
+    for i in range(min(len(tpl.areas), len(user_imgs))):
+        area = tpl.areas[i]
+        user_img = user_imgs[i]
+
+        # 7.4 --- СОЗДАЕМ «МОНОЛИТ»
+        # H всегда будет длинной стороной, W - короткой. Это сохраняет консистентность.
+        W, H = area.mono_size
+        if area.degenerate:
+            monos.append(None) # Пропускаем вырожденные области
+            continue
+
+        with stage("monolith"):
+            if scale < 1.0:
+                ss = scale * PREVIEW_SUPERSAMPLE
+                cropped = _fill_crop_bounded(user_img, *_fill_target(area, area_budget, scale))
+            elif MONO_MODE == "classic":
+                ss = SCALE_MONO
+                cropped = _fill_crop_classic(user_img, W, H)
+            else:
+                # Тот же монолит, но в суперсэмплинге ss <= SCALE_MONO, ограниченном бюджетом
+                ss = _mono_supersample(W // SCALE_MONO, H // SCALE_MONO, area_budget)
+                cropped = _fill_crop_bounded(user_img, W // SCALE_MONO * ss, H // SCALE_MONO * ss)
+
+            mono = cropped # По умолчанию, если фильтра нет
+            filt = get_filter_overlay(cropped.size)
+            if filt is not None:
+                mono = Image.new("RGBA", filt.size, (0, 0, 0, 0))
+                mono.paste(cropped, (0, 0))
+                mono = Image.alpha_composite(mono, filt)
+        monos.append((mono, ss))
+    return monos
+
+
+def composite_monoliths(tpl: CompiledTemplate, monos: List[Optional[Monolith]],
+                        jitter: Optional[List[Jitter]] = None, scale: float = 1.0,
+                        seed: Optional[int] = None, fmt: Optional[str] = None) -> bytes:
+    """
+    Случайная часть рендера: поворот и сдвиг монолитов, вставка в шаблон,
+    размытие кромки и кодирование. Монолиты не меняются, поэтому один
+    набор можно рендерить повторно с новыми вариациями.
+
+    jitter -- заранее выбранные поворот и сдвиг (см. draw_jitter), иначе
+    выбираются здесь по seed. scale < 1 — превью или рендер с нехваткой памяти:
+    та же раскладка в уменьшенном холсте, монолиты из build_monoliths(..., scale).
+    fmt -- формат кодирования (см. encode_result); превью передает "jpeg".
+    """
+    # Копия, т.к. размытие кромки ниже меняет растр на месте. В режиме "canvas"
+    # копия одна — uint8-массив, который без преобразований доходит до кодирования
+    if scale >= 1.0:
+        base = tpl.tpl_big
+    else:
+        # В кэше шаблона держим только основания превью
+        base = tpl.preview_base(scale, cache=scale <= preview_scale(tpl))
+    use_canvas = COMPOSITE_MODE == "canvas"
+    if use_canvas:
+        canvas = np.array(base)
+    else:
+        res = base.copy()
+    if jitter is None:
+        jitter = draw_jitter(len(monos), seed)
+
+    if not tpl.areas:
+        with stage("encode"):
+            return encode_result(Image.fromarray(canvas, "RGBA") if use_canvas else res, fmt)
+
+    for i, entry in enumerate(monos):
+        if entry is None:
+            continue
+        mono, ss = entry
+        area = tpl.areas[i]
+        W, H = area.mono_size
+
+        angle, dx, dy = jitter[i]
+        with stage("rotate"):
+            if MONO_MODE == "classic" and scale >= 1.0:
+                mono = mono.rotate(angle, expand=True, resample=Image.BICUBIC)
+                mono = mono.resize((mono.width // SCALE_MONO, mono.height // SCALE_MONO), Image.LANCZOS)
+            else:
+                # Итоговый размер — как у классического поворота в SCALE_MONO,
+                # чтобы геометрия вставки не зависела от режима
+                fw, fh = (v // SCALE_MONO for v in _rotated_size(W, H, angle))
+                mono = _rotate_to_size(mono, angle, (round(fw * ss), round(fh * ss)))
+                mono = mono.resize((max(1, round(fw * scale)), max(1, round(fh * scale))), Image.LANCZOS)
+
+        # 7.5 --- ВСТАВКА «МОНОЛИТА»
+        with stage("composite"):
+            if area.persp:
+                M = area.warp_matrix(dx, dy, scale)
+                if use_canvas:
+                    _warp_blend_canvas(canvas, mono, M)
+                elif COMPOSITE_MODE == "roi":
+                    _warp_blend_roi(res, mono, M)
+                else:
+                    canvas_bgr = cv2.cvtColor(np.asarray(res), cv2.COLOR_RGBA2BGRA)
+                    mono_bgr = cv2.cvtColor(np.asarray(mono), cv2.COLOR_RGBA2BGRA)
+                    warp = cv2.warpPerspective(
+                        mono_bgr, M, dsize=res.size, flags=cv2.INTER_LANCZOS4,
+                        borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0)
+                    )
+                    alpha = warp[:, :, 3:4] / 255.0
+                    canvas_bgr[:, :, :3] = canvas_bgr[:, :, :3] * (1 - alpha) + warp[:, :, :3] * alpha
+                    res = Image.fromarray(cv2.cvtColor(canvas_bgr, cv2.COLOR_BGRA2RGBA), "RGBA")
+            else:
+                mono_rot = mono.rotate(area.paste_angle, expand=True, resample=Image.BICUBIC)
+                paste_x, paste_y = area.paste_position(mono_rot.size, dx, dy, scale)
+                if use_canvas:
+                    _paste_composite_canvas(canvas, mono_rot, paste_x, paste_y)
+                elif COMPOSITE_MODE == "roi":
+                    _paste_composite_roi(res, mono_rot, paste_x, paste_y)
+                else:
+                    layer = Image.new("RGBA", res.size, (0, 0, 0, 0))
+                    layer.paste(mono_rot, (paste_x, paste_y), mono_rot)
+                    res = Image.alpha_composite(res, layer)
+
+    # 7.6 --- РАЗМЫТИЕ ЛЕВОЙ КРОМКИ (применяется ко всему итоговому изображению)
+    with stage("edge_blur"):
+        edge = max(1, round(thickness * scale)) if thickness > 0 else 0
+        radius = max(1, round(box_blur_radius * scale)) if box_blur_radius > 0 else 0
+        if use_canvas:
+            if edge > 0 and radius > 0 and canvas.shape[1] >= edge:
+                strip = Image.fromarray(np.ascontiguousarray(canvas[:, :edge]), "RGBA")
+                canvas[:, :edge] = np.asarray(strip.filter(ImageFilter.BoxBlur(radius)))
+            # Изображение PIL поверх того же буфера, без копии
+            res = Image.fromarray(canvas, "RGBA")
+        elif edge > 0 and radius > 0 and res.width >= edge:
+            strip = res.crop((0, 0, edge, res.height))
+            res.paste(strip.filter(ImageFilter.BoxBlur(radius)), (0, 0))
+
+    # 7.7 --- ПАКОВКА
+    with stage("encode"):
+        return encode_result(res, fmt)
+
+
+def process_template_with_multiple_photos(tpl: Union[CompiledTemplate, Image.Image],
+                                          user_imgs: List[Image.Image]) -> bytes:
+    """
+    Основная функция обработки: берет зеленые области скомпилированного
+    шаблона и вставляет в них фото из списка user_imgs.
+    """
+    if isinstance(tpl, Image.Image):
+        tpl = CompiledTemplate(tpl)
+    return composite_monoliths(tpl, build_monoliths(tpl, user_imgs))
+
+
+# ────────────────────────────────────────────────────────────────────
+# ► 9. ПУБЛИЧНЫЙ API И ТОЧКА ВХОДА ДЛЯ ВОРКЕРОВ
+# ────────────────────────────────────────────────────────────────────
+def count_areas(tpl_path: str) -> int:
+    """Сколько фото нужно для шаблона (число зеленых областей); растры не строятся."""
+    return len(template_geometry(tpl_path).areas)
+
+
+def find_templates(root: str = templates_dir) -> List[str]:
+    """Все файлы шаблонов под root (любая глубина), в стабильном порядке."""
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            if fname.lower().endswith(VALID_IMAGE_EXTENSIONS):
+                found.append(os.path.join(dirpath, fname))
+    return found
+
+
+def prewarm_templates(paths: List[str], max_bytes: int = PREWARM_MAX_BYTES) -> Dict[str, Any]:
+    """
+    Заранее компилирует шаблоны в кэш процесса, чтобы первый рендер каждого
+    не платил за декодирование, апскейл и поиск контуров. Останавливается,
+    когда кэш занял max_bytes или начал вытеснять уже прогретые шаблоны.
+    """
+    t0 = time.perf_counter()
+    warmed: List[str] = []
+    failed = 0
+    for path in paths:
+        try:
+            get_compiled_template(path)
+        except Exception as e:
+            failed += 1
+            logging.warning(f"Прогрев: не удалось скомпилировать {path}: {e}")
+            continue
+        warmed.append(os.path.abspath(path))
+        with _tpl_cache_lock:
+            kept = [p for p in warmed if p in _tpl_cache]
+            cached_bytes = sum(t.nbytes for t in _tpl_cache.values())
+        if len(kept) < len(warmed) or cached_bytes >= max_bytes:
+            warmed = kept
+            break
+    return {
+        "pid": os.getpid(),
+        "templates": warmed,
+        "failed": failed,
+        "skipped": len(paths) - len(warmed) - failed,
+        "seconds": time.perf_counter() - t0,
+    }
+
+
+def cached_templates() -> Tuple[int, List[str]]:
+    """pid процесса и шаблоны в его кэше — движок так узнает, какие воркеры прогреты."""
+    with _tpl_cache_lock:
+        return os.getpid(), list(_tpl_cache)
+
+
+def render_files(tpl_path: str, photo_paths: List[str], seed: Optional[int] = None) -> bytes:
+    """
+    Рендер по путям к шаблону и фото; возвращает байты в формате OUTPUT_FORMAT.
+    С одним seed результат побайтно повторяется.
+    """
+    return render_job(tpl_path, list(photo_paths), seed=seed)
+
+
+def render_settings() -> Dict[str, Any]:
+    """
+    Настройки, от которых зависят байты результата при тех же шаблоне,
+    фото и сиде (часть ключа кэша результатов, см. result_cache.py).
+    Сам filter.png сюда не входит — он хэшируется по содержимому.
+    """
+    return {
+        "version": RENDER_VERSION,
+        "composite": COMPOSITE_MODE,
+        "mono": [MONO_MODE, MONO_SUPERSAMPLE, MONO_PIXEL_BUDGET, SCALE_MONO],
+        "jitter": [min_rotation, max_rotation, min_shift, max_shift],
+        "edge": [thickness, box_blur_radius],
+        "output": [OUTPUT_FORMAT, OUTPUT_QUALITY, OUTPUT_MIN_QUALITY, OUTPUT_SIZE_MARGIN, PROBE_REDUCE, TG_PHOTO_LIMIT],
+        "template": [OUT_DIM, scale_pixels, upscale_factor, MAX_PIXELS_TPL, MIN_CONTOUR_AREA],
+    }
+
+
+def result_extension(result: bytes) -> str:
+    """Расширение файла для результата рендера."""
+    if result.startswith(b"\x89PNG"):
+        return ".png"
+    if result[:4] == b"RIFF" and result[8:12] == b"WEBP":
+        return ".webp"
+    return ".jpg"
+
+
+def _open_photo(src: Union[bytes, str]) -> Image.Image:
+    """Декодирует фото из байтов или из файла; файл читается через mmap без копии в память."""
+    if isinstance(src, str):
+        with open(src, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                Image.open(mm) as img:
+            # Копия отвязывает растр от mmap, который закроется при выходе
+            return img.copy()
+    img = Image.open(io.BytesIO(src))
+    img.load()
+    return img
+
+
+def prepare_photo(payload: bytes, tpl_path: str) -> bytes:
+    """
+    Подготовка фото при получении: декодирует его сразу в уменьшенном виде
+    (для JPEG — draft-режим, масштабирование на этапе DCT), применяет
+    EXIF-ориентацию и возвращает несжатый TIFF размером не меньше нужного
+    самой крупной области шаблона. Время рендера и пик памяти после этого
+    не зависят от того, что прислал пользователь.
+    """
+    # Только геометрия: бот не компилирует шаблон и не держит его растр
+    areas = template_geometry(tpl_path).areas
+    area_budget = MONO_PIXEL_BUDGET // max(1, len(areas))
+    targets = [_fill_target(a, area_budget) for a in areas]
+
+    with Image.open(io.BytesIO(payload)) as img:
+        orientation = img.getexif().get(0x0112, 1)
+        # Размеры после поворота по EXIF: для 5–8 стороны меняются местами
+        ow, oh = (img.height, img.width) if orientation in (5, 6, 7, 8) else img.size
+        scale = max((max(tw / ow, th / oh) for tw, th in targets), default=1.0)
+        need_w, need_h = math.ceil(ow * min(1.0, scale)), math.ceil(oh * min(1.0, scale))
+        if scale < 1 and img.format == "JPEG":
+            draft_size = (need_h, need_w) if orientation in (5, 6, 7, 8) else (need_w, need_h)
+            img.draft(img.mode if img.mode in ("RGB", "L") else "RGB", draft_size)
+        img.load()
+        img = ImageOps.exif_transpose(img)
+
+    # Целое уменьшение до размера, не меньше нужного; точный ресайз — при рендере
+    factor = min(img.width // need_w, img.height // need_h)
+    if factor >= 2:
+        img = img.reduce(factor)
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "transparency" in img.info or img.mode in ("LA", "PA") else "RGB")
+
+    buf = io.BytesIO()
+    img.save(buf, "TIFF")
+    return buf.getvalue()
+
+
+def _mono_cache_key(tpl: CompiledTemplate, photos: List[str]) -> Dict[str, Any]:
+    """Все, от чего зависят монолиты: шаблон, фото, фильтр и настройки суперсэмплинга."""
+    return {
+        "template": tpl.path, "mtime_ns": tpl.mtime_ns, "size": tpl.file_size,
+        "photos": [os.path.basename(p) for p in photos],
+        "filter": list(_filter_signature() or ()),
+        "mono": [MONO_MODE, MONO_SUPERSAMPLE, MONO_PIXEL_BUDGET, SCALE_MONO],
+    }
+
+
+def _load_monoliths(mono_dir: str, key: Dict[str, Any]) -> Optional[List[Optional[Monolith]]]:
+    """Монолиты из каталога кэша или None, если их нет или они от других входных данных."""
+    try:
+        with open(os.path.join(mono_dir, MONO_CACHE_META), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("key") != key:
+            return None
+        return [None if m is None else (_open_photo(os.path.join(mono_dir, m["file"])), m["ss"])
+                for m in meta["monos"]]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _save_monoliths(mono_dir: str, key: Dict[str, Any], monos: List[Optional[Monolith]]) -> None:
+    """
+    Сохраняет монолиты несжатым TIFF (читается обратно через mmap).
+    Описание пишется последним, поэтому недописанный кэш не используется.
+    """
+    os.makedirs(mono_dir, exist_ok=True)
+    entries = []
+    for i, entry in enumerate(monos):
+        if entry is None:
+            entries.append(None)
+            continue
+        mono, ss = entry
+        name = f"mono_{i}.tif"
+        tmp_path = os.path.join(mono_dir, name + ".tmp")
+        mono.save(tmp_path, "TIFF")
+        os.replace(tmp_path, os.path.join(mono_dir, name))
+        entries.append({"file": name, "ss": ss})
+    tmp_path = os.path.join(mono_dir, MONO_CACHE_META + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"key": key, "monos": entries}, f)
+    os.replace(tmp_path, os.path.join(mono_dir, MONO_CACHE_META))
+
+
+def estimate_job_memory(tpl_path: str, photos: List[Union[bytes, str]], scale: float = 1.0,
+                        template_cached: bool = False) -> int:
+    """
+    Оценка пика памяти задачи в байтах сверх простоя воркера, до рендера:
+    по размерам шаблона, геометрии областей и объему фото. Пик — большее из
+    этапов: построение монолитов (фото + монолиты), вставка с кодированием
+    (холст + готовые монолиты) и, если шаблона может не быть в кэше воркера,
+    его компиляция — она идет до рендера, и ее буферы к тому времени освобождены.
+    """
+    tpl = template_geometry(tpl_path)
+    n = min(len(tpl.areas), len(photos))
+    area_budget = MONO_PIXEL_BUDGET // max(1, n)
+    mono_px = sum(w * h for w, h in (_fill_target(a, area_budget, scale) for a in tpl.areas[:n]))
+    photo_bytes = sum(len(p) if isinstance(p, bytes) else os.path.getsize(p) for p in photos)
+    canvas_px = round(tpl.big_size[0] * scale) * round(tpl.big_size[1] * scale)
+    # Уменьшенное основание не кэшируется: лишняя копия RGBA на время задачи
+    canvas_bytes = canvas_px * (MEM_PER_CANVAS_PX + (4 if scale < 1.0 else 0))
+
+    build = photo_bytes * MEM_PER_PHOTO_BYTE + mono_px * MEM_PER_MONO_PX
+    composite = canvas_bytes + mono_px * 4
+    compile_ = 0
+    if not template_cached:
+        compile_ = (tpl.size[0] * tpl.size[1] * MEM_COMPILE_PER_SRC_PX
+                    + tpl.big_size[0] * tpl.big_size[1] * MEM_COMPILE_PER_BIG_PX)
+    return MEM_JOB_OVERHEAD + max(build, composite, compile_)
+
+
+def fit_render_scale(tpl_path: str, photos: List[Union[bytes, str]], budget: int,
+                     template_cached: bool = False) -> Tuple[float, int]:
+    """
+    Наибольший масштаб из LOW_MEMORY_SCALES, при котором оценка задачи
+    укладывается в budget, и сама оценка. Если не влезает и самый мелкий
+    (например, мешает компиляция шаблона) — возвращается он, и задачу
+    стоит запускать в одиночку.
+    """
+    estimate = 0
+    for scale in LOW_MEMORY_SCALES:
+        estimate = estimate_job_memory(tpl_path, photos, scale, template_cached)
+        if estimate <= budget:
+            return scale, estimate
+    return LOW_MEMORY_SCALES[-1], estimate
+
+
+def render_job(tpl_path: str, photos: List[Union[bytes, str]], mono_dir: Optional[str] = None,
+               jitter: Optional[List[Jitter]] = None, scale: float = 1.0, seed: Optional[int] = None) -> bytes:
+    """
+    Рендер одной задачи по пути к шаблону и фото (байты или пути к файлам).
+    Вызывается в процессах пула, поэтому принимает и возвращает только простые типы.
+
+    mono_dir -- каталог кэша монолитов: если в нем лежат монолиты для тех же
+    шаблона и фото, заново выполняются только поворот, сдвиг и вставка;
+    иначе собранные монолиты сохраняются туда для следующих вариаций.
+    jitter -- поворот и сдвиг областей, если они выбраны заранее (см. draw_jitter);
+    иначе они выбираются по seed, а без него случайно.
+    scale -- масштаб результата меньше 1, если задаче не хватает памяти
+    (см. fit_render_scale); такие монолиты не кэшируются.
+    """
+    compiled_tpl = get_compiled_template(tpl_path)
+    key, monos = None, None
+    if mono_dir and scale >= 1.0 and all(isinstance(p, str) for p in photos):
+        key = _mono_cache_key(compiled_tpl, photos)
+        with stage("mono_load"):
+            monos = _load_monoliths(mono_dir, key)
+
+    if monos is None:
+        with stage("photo_decode"):
+            user_imgs = [_open_photo(p) for p in photos]
+        try:
+            monos = build_monoliths(compiled_tpl, user_imgs, scale)
+        finally:
+            for img in user_imgs: img.close()
+        if key is not None:
+            with stage("mono_save"):
+                try:
+                    _save_monoliths(mono_dir, key, monos)
+                except OSError as e:
+                    logging.warning(f"Не удалось сохранить монолиты в {mono_dir}: {e}")
+
+    return composite_monoliths(compiled_tpl, monos, jitter, scale, seed)
+
+
+def render_preview(tpl_path: str, photos: List[Union[bytes, str]], jitter: List[Jitter],
+                   size: int = PREVIEW_SIZE) -> bytes:
+    """
+    Превью задачи: та же раскладка и тот же jitter, что у полного рендера,
+    но холст с длинной стороной size и монолиты в том же масштабе. JPEG.
+    """
+    compiled_tpl = get_compiled_template(tpl_path)
+    scale = preview_scale(compiled_tpl, size)
+    with stage("photo_decode"):
+        user_imgs = [_open_photo(p) for p in photos]
+    try:
+        monos = build_monoliths(compiled_tpl, user_imgs, scale)
+    finally:
+        for img in user_imgs: img.close()
+    # Превью всегда JPEG: оно маленькое и уходит обычным фото
+    return composite_monoliths(compiled_tpl, monos, jitter, scale, fmt="jpeg")
+
+
+def render_job_with_stats(tpl_path: str, photos: List[Union[bytes, str]], mono_dir: Optional[str] = None,
+                          jitter: Optional[List[Jitter]] = None, scale: float = 1.0) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    render_job() с замерами: {"stages": {этап: секунды}, "render_total": секунды,
+    "peak_rss_bytes": пиковый RSS воркера за время задачи, "job_rss_bytes": прирост
+    пика над RSS до задачи (сравнивается с estimate_job_memory), "pid": воркер,
+    "template_compiled": шаблон компилировался в этой задаче}.
+    """
+    _reset_peak_rss()
+    rss_before = _rss_bytes()
+    t0 = time.perf_counter()
+    with collect_stages() as timings:
+        result = render_job(tpl_path, photos, mono_dir, jitter, scale)
+    peak = _peak_rss_bytes()
+    return result, {
+        "stages": dict(timings),
+        "render_total": time.perf_counter() - t0,
+        "peak_rss_bytes": peak,
+        "job_rss_bytes": max(0, peak - rss_before),
+        "pid": os.getpid(),
+        "template_compiled": "contours" in timings,
+    }
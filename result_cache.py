@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Кэш готовых результатов рендера на диске, адресуемый по содержимому.
+
+Ключ — хэш от содержимого шаблона, фото и filter.png, сида и настроек
+рендера (render.render_settings), поэтому повтор тех же входов отдается
+без рендера, а любое изменение входа дает другой ключ. Размер каталога
+ограничен, вытесняются давно не читанные результаты (LRU).
+"""
+
+# ────────────────────────────────────────────────────────────────────
+# ► 0. ИМПОРТЫ
+# ────────────────────────────────────────────────────────────────────
+import os, json, hashlib, logging, threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import render
+from metrics import METRICS
+
+# ────────────────────────────────────────────────────────────────────
+# ► 1. КОНСТАНТЫ
+# ────────────────────────────────────────────────────────────────────
+RESULT_CACHE_DIR       = os.getenv("RESULT_CACHE_DIR", "data/results")
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 1024 * 1024 * 1024))  # 0 — кэш выключен
+DIGEST_MEMO_SIZE       = 512       # хэшей файлов в памяти (по пути, mtime и размеру)
+HASH_CHUNK             = 1 << 20
+
+# ────────────────────────────────────────────────────────────────────
+# ► 2. ХЭШИ ВХОДОВ
+# ────────────────────────────────────────────────────────────────────
+_digests: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+_digests_lock = threading.Lock()
+
+
+def file_digest(path: str) -> str:
+    """
+    SHA-256 содержимого файла. Результат запоминается по (путь, mtime, размер),
+    так что повторная генерация на тех же фото файлы не перечитывает.
+    """
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    with _digests_lock:
+        digest = _digests.get(memo_key)
+        if digest is not None:
+            _digests.move_to_end(memo_key)
+            return digest
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _digests_lock:
+        _digests[memo_key] = digest
+        while len(_digests) > DIGEST_MEMO_SIZE:
+            _digests.popitem(last=False)
+    return digest
+
+
+def inputs_digest(tpl_path: str, photos: List[str]) -> str:
+    """Хэш всего, что подается на вход рендера, кроме сида."""
+    filter_digest = file_digest(render.filter_path) if os.path.exists(render.filter_path) else None
+    payload = {
+        "template": file_digest(tpl_path),
+        "photos": [file_digest(p) for p in photos],
+        "filter": filter_digest,
+        "settings": render.render_settings(),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def content_seed(digest: str) -> int:
+    """Сид, выведенный из входов: те же шаблон и фото — та же раскладка."""
+    return int(digest[:8], 16)
+
+
+def job_key(tpl_path: str, photos: List[str], seed: Optional[int] = None) -> Tuple[str, int]:
+    """
+    Ключ результата и сид задачи. Без seed сид выводится из содержимого
+    входов, поэтому повтор тех же шаблона и фото попадает в кэш.
+    """
+    digest = inputs_digest(tpl_path, photos)
+    if seed is None:
+        seed = content_seed(digest)
+    return hashlib.sha256(f"{digest}:{seed}".encode("ascii")).hexdigest(), seed
+
+# ────────────────────────────────────────────────────────────────────
+# ► 3. КЭШ
+# ────────────────────────────────────────────────────────────────────
+class ResultCache:
+    """
+    Результаты лежат файлами root/<первые 2 символа ключа>/<ключ>. Порядок
+    LRU — в памяти; при чтении у файла обновляется mtime, поэтому после
+    рестарта порядок восстанавливается сканированием каталога.
+    """
+
+    def __init__(self, root: str = RESULT_CACHE_DIR, max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # ключ → размер, от старых к свежим
+        self._total = 0
+        if self.enabled:
+            os.makedirs(root, exist_ok=True)
+            self._scan()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def _scan(self) -> None:
+        found = []
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".tmp"):
+                    os.remove(entry.path)  # недописанный результат аварийного завершения
+                    continue
+                st = entry.stat()
+                found.append((st.st_mtime_ns, entry.name, st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total += size
+        with self._lock:
+            evicted = self._evict_locked()
+        logging.info(f"Кэш результатов: {len(self._entries)} файлов, {self._total >> 20} МБ "
+                     f"(предел {self.max_bytes >> 20} МБ, вытеснено {evicted})")
+
+    def _evict_locked(self) -> int:
+        evicted = 0
+        while self._total > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total -= size
+            evicted += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+        if evicted:
+            METRICS.inc("result_cache_total", "evicted", evicted)
+        return evicted
+
+    # ── Чтение и запись ────────────────────────────────────────────
+    def get(self, key: str) -> Optional[bytes]:
+        """Результат по ключу или None."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            if key not in self._entries:
+                METRICS.inc("result_cache_total", "miss")
+                return None
+            self._entries.move_to_end(key)
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            # Файл удалили снаружи или вытеснили между проверкой и чтением
+            with self._lock:
+                size = self._entries.pop(key, None)
+                if size is not None:
+                    self._total -= size
+            METRICS.inc("result_cache_total", "miss")
+            return None
+        METRICS.inc("result_cache_total", "hit")
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        """Сохраняет результат; ошибки диска только логируются — кэш не обязателен."""
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Не удалось сохранить результат в кэш {path}: {e}")
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total -= old
+            self._entries[key] = len(data)
+            self._total += len(data)
+            self._evict_locked()
+        METRICS.inc("result_cache_total", "stored")
+
+    def size_bytes(self) -> int:
+        with self._lock:
+            return self._total
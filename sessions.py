@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Хранилище сессий пользователей: SQLite (WAL) на смонтированном томе.
+
+Состояние диалога хранится в таблице как JSON, фото — отдельными файлами
+в каталоге чата, в базе только их имена. Сессии переживают перезапуск
+контейнера, брошенные на полпути удаляются по TTL.
+"""
+
+# ────────────────────────────────────────────────────────────────────
+# ► 0. ИМПОРТЫ
+# ────────────────────────────────────────────────────────────────────
+import os, json, time, uuid, shutil, sqlite3, logging, threading
+from typing import Any, Container, Dict, List, Optional
+
+# ────────────────────────────────────────────────────────────────────
+# ► 1. КОНСТАНТЫ
+# ────────────────────────────────────────────────────────────────────
+SESSION_DIR        = os.getenv("SESSION_DIR", "data/sessions")
+SESSION_TTL        = int(os.getenv("SESSION_TTL", 24 * 3600))  # секунд без активности
+REGEN_TTL          = int(os.getenv("REGEN_TTL", 30 * 60))  # сколько хранить фото после готового результата
+SWEEP_INTERVAL     = 600   # секунд между проходами очистки
+
+# ────────────────────────────────────────────────────────────────────
+# ► 2. ХРАНИЛИЩЕ
+# ────────────────────────────────────────────────────────────────────
+class SessionStore:
+    """
+    Потокобезопасное хранилище сессий. Все изменения одной сессии идут
+    под общей блокировкой в одной транзакции, поэтому параллельные
+    хендлеры telebot не теряют фото и не затирают состояние друг друга.
+    """
+
+    def __init__(self, root: str = SESSION_DIR, ttl: int = SESSION_TTL, regen_ttl: int = REGEN_TTL):
+        self.root = root
+        self.ttl = ttl
+        self.regen_ttl = regen_ttl
+        self.photos_root = os.path.join(root, "photos")
+        os.makedirs(self.photos_root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(root, "sessions.db"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " chat_id INTEGER PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self._sweeper: Optional[threading.Thread] = None
+
+    # ── Внутреннее ─────────────────────────────────────────────────
+    def _chat_dir(self, chat_id: int) -> str:
+        return os.path.join(self.photos_root, str(chat_id))
+
+    def _read_locked(self, chat_id: int) -> Dict[str, Any]:
+        row = self._conn.execute("SELECT data FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def _write_locked(self, chat_id: int, data: Dict[str, Any]) -> None:
+        self._conn.execute(
+            "INSERT INTO sessions (chat_id, data, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            (chat_id, json.dumps(data, ensure_ascii=False), time.time())
+        )
+
+    # ── Состояние ──────────────────────────────────────────────────
+    def get(self, chat_id: int) -> Dict[str, Any]:
+        """Копия состояния сессии ({} — сессии нет)."""
+        with self._lock:
+            return self._read_locked(chat_id)
+
+    def update(self, chat_id: int, **fields: Any) -> Dict[str, Any]:
+        """Дописывает поля в состояние сессии и возвращает новое состояние."""
+        with self._lock, self._conn:
+            data = self._read_locked(chat_id)
+            data.update(fields)
+            self._write_locked(chat_id, data)
+            return data
+
+    def reset(self, chat_id: int, data: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Заменяет состояние на data (по умолчанию пустое) и удаляет фото чата.
+        Удаление каталога может быть долгим — из цикла событий через asyncio.to_thread.
+        """
+        with self._lock, self._conn:
+            self._write_locked(chat_id, dict(data or {}))
+            shutil.rmtree(self._chat_dir(chat_id), ignore_errors=True)
+
+    def compare_and_set_state(self, chat_id: int, expected: str, new: str) -> bool:
+        """Атомарно переводит поле state из expected в new; False — состояние уже другое."""
+        with self._lock, self._conn:
+            data = self._read_locked(chat_id)
+            if data.get("state") != expected:
+                return False
+            data["state"] = new
+            self._write_locked(chat_id, data)
+            return True
+
+    # ── Фото ───────────────────────────────────────────────────────
+    def add_photo(self, chat_id: int, payload: bytes, ext: str = ".img") -> int:
+        """
+        Сохраняет фото файлом в каталоге чата и добавляет его в сессию.
+        Возвращает число фото в сессии после добавления.
+        """
+        chat_dir = self._chat_dir(chat_id)
+        os.makedirs(chat_dir, exist_ok=True)
+        name = uuid.uuid4().hex + ext
+        tmp_path = os.path.join(chat_dir, name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, os.path.join(chat_dir, name))
+        with self._lock, self._conn:
+            data = self._read_locked(chat_id)
+            photos = data.setdefault("photos", [])
+            photos.append(name)
+            self._write_locked(chat_id, data)
+            return len(photos)
+
+    def photo_paths(self, chat_id: int) -> List[str]:
+        """Абсолютные пути к фото сессии в порядке получения."""
+        chat_dir = os.path.abspath(self._chat_dir(chat_id))
+        return [os.path.join(chat_dir, name) for name in self.get(chat_id).get("photos", [])]
+
+    def mono_dir(self, chat_id: int) -> str:
+        """Каталог кэша монолитов чата; удаляется вместе с фото."""
+        return os.path.abspath(os.path.join(self._chat_dir(chat_id), "mono"))
+
+    # ── Очистка ────────────────────────────────────────────────────
+    def evict_expired(self) -> int:
+        """
+        Удаляет сессии без активности дольше ttl вместе с их фото,
+        а у готовых (state «done») — фото старше regen_ttl.
+        """
+        now = time.time()
+        deadline = now - self.ttl
+        with self._lock, self._conn:
+            # Выборка и сброс под одной блокировкой: сессия не успеет уйти в рендер
+            done = [r[0] for r in self._conn.execute(
+                "SELECT chat_id, data FROM sessions WHERE updated_at < ?", (now - self.regen_ttl,))
+                if json.loads(r[1]).get("state") == "done"]
+            for chat_id in done:
+                self._write_locked(chat_id, {})
+                shutil.rmtree(self._chat_dir(chat_id), ignore_errors=True)
+        with self._lock, self._conn:
+            expired = [r[0] for r in self._conn.execute(
+                "SELECT chat_id FROM sessions WHERE updated_at < ?", (deadline,))]
+            self._conn.execute("DELETE FROM sessions WHERE updated_at < ?", (deadline,))
+            # Пустые сессии (после /start или готового результата) места не занимают,
+            # но и хранить их незачем
+            self._conn.execute("DELETE FROM sessions WHERE data = '{}'")
+            for chat_id in expired:
+                shutil.rmtree(self._chat_dir(chat_id), ignore_errors=True)
+            # Каталоги фото без сессии — остатки аварийного завершения
+            known = {str(r[0]) for r in self._conn.execute("SELECT chat_id FROM sessions")}
+        for name in os.listdir(self.photos_root):
+            path = os.path.join(self.photos_root, name)
+            if name not in known and os.path.getmtime(path) < deadline:
+                shutil.rmtree(path, ignore_errors=True)
+        if expired:
+            logging.info(f"Удалено просроченных сессий: {len(expired)}")
+        return len(expired)
+
+    def reset_state(self, state: str, keep: Container[int] = ()) -> int:
+        """
+        Сбрасывает все сессии в состоянии state (например, «rendering» после
+        рестарта), кроме чатов из keep.
+        """
+        with self._lock, self._conn:
+            # Выборка и сброс под одной блокировкой: сессия не успеет выйти из state
+            # (например, рендер закончится и выставит «done») и не потеряет фото
+            chat_ids = [r[0] for r in self._conn.execute("SELECT chat_id, data FROM sessions").fetchall()
+                        if json.loads(r[1]).get("state") == state and r[0] not in keep]
+            for chat_id in chat_ids:
+                self._write_locked(chat_id, {})
+                shutil.rmtree(self._chat_dir(chat_id), ignore_errors=True)
+        return len(chat_ids)
+
+    def start_sweeper(self, interval: int = SWEEP_INTERVAL) -> None:
+        """Фоновый поток, периодически вызывающий evict_expired()."""
+        def loop():
+            while True:
+                try:
+                    self.evict_expired()
+                except Exception:
+                    logging.exception("Ошибка очистки сессий")
+                time.sleep(interval)
+
+        self._sweeper = threading.Thread(target=loop, name="session-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
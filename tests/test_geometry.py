@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Перспектива монолита: CompiledArea.base_matrix и warp_matrix."""
+import cv2
+import numpy as np
+import pytest
+
+import render
+
+# Прямоугольная зеленая область 300×600 с левым верхним углом в (100, 200)
+RECT = np.array([[[100, 200]], [[400, 200]], [[400, 800]], [[100, 800]]], dtype=np.int32)
+# Углы вставки: прямоугольник, раздвинутый от центра на scale_pixels (см. CompiledArea)
+QUAD_BBOX = (90.625, 181.25, 409.375, 818.75)
+
+
+@pytest.fixture
+def area() -> render.CompiledArea:
+    a = render.CompiledArea(RECT, 1.0)
+    assert a.persp
+    return a
+
+
+def _project(matrix: np.ndarray, pts: np.ndarray) -> np.ndarray:
+    return cv2.perspectiveTransform(pts.reshape(-1, 1, 2).astype("float64"), matrix).reshape(-1, 2)
+
+
+def _bbox(pts: np.ndarray):
+    return (*pts.min(0), *pts.max(0))
+
+
+def test_warp_matrix_without_shift_is_base_matrix(area):
+    m = area.warp_matrix(0, 0, 1.0)
+    np.testing.assert_array_equal(m, area.base_matrix)
+    assert m is not area.base_matrix  # задача не должна портить общий план
+
+
+def test_corners_map_to_quad(area):
+    corners = _project(area.base_matrix, area.src_quad)
+    np.testing.assert_allclose(corners, area.quad, atol=1e-3)
+    np.testing.assert_allclose(_bbox(corners), QUAD_BBOX, atol=1e-3)
+
+
+def test_shift_moves_corners(area):
+    dx, dy = 5, -7
+    corners = _project(area.warp_matrix(dx, dy), area.src_quad)
+    x0, y0, x1, y1 = QUAD_BBOX
+    np.testing.assert_allclose(_bbox(corners), (x0 + dx, y0 + dy, x1 + dx, y1 + dy), atol=1e-3)
+
+
+def test_preview_scale(area):
+    dx, dy, scale = 3, 4, 0.25
+    corners = _project(area.warp_matrix(dx, dy, scale), area.src_quad * scale)
+    np.testing.assert_allclose(corners, (area.quad + (dx, dy)) * scale, atol=1e-3)
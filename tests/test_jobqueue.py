@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+"""Отметки воркеров в очереди задач: health-check контейнера видит только свой хост."""
+from jobqueue import JobQueue
+
+
+def test_worker_seen_matches_exact_host(tmp_path):
+    queue = JobQueue(str(tmp_path))
+    try:
+        queue.worker_beat("host-foo-12", True, 0, None)
+        queue.worker_beat("h_st-7", True, 0, None)
+        assert queue.worker_seen("host") is None      # отметка соседнего хоста «host-foo»
+        assert queue.worker_seen("h%st") is None      # % и _ не шаблоны
+        assert queue.worker_seen("hXst") is None
+        assert queue.worker_seen("host-foo") is not None
+        assert queue.worker_seen("h_st") is not None
+    finally:
+        queue.close()
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""Формат результата: OUTPUT_FORMAT для полного рендера, JPEG только для превью."""
+import io
+
+from PIL import Image
+
+import render
+
+
+def _template(tmp_path) -> str:
+    tpl = Image.new("RGB", (400, 300), (255, 255, 255))
+    tpl.paste((0, 255, 0), (50, 50, 200, 250))
+    path = str(tmp_path / "tpl.png")
+    tpl.save(path)
+    return path
+
+
+def _photo() -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (600, 450), (200, 100, 50)).save(buf, "JPEG")
+    return buf.getvalue()
+
+
+def _format(data: bytes) -> str:
+    with Image.open(io.BytesIO(data)) as img:
+        return img.format
+
+
+def test_reduced_render_keeps_output_format(tmp_path, monkeypatch):
+    monkeypatch.setattr(render, "OUTPUT_FORMAT", "png")
+    tpl_path = _template(tmp_path)
+    jitter = render.draw_jitter(1, 1)
+    assert _format(render.render_job(tpl_path, [_photo()], jitter=jitter)) == "PNG"
+    # Нехватка памяти уменьшает результат, но не превращает его в превью
+    assert _format(render.render_job(tpl_path, [_photo()], jitter=jitter, scale=0.5)) == "PNG"
+    assert _format(render.render_preview(tpl_path, [_photo()], jitter, 200)) == "JPEG"
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""Подготовка фото в процессе бота: только геометрия шаблона, без растров."""
+import io
+
+from PIL import Image
+
+import render
+
+
+def _png(img: Image.Image) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, "PNG")
+    return buf.getvalue()
+
+
+def test_prepare_photo_does_not_compile_template(tmp_path):
+    tpl = Image.new("RGB", (400, 300), (255, 255, 255))
+    tpl.paste((0, 255, 0), (50, 50, 200, 250))
+    tpl_path = str(tmp_path / "tpl.png")
+    tpl.save(tpl_path)
+    photo = _png(Image.new("RGB", (1200, 900), (200, 100, 50)))
+    before = render.cached_templates()[1]
+
+    prepared = render.prepare_photo(photo, tpl_path)
+
+    with Image.open(io.BytesIO(prepared)) as img:
+        assert img.format == "TIFF"
+    assert render.template_geometry(tpl_path).areas
+    assert render.cached_templates()[1] == before  # кэш скомпилированных шаблонов не тронут
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Вебхук и планировщик вместе: обновления приходят через make_webhook_app,
+ответы уходят через Outbox в поддельный Bot API (fake_botapi.py) с лимитами.
+"""
+import json, time, asyncio
+from typing import Any, Dict, List, Tuple
+
+import aiohttp
+import pytest
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+import webhook
+from fake_botapi import FakeBotApi, start_server
+from outbox import Outbox
+
+SECRET = "test-secret"
+CHAT_ID = 1001
+
+
+class RecordingBotApi(FakeBotApi):
+    """FakeBotApi, запоминающий время и исход каждого запроса."""
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.log: List[Tuple[float, str, int]] = []   # (время, метод, retry_after или 0)
+
+    async def api(self, request):
+        at = time.monotonic()
+        response = await super().api(request)
+        retry_after = json.loads(response.body).get("parameters", {}).get("retry_after", 0)
+        self.log.append((at, request.match_info["method"], retry_after))
+        return response
+
+
+def _update(update_id: int) -> Dict[str, Any]:
+    return {"update_id": update_id,
+            "message": {"message_id": update_id, "date": 0, "text": f"hi {update_id}",
+                        "chat": {"id": CHAT_ID, "type": "private"},
+                        "from": {"id": CHAT_ID, "is_bot": False, "first_name": "test"}}}
+
+
+async def _replay(n_updates: int) -> Tuple[RecordingBotApi, List[int], int, float]:
+    # Чат в поддельном API строже планировщика: часть ответов упрется в 429
+    api = RecordingBotApi(global_rate=100, chat_rate=1, chat_burst=1)
+    api_runner = await start_server(api, "127.0.0.1", 0)
+    api_port = api_runner.addresses[0][1]
+    asyncio_helper.API_URL = f"http://127.0.0.1:{api_port}/bot{{0}}/{{1}}"
+    bot = AsyncTeleBot("0:fake")
+    outbox = Outbox(bot, global_rate=100, chat_rate=10, chat_burst=10)
+    outbox.start()
+
+    replies: List[asyncio.Future] = []
+
+    async def dispatch(update) -> None:
+        fut = asyncio.ensure_future(outbox.send_message(update.message.chat.id, "ok"))
+        replies.append(fut)
+        await fut
+
+    hook_runner = await webhook.start_webhook_server(
+        webhook.make_webhook_app(dispatch, SECRET), "127.0.0.1", 0)
+    url = f"http://127.0.0.1:{hook_runner.addresses[0][1]}{webhook.WEBHOOK_PATH}"
+    try:
+        t0 = time.monotonic()
+        async with aiohttp.ClientSession() as session:
+            statuses = []
+            for i in range(n_updates):
+                async with session.post(url, json=_update(i + 1),
+                                        headers={webhook.SECRET_HEADER: SECRET}) as resp:
+                    statuses.append(resp.status)
+            async with session.post(url, json=_update(99)) as resp:
+                forbidden = resp.status
+        while len(replies) < n_updates:
+            await asyncio.sleep(0.01)
+        await asyncio.wait_for(asyncio.gather(*replies), 30)
+        elapsed = time.monotonic() - t0
+    finally:
+        await outbox.stop()
+        await bot.close_session()
+        await hook_runner.cleanup()
+        await api_runner.cleanup()
+    return api, statuses, forbidden, elapsed
+
+
+@pytest.fixture
+def replayed(monkeypatch):
+    monkeypatch.setattr(asyncio_helper, "API_URL", asyncio_helper.API_URL)
+    return asyncio.run(_replay(3))
+
+
+def test_webhook_accepts_only_signed_updates(replayed):
+    api, statuses, forbidden, _ = replayed
+    assert statuses == [200, 200, 200]
+    assert forbidden == 403
+    assert api.calls == {"sendMessage": 3}   # неподписанное обновление не дошло до хендлера
+
+
+def test_outbox_waits_retry_after(replayed):
+    api, _, _, elapsed = replayed
+    assert api.rejected.get("sendMessage", 0) >= 1
+    # Три ответа в чат с лимитом 1 в секунду не уложить быстрее чем за ~2 с
+    assert elapsed >= 2.0
+    # После 429 следующий запрос в чат уходит не раньше retry_after; допуск — на запросы,
+    # отправленные одновременно с отклоненным, до получения 429
+    for at, _, retry_after in api.log:
+        if retry_after:
+            early = [t for t, _, _ in api.log if at + 0.1 < t < at + retry_after]
+            assert not early, f"запрос через {early[0] - at:.2f} с после 429 с retry_after={retry_after}"
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Прием обновлений Telegram через вебхук: встроенный aiohttp-сервер.
+
+Запрос проверяется по секретному токену, ответ 200 отдается сразу,
+а обработка обновления идет в отдельной задаче цикла событий.
+"""
+
+# ────────────────────────────────────────────────────────────────────
+# ► 0. ИМПОРТЫ
+# ────────────────────────────────────────────────────────────────────
+import os, hmac, json, asyncio, logging, secrets
+from typing import Awaitable, Callable, Set
+
+from aiohttp import web
+from telebot.types import Update
+
+# ────────────────────────────────────────────────────────────────────
+# ► 1. КОНСТАНТЫ
+# ────────────────────────────────────────────────────────────────────
+BOT_MODE           = os.getenv("BOT_MODE", "polling")       # "polling" | "webhook"
+WEBHOOK_URL        = os.getenv("WEBHOOK_URL", "")           # публичный https://host; пусто — не регистрировать
+WEBHOOK_PATH       = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET     = os.getenv("WEBHOOK_SECRET", "")          # пусто — случайный при старте (см. resolve_secret)
+WEBHOOK_HOST       = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT       = int(os.getenv("WEBHOOK_PORT", 8080))
+SECRET_HEADER      = "X-Telegram-Bot-Api-Secret-Token"
+
+# ────────────────────────────────────────────────────────────────────
+# ► 2. СЕРВЕР
+# ────────────────────────────────────────────────────────────────────
+def resolve_secret(secret: str = WEBHOOK_SECRET) -> str:
+    """
+    Секретный токен вебхука. Без него любой, кто знает адрес, мог бы слать
+    боту поддельные обновления, поэтому при пустом WEBHOOK_SECRET генерируется
+    случайный — его бот передает Telegram в setWebhook.
+    """
+    if secret:
+        return secret
+    logging.warning("WEBHOOK_SECRET не задан — сгенерирован случайный; внешние отправители "
+                    "(webhook_replay.py) без него получат 403")
+    return secrets.token_urlsafe(32)
+
+
+def make_webhook_app(dispatch: Callable[[Update], Awaitable[None]],
+                     secret: str, path: str = WEBHOOK_PATH) -> web.Application:
+    """
+    aiohttp-приложение, принимающее обновления на path. dispatch вызывается
+    в фоновой задаче, поэтому Telegram получает ответ, не дожидаясь хендлеров.
+    Запросы без секретного токена secret отклоняются (403).
+    """
+    if not secret:
+        raise ValueError("вебхук без секретного токена принимал бы обновления от кого угодно")
+    tasks: Set[asyncio.Task] = set()
+
+    async def run(update: Update) -> None:
+        try:
+            await dispatch(update)
+        except Exception:
+            logging.exception(f"Ошибка обработки обновления {update.update_id}")
+
+    async def handle(request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            logging.warning(f"Вебхук: неверный секретный токен от {request.remote}")
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(loads=json.loads))
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Вебхук: некорректное обновление: {e}")
+            return web.Response(status=400)
+        # Ссылки на задачи держим, иначе сборщик мусора может снять их до завершения
+        task = asyncio.create_task(run(update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return web.Response(status=200)
+
+    app = web.Application()
+    app.router.add_post(path, handle)  # множество tasks живет в замыкании handle
+    return app
+
+
+async def start_webhook_server(app: web.Application, host: str = WEBHOOK_HOST,
+                               port: int = WEBHOOK_PORT) -> web.AppRunner:
+    """Запускает приложение на host:port; остановка — await runner.cleanup()."""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Вебхук слушает http://{host}:{port}")
+    return runner
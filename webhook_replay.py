@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Проверка режима вебхука: отправляет записанные обновления Telegram на
+локальный сервер и меряет пропускную способность (обновлений в секунду).
+
+Примеры:
+    python webhook_replay.py --updates updates.jsonl --repeat 100
+    python webhook_replay.py --synthetic 5000 --concurrency 64
+    python webhook_replay.py --local --synthetic 20000   # только сам сервер, без бота
+"""
+
+# ────────────────────────────────────────────────────────────────────
+# ► 0. ИМПОРТЫ
+# ────────────────────────────────────────────────────────────────────
+import sys, json, time, asyncio, argparse, logging
+from typing import Any, Dict, List
+
+import aiohttp
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import webhook
+
+# ────────────────────────────────────────────────────────────────────
+# ► 1. ПОДГОТОВКА ОБНОВЛЕНИЙ
+# ────────────────────────────────────────────────────────────────────
+def load_updates(path: str) -> List[Dict[str, Any]]:
+    """Обновления из JSON-массива или JSONL (по одному объекту в строке)."""
+    with open(path, encoding="utf-8") as f:
+        text = f.read().strip()
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def synthetic_updates(n: int, user_id: int) -> List[Dict[str, Any]]:
+    """Простые текстовые сообщения: проходят разбор, но не запускают сценарий бота."""
+    return [{
+        "update_id": i + 1,
+        "message": {
+            "message_id": i + 1, "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "replay"},
+            "text": f"ping {i}",
+        },
+    } for i in range(n)]
+
+
+# ────────────────────────────────────────────────────────────────────
+# ► 2. ОТПРАВКА
+# ────────────────────────────────────────────────────────────────────
+async def replay(url: str, updates: List[Dict[str, Any]], secret: str, concurrency: int) -> Dict[str, Any]:
+    headers = {webhook.SECRET_HEADER: secret} if secret else {}
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    queue: asyncio.Queue = asyncio.Queue()
+    for u in updates:
+        queue.put_nowait(u)
+
+    async def worker(session: aiohttp.ClientSession) -> None:
+        while not queue.empty():
+            update = queue.get_nowait()
+            t0 = time.perf_counter()
+            async with session.post(url, json=update, headers=headers) as resp:
+                await resp.read()
+                statuses[resp.status] = statuses.get(resp.status, 0) + 1
+            latencies.append(time.perf_counter() - t0)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        wall = time.perf_counter() - t0
+
+    latencies.sort()
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000 if latencies else 0.0
+    return {
+        "sent": len(updates), "statuses": statuses, "seconds": round(wall, 3),
+        "updates_per_sec": round(len(updates) / wall, 1) if wall else 0.0,
+        "p50_ms": round(pick(0.50), 2), "p95_ms": round(pick(0.95), 2),
+    }
+
+
+async def run(args) -> Dict[str, Any]:
+    if args.updates:
+        base = load_updates(args.updates)
+    else:
+        base = synthetic_updates(args.synthetic, args.user_id)
+    # Уникальные update_id, как у настоящего потока обновлений
+    updates = []
+    for r in range(args.repeat):
+        for u in base:
+            updates.append(dict(u, update_id=len(updates) + 1))
+
+    runner = None
+    url = args.url
+    if args.local:
+        async def dispatch(update):
+            return None
+        args.secret = webhook.resolve_secret(args.secret)
+        app = webhook.make_webhook_app(dispatch, args.secret, webhook.WEBHOOK_PATH)
+        runner = await webhook.start_webhook_server(app, "127.0.0.1", args.port)
+        url = f"http://127.0.0.1:{args.port}{webhook.WEBHOOK_PATH}"
+    try:
+        return await replay(url, updates, args.secret, args.concurrency)
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Отправка обновлений на вебхук и замер пропускной способности.")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{webhook.WEBHOOK_PORT}{webhook.WEBHOOK_PATH}")
+    parser.add_argument("--updates", help="файл с записанными обновлениями (JSON-массив или JSONL)")
+    parser.add_argument("--synthetic", type=int, default=1000, help="сколько синтетических сообщений, если нет --updates")
+    parser.add_argument("--user-id", type=int, default=1, help="отправитель синтетических сообщений")
+    parser.add_argument("--repeat", type=int, default=1, help="повторить набор обновлений N раз")
+    parser.add_argument("--concurrency", type=int, default=32, help="одновременных запросов")
+    parser.add_argument("--secret", default=webhook.WEBHOOK_SECRET, help="секретный токен вебхука")
+    parser.add_argument("--local", action="store_true", help="поднять сервер в этом процессе с пустым обработчиком")
+    parser.add_argument("--port", type=int, default=8089, help="порт сервера для --local")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    result = asyncio.run(run(args))
+    print(json.dumps(result, ensure_ascii=False))
+    return 0 if set(result["statuses"]) == {200} else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Воркер рендера для режима RENDER_MODE=queue: забирает задачи из общей
+очереди (jobqueue.py), рендерит и кладет результат обратно. Один процесс
+рендерит одну задачу за раз; мощность добавляется числом процессов или
+контейнеров (docker compose --profile queue up -d --scale worker=3).
+
+Пример:
+    python worker.py
+    python worker.py --check   # health-check контейнера
+"""
+
+# ────────────────────────────────────────────────────────────────────
+# ► 0. ИМПОРТЫ
+# ────────────────────────────────────────────────────────────────────
+import os, sys, time, signal, socket, sqlite3, argparse, logging, threading
+from typing import Any, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import render
+from engine import RENDER_MEMORY_BUDGET, default_memory_budget
+from jobqueue import JobQueue, JOB_LEASE, JOB_POLL_INTERVAL
+from health import HEALTH_JOB_STALE
+from logsetup import setup_logging, stop_logging
+
+# ────────────────────────────────────────────────────────────────────
+# ► 1. КОНСТАНТЫ
+# ────────────────────────────────────────────────────────────────────
+PREWARM_TEMPLATES  = os.getenv("PREWARM_TEMPLATES", "1") != "0"  # компилировать шаблоны при старте
+IDLE_POLL_MAX      = 1.0                     # секунд между опросами пустой очереди (после разгона)
+HEARTBEAT_INTERVAL = max(1.0, JOB_LEASE / 4)  # продление аренды и отметка воркера
+
+# ────────────────────────────────────────────────────────────────────
+# ► 2. ВОРКЕР
+# ────────────────────────────────────────────────────────────────────
+class Worker:
+    """
+    Цикл «забрать → отрендерить → сдать» и поток-heartbeat, который
+    продлевает аренду текущей задачи. Если аренду продлить не удалось
+    (задачу отменили или отдали другому воркеру), результат выбрасывается.
+    Задачу дольше HEALTH_JOB_STALE heartbeat считает зависшей и завершает процесс.
+    """
+
+    def __init__(self, queue: JobQueue, worker_id: str, memory_budget: int = RENDER_MEMORY_BUDGET):
+        self.queue = queue
+        self.worker_id = worker_id
+        self.memory_budget = memory_budget or default_memory_budget()
+        self.stop = threading.Event()
+        self._lock = threading.Lock()
+        self._job_id: Optional[int] = None
+        self._job_started = 0.0
+        self._ready = False
+        self._warm = 0
+
+    # ── Heartbeat ──────────────────────────────────────────────────
+    def _beat(self) -> bool:
+        """Отметка воркера и продление аренды. False — задача зависла, аренда не продлена."""
+        with self._lock:
+            job_id, started, ready, warm = self._job_id, self._job_started, self._ready, self._warm
+        self.queue.worker_beat(self.worker_id, ready, warm, job_id)
+        if job_id is None:
+            return True
+        if time.time() - started > HEALTH_JOB_STALE:
+            return False
+        if not self.queue.renew(job_id, self.worker_id):
+            logging.info(f"Аренда задачи {job_id} потеряна — результат будет отброшен")
+        return True
+
+    def _heartbeat_loop(self) -> None:
+        while not self.stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                if not self._beat():
+                    self._abandon()
+            except Exception:
+                logging.exception("Не удалось отметиться в очереди задач")
+
+    def _abandon(self) -> None:
+        """
+        Рендер завис, а прервать его из другого потока нельзя. Аренда больше
+        не продлевается — после ее истечения бот вернет задачу в очередь
+        (expire_leases), — а процесс завершается, и docker его перезапускает.
+        """
+        logging.error(f"Задача {self._job_id} в работе дольше {HEALTH_JOB_STALE} с — "
+                      f"рендер завис, воркер {self.worker_id} завершается")
+        try:
+            self.queue.worker_gone(self.worker_id)
+        except Exception:
+            logging.exception("Не удалось снять отметку воркера")
+        stop_logging()
+        os._exit(1)
+
+    # ── Цикл ───────────────────────────────────────────────────────
+    def run(self, prewarm: List[str]) -> None:
+        self._beat()
+        threading.Thread(target=self._heartbeat_loop, name="worker-heartbeat", daemon=True).start()
+        render.preload_filter()
+        if prewarm:
+            report = render.prewarm_templates(prewarm)
+            logging.info(f"Воркер прогрет: шаблонов {len(report['templates'])}, ошибок {report['failed']}, "
+                         f"не прогрето (бюджет кэша) {report['skipped']} за {report['seconds']:.1f} с")
+        with self._lock:
+            self._ready, self._warm = True, len(render.cached_templates()[1])
+        self._beat()
+        logging.info(f"Воркер {self.worker_id} готов: бюджет памяти {self.memory_budget >> 20} МБ")
+
+        idle = JOB_POLL_INTERVAL
+        while not self.stop.is_set():
+            try:
+                claimed = self.queue.claim(self.worker_id)
+            except sqlite3.Error as e:
+                # База на общем томе временно недоступна (блокировка, сеть) — ждем, как при пустой очереди
+                logging.warning(f"Не удалось взять задачу из очереди: {e}")
+                claimed = None
+            if claimed is None:
+                self.stop.wait(idle)
+                idle = min(IDLE_POLL_MAX, idle * 2)
+                continue
+            idle = JOB_POLL_INTERVAL
+            job_id, payload, attempt = claimed
+            with self._lock:
+                self._job_id, self._job_started = job_id, time.time()
+            try:
+                self._process(job_id, payload, attempt)
+            finally:
+                with self._lock:
+                    self._job_id, self._warm = None, len(render.cached_templates()[1])
+                self._beat()
+        self.queue.worker_gone(self.worker_id)
+
+    def _fit_scale(self, tpl_path: str, photos: List[str]) -> Dict[str, Any]:
+        """Оценка памяти и масштаб по бюджету воркера — как в RenderEngine.estimate."""
+        warm = os.path.abspath(tpl_path) in render.cached_templates()[1]
+        try:
+            estimate = render.estimate_job_memory(tpl_path, photos, template_cached=warm)
+            scale = 1.0
+            if estimate > self.memory_budget:
+                scale, estimate = render.fit_render_scale(tpl_path, photos, self.memory_budget, template_cached=warm)
+                logging.warning(f"Задача не помещается в бюджет памяти воркера → масштаб {scale:g} "
+                                f"({estimate >> 20}МБ из {self.memory_budget >> 20}МБ)")
+        except Exception as e:
+            logging.warning(f"Не удалось оценить память задачи: {e}")
+            estimate, scale = 0, 1.0
+        return {"render_scale": scale, "mem_estimate_bytes": estimate}
+
+    def _process(self, job_id: int, payload: Dict[str, Any], attempt: int) -> None:
+        chat_id, tpl_path, photos, seed = payload["chat_id"], payload["tpl_path"], payload["photos"], payload.get("seed")
+        logging.info(f"Задача {job_id} взята | chat={chat_id} попытка={attempt}")
+        t0 = time.perf_counter()
+        try:
+            jitter = None if seed is None else render.draw_jitter(len(photos), seed)
+            fit = self._fit_scale(tpl_path, photos)
+            preview_total = None
+            if payload.get("preview_size") and jitter is not None:
+                try:
+                    preview = render.render_preview(tpl_path, photos, jitter, payload["preview_size"])
+                    self.queue.put_preview(job_id, self.worker_id, preview)
+                    preview_total = time.perf_counter() - t0
+                except Exception as e:
+                    logging.warning(f"Превью не удалось, продолжаем без него | chat={chat_id}: {e}")
+            result, stats = render.render_job_with_stats(tpl_path, photos, payload.get("mono_dir"), jitter,
+                                                         fit["render_scale"])
+        except Exception as e:
+            logging.exception(f"Ошибка рендера задачи {job_id} | chat={chat_id}")
+            self.queue.fail(job_id, self.worker_id, f"{type(e).__name__}: {e}")
+            return
+        stats.update(fit, worker=self.worker_id, attempt=attempt)
+        if preview_total is not None:
+            stats["preview_total"] = preview_total
+        if self.queue.complete(job_id, self.worker_id, result, stats):
+            logging.info(f"Задача {job_id} готова за {time.perf_counter() - t0:.2f} с | chat={chat_id} "
+                         f"память: оценка {fit['mem_estimate_bytes'] >> 20} МБ, факт {stats['job_rss_bytes'] >> 20} МБ")
+        else:
+            logging.info(f"Результат задачи {job_id} отброшен: задачу отменили или отдали другому воркеру")
+
+# ────────────────────────────────────────────────────────────────────
+# ► 3. ЗАПУСК
+# ────────────────────────────────────────────────────────────────────
+def check(queue: JobQueue) -> int:
+    """Health-check контейнера: воркер этого хоста недавно отмечался и не завис на задаче."""
+    seen = queue.worker_seen(socket.gethostname())
+    now = time.time()
+    if seen is None or now - seen["seen_at"] > 3 * HEARTBEAT_INTERVAL:
+        print("нет свежей отметки воркера")
+        return 1
+    if seen["job_started_at"] is not None and now - seen["job_started_at"] > HEALTH_JOB_STALE:
+        print(f"задача в работе {now - seen['job_started_at']:.0f} с")
+        return 1
+    return 0
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Воркер рендера общей очереди задач.")
+    parser.add_argument("--check", action="store_true", help="проверить воркер этого хоста и выйти")
+    args = parser.parse_args(argv)
+    queue = JobQueue()
+    if args.check:
+        return check(queue)
+
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    # Свой файл на контейнер (в контейнере один воркер): несколько процессов не могут
+    # ротировать один файл, а ключ по pid плодил бы новый файл на каждый рестарт
+    setup_logging(log_file=f"worker-{socket.gethostname()}.log", jobs_file=None)
+    worker = Worker(queue, worker_id)
+    # SIGTERM (docker stop): текущая задача дорендеривается, новые не берутся
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: worker.stop.set())
+    templates = render.find_templates() if PREWARM_TEMPLATES else []
+    try:
+        worker.run(templates)
+    except Exception:
+        logging.exception("Воркер остановлен с ошибкой")
+        return 1
+    finally:
+        logging.info(f"Воркер {worker_id} остановлен")
+        stop_logging()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())